@@ -10,9 +10,14 @@ from app.routers import generic_router, messages_router, rooms_router, room_id_r
 from app.routers.admin import admin_websocket_endpoint
 from app.routers.user import users_router
 from app.routers.search import search_messages_router, search_rooms_router
-from app.routers.websocket import websocket_endpoint, websocket_manager
+from app.routers.websocket import admin_statistics, broker_health_monitor, message_ingestion_queue, \
+    presence_service, read_cursor_coalescer, websocket_endpoint
 from app.util import setup_cassandra, setup_neo4j
 from app.util.elasticsearch import es as elasticsearch_client, setup_elasticsearch
+from app.util.graph import graph_executor
+from app.util.ingestion import MESSAGE_INGESTION_ENABLED
+from app.util.passwords import password_hasher
+from app.util.websocket import websocket_manager
 from app.util.config import APP_NAME, DEBUG, TESTING
 
 
@@ -66,6 +71,8 @@ async def startup() -> None:
     if TESTING:
         logging.info('App: skipping startup tasks for testing')
     else:
+        # forks the password hashing workers, before the database drivers start their threads
+        password_hasher.start()
         try:
             setup_neo4j()
             setup_cassandra()
@@ -73,10 +80,25 @@ async def startup() -> None:
             await websocket_manager.startup()
         except Exception as e:
             logging.error(f'App: startup tasks failed: {e}')
+        finally:
+            # also started when the broker is down, it reconnects the websocket manager once the broker is back
+            broker_health_monitor.start()
+            presence_service.start()
+            admin_statistics.start()
+            if MESSAGE_INGESTION_ENABLED:
+                message_ingestion_queue.start()
 
 
 @app.on_event('shutdown')
 async def shutdown() -> None:
+    await broker_health_monitor.stop()
+    await admin_statistics.stop()
+    # flush the messages that are being written, before the connections they have to be sent to are closed
+    await message_ingestion_queue.stop()
+    await read_cursor_coalescer.stop()
+    # the users connected to this node go offline with it
+    await presence_service.stop()
+
     try:
         await websocket_manager.shutdown()
     except:
@@ -89,6 +111,9 @@ async def shutdown() -> None:
         logging.info('App: failed to close elasticsearch connection, or it was already closed')
         pass
 
+    graph_executor.shutdown()
+    password_hasher.shutdown()
+
 
 if __name__ == '__main__':
     log_config = uvicorn.config.LOGGING_CONFIG
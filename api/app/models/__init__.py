@@ -1,4 +1,5 @@
 from .enums import UserStates
 from .message import Message
+from .read_cursor import ReadCursor
 from .room import Room, RoomRel
 from .user import User, UserStatus
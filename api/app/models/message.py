@@ -12,7 +12,8 @@ class Message(Model):
     - Most performed queries:
         - Get messages in a room, ordered by date: `room_id` and `index_id`
         - Get a single message by id
-            - to update stats like distributed, saved, etc: `uuid`
+            - to update stats like distributed, saved, etc: `uuid` (the seen state is derived from the read cursors
+              of the room instead, see `apply_read_cursors`)
             - to perform actions like delete, reply, etc: `uuid`
         - create new messages, which could be a reply to another message: `uuid`
 
@@ -0,0 +1,25 @@
+from datetime import datetime
+from uuid import UUID
+
+from cassandra.cqlengine import columns
+from cassandra.cqlengine.models import Model
+
+
+class ReadCursor(Model):
+    """
+    How far a user has read in a room, stored in Cassandra.
+
+    Instead of marking every message as seen, every member of a room has a single cursor: all messages up to (and
+    including) `index_id` have been seen by the user. Whether a message has been seen is derived by comparing its
+    `index_id` against the cursors of the other members of the room.
+
+    `room_id` is the partition key, so the cursors of all members of a room (needed when fetching the messages of the
+    room) are read from a single partition. A cursor only moves forward: it is written with the time of `index_id` as
+    write timestamp, so an older cursor never overwrites a newer one, without a read before the write.
+    """
+
+    __table_name__ = 'read_cursor'
+
+    room_id: UUID = columns.UUID(primary_key=True, partition_key=True)
+    user_id: UUID = columns.UUID(primary_key=True)
+    index_id: datetime = columns.DateTime(required=True)
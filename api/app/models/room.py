@@ -1,12 +1,27 @@
-from typing import Generator, TYPE_CHECKING
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
 
 from neomodel import StringProperty, IntegerProperty, DateTimeProperty, UniqueIdProperty, \
-    StructuredNode, StructuredRel, BooleanProperty, RelationshipFrom
+    StructuredNode, StructuredRel, BooleanProperty, RelationshipFrom, db
 
-from app.schemas.user import UserSchema
+from app.models.enums import UserStates
+from app.schemas.user import UserSchema, UserStateSchema
 
-if TYPE_CHECKING:
-    from app.models.user import User
+# Projection of the members of rooms, including their status and typing flag, in a single round trip
+ROOM_MEMBERS_QUERY = """
+UNWIND $room_uuids AS room_uuid
+MATCH (room:Room {uuid: room_uuid})
+OPTIONAL MATCH (user:User)-[in_room:IN_ROOM]->(room)
+OPTIONAL MATCH (user)-[status_rel:HAS_STATUS]->(status:UserStatus)
+RETURN room.uuid, collect(CASE WHEN user IS NULL THEN NULL ELSE {
+    uuid: user.uuid,
+    username: user.username,
+    is_admin: user.is_admin,
+    state: status.state,
+    last_changed: status_rel.last_changed,
+    is_typing: in_room.is_typing
+} END)
+"""
 
 
 class RoomRel(StructuredRel):
@@ -32,18 +47,51 @@ class Room(StructuredNode):
     last_message = StringProperty(default=None)  # TODO: check if this needs to be a uuid or needs to be a full Message
     connected_users = RelationshipFrom('.user.User', 'IN_ROOM', model=RoomRel)
 
+    @staticmethod
+    def _member_from_projection(member: dict) -> Tuple[UserSchema, bool]:
+        from app.models.user import User
+
+        last_changed = member['last_changed']
+        return UserSchema(
+            uuid=member['uuid'],
+            username=member['username'],
+            is_admin=member['is_admin'] or False,
+            avatar=User.avatar,
+            status=UserStateSchema(
+                state=member['state'] or UserStates.OFFLINE.value,
+                last_changed=datetime.fromtimestamp(last_changed, tz=timezone.utc)
+                if member['state'] and last_changed is not None else None,
+            ),
+        ), bool(member['is_typing'])
+
+    @classmethod
+    def load_members(cls, rooms: Iterable['Room']) -> None:
+        """
+        Load the members of the given rooms, including their status and typing flag, using a single query.
+        Without this, every member would cost a query for the member itself, two for its status and one for its
+        typing flag.
+        :param rooms: The rooms to load the members of
+        """
+        rooms = list(rooms)
+        if not rooms:
+            return
+        results, _ = db.cypher_query(ROOM_MEMBERS_QUERY, {'room_uuids': [room.uuid for room in rooms]})
+        members: Dict[str, list] = {room_uuid: projection for room_uuid, projection in results}
+        for room in rooms:
+            room._members = [cls._member_from_projection(member) for member in members.get(room.uuid, [])]
+
+    def _get_members(self) -> List[Tuple[UserSchema, bool]]:
+        if getattr(self, '_members', None) is None:
+            Room.load_members([self])
+        return self._members
+
     @property
-    def users(self) -> Generator[UserSchema, None, None]:
+    def users(self) -> List[UserSchema]:
         """
-        Return generator for obtaining all users in this room as UserSchema objects.
+        All users in this room as UserSchema objects, loaded together with `typing_users`.
         """
-        return (UserSchema.from_orm(user) for user in self.connected_users.all())
+        return [user for user, _ in self._get_members()]
 
     @property
-    def typing_users(self) -> Generator['User', None, None]:
-        return (
-            user
-            for user
-            in self.connected_users.all()
-            if self.connected_users.relationship(user).is_typing
-        )
+    def typing_users(self) -> List[UserSchema]:
+        return [user for user, is_typing in self._get_members() if is_typing]
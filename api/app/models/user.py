@@ -23,6 +23,9 @@ class UserStatus(StructuredNode):
     The status of a user is also represented as a node in a graph database since we can then easily change the
     connection of a user node to its respective status node, thereby allowing us to do an insanely fast lookup of
     all users with a specific status, as it's just a matter of finding all connected nodes to a status node.
+
+    The live status of users is kept by the presence store in Redis, the status relations are a snapshot of it that
+    is saved periodically (for analytics), see `PresenceService`.
     """
     USER_STATES = {status.value: status.value for status in UserStates}
 
@@ -68,7 +71,7 @@ class User(StructuredNode):
             }
         return {
             'state': UserStates.OFFLINE.value,
-            'last_changed': '',
+            'last_changed': None,
         }
 
     @classmethod
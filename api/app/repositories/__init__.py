@@ -0,0 +1,4 @@
+from .message import MessageRepository, message_repository
+from .read_cursor import ReadCursorRepository, read_cursor_repository
+from .room import RoomRepository, room_repository
+from .user import UserRepository, user_repository
@@ -0,0 +1,86 @@
+from datetime import datetime
+from typing import List, Optional, Sequence
+from uuid import UUID
+
+from cassandra.cluster import ResultSet
+from cassandra.query import UNSET_VALUE
+
+from app.models import Message
+from app.util.cassandra import MESSAGE_COLUMNS, message_statements
+
+
+class MessageRepository:
+    """
+    Async data access for the Message table.
+
+    The cqlengine ORM (and `Session.execute`) block until Cassandra answers, which stalls the whole event loop.
+    All queries in here are prepared statements of the `message_statements` registry, executed with
+    `Session.execute_async` instead, so many of them can be in flight at once.
+    The ORM model is still used to describe the table and to represent messages.
+    """
+
+    @staticmethod
+    def build(**values) -> Message:
+        """
+        Create a new (validated) message, without saving it.
+        :param values: The values of the message, missing values get the defaults of the `Message` model
+        :return: The unsaved message
+        """
+        message = Message(**values)
+        message.validate()
+        return message
+
+    @staticmethod
+    def _insert_parameters(message: Message) -> List:
+        parameters = [getattr(message, name) for name, _ in MESSAGE_COLUMNS]
+        # unset values are not written at all, instead of writing a tombstone
+        return [UNSET_VALUE if value is None else value for value in parameters]
+
+    async def create(self, **values) -> Message:
+        """
+        Create and save a new message.
+        :param values: The values of the message, missing values get the defaults of the `Message` model
+        :return: The saved message
+        """
+        message = self.build(**values)
+        await self.insert(message)
+        return message
+
+    async def insert(self, message: Message) -> None:
+        """
+        Save a (built) message.
+        """
+        await message_statements.execute('insert_message', self._insert_parameters(message))
+
+    async def create_many(self, messages: Sequence[Message]) -> None:
+        """
+        Save multiple messages of the same room with a single unlogged batch. All rows are in the same partition, so
+        the batch is applied atomically by a single replica set, without the overhead of a logged batch.
+        :param messages: The (built) messages to save, all of the same room
+        """
+        await message_statements.execute_batch(
+            'insert_message', [self._insert_parameters(message) for message in messages]
+        )
+
+    async def get(self, room_id: UUID, index_id: datetime, uuid: UUID) -> Optional[Message]:
+        """
+        Get a single message by its full primary key.
+        :return: The message, or None if it does not exist
+        """
+        results = await message_statements.execute('get_message', [room_id, index_id, uuid])
+        if not results.current_rows:
+            return None
+        return Message._construct_instance(results.current_rows[0])
+
+    async def get_page(self, room_id: UUID, count: int, paging_state: Optional[bytes] = None) -> ResultSet:
+        """
+        Get a page of the messages of a room, newest first.
+        :param room_id: The room to get the messages of
+        :param count: The size of the page
+        :param paging_state: The paging state of the previous page, if any
+        :return: The `ResultSet` of the page, containing the rows (as dicts) and the paging state of the next page
+        """
+        return await message_statements.execute('get_messages', [room_id], fetch_size=count, paging_state=paging_state)
+
+
+message_repository = MessageRepository()
@@ -0,0 +1,39 @@
+import calendar
+from datetime import datetime
+from typing import Dict, Mapping
+from uuid import UUID
+
+from app.util.cassandra import read_cursor_statements
+
+
+def _write_timestamp(index_id: datetime) -> int:
+    # microseconds since the epoch, `index_id` is a naive UTC datetime
+    return calendar.timegm(index_id.utctimetuple()) * 1_000_000 + index_id.microsecond
+
+
+class ReadCursorRepository:
+    """
+    Async data access for the ReadCursor table, with the prepared statements of the `read_cursor_statements` registry.
+    """
+
+    async def get_room_cursors(self, room_id: UUID) -> Dict[UUID, datetime]:
+        """
+        Get the read cursors of all members of a room (that have read anything in it).
+        :return: The `index_id` up to which every user has seen the messages of the room, by user id
+        """
+        results = await read_cursor_statements.execute('get_read_cursors', [room_id])
+        return {row['user_id']: row['index_id'] for row in results.current_rows}
+
+    async def advance(self, room_id: UUID, cursors: Mapping[UUID, datetime]) -> None:
+        """
+        Move the read cursors of users in a room forward, with a single unlogged batch (all rows are in the same
+        partition). A cursor that is older than the stored cursor of the user is ignored by Cassandra.
+        :param room_id: The room of the cursors
+        :param cursors: The new `index_id` of the cursor, by user id
+        """
+        await read_cursor_statements.execute_batch('advance_read_cursor', [
+            [_write_timestamp(index_id), index_id, room_id, user_id] for user_id, index_id in cursors.items()
+        ])
+
+
+read_cursor_repository = ReadCursorRepository()
@@ -0,0 +1,92 @@
+from typing import FrozenSet, List, Optional
+from uuid import UUID
+
+from app.models import Room, User
+from app.util.graph import graph_executor
+from app.util.membership import get_user_room_ids
+from app.util.presence import apply_presence
+
+
+class RoomRepository:
+    """
+    Async data access for rooms and their members.
+
+    Like the `UserRepository`, every operation runs as a whole on the graph executor. Rooms are returned with their
+    members loaded, so converting them to a `RoomSchema` does not query Neo4j on the event loop. The status of the
+    members is their live status from the presence store.
+    """
+
+    async def get_by_id(self, uuid: UUID | str) -> Optional[Room]:
+        return await graph_executor.run(Room.nodes.get_or_none, uuid=UUID(str(uuid)).hex)
+
+    async def get_by_name(self, room_name: str) -> Optional[Room]:
+        return await graph_executor.run(Room.nodes.get_or_none, room_name=room_name)
+
+    async def get_user_rooms(self, user_uuid: UUID | str, name_contains: str | None = None) -> List[Room]:
+        """
+        Get the rooms of a user, including their members.
+        :param user_uuid: The user to get the rooms of
+        :param name_contains: Only get the rooms whose name contains this (case-insensitive)
+        :return: The rooms of the user
+        """
+        def get_rooms() -> List[Room]:
+            user = User.nodes.get(uuid=UUID(str(user_uuid)).hex)
+            rooms = list(user.rooms.filter(room_name__icontains=name_contains) if name_contains else user.rooms)
+            Room.load_members(rooms)
+            return rooms
+
+        rooms = await graph_executor.run(get_rooms)
+        await apply_presence(user for room in rooms for user in room.users)
+        return rooms
+
+    async def get_user_room_ids(self, user_uuid: UUID | str) -> FrozenSet[str]:
+        """
+        Get the hex uuids of the rooms of a user, without loading the rooms themselves.
+        These are cached until the user joins or leaves a room.
+        """
+        return await get_user_room_ids(user_uuid)
+
+    async def create(self, room_name: str, user_uuid: UUID | str) -> Room:
+        """
+        Create a new room, with the user creating it as its only member.
+        :return: The created room, including its members
+        """
+        def create_room() -> Room:
+            user = User.nodes.get(uuid=UUID(str(user_uuid)).hex)
+            room = Room(room_name=room_name)
+            room.save()
+            room.connected_users.connect(user)
+            Room.load_members([room])
+            return room
+
+        room = await graph_executor.run(create_room)
+        await apply_presence(room.users)
+        return room
+
+    async def join(self, room: Room, user_uuid: UUID | str) -> Room:
+        """
+        Add a user to the members of a room.
+        :return: The room, including its members
+        """
+        def join_room() -> Room:
+            user = User.nodes.get(uuid=UUID(str(user_uuid)).hex)
+            user.rooms.connect(room)
+            Room.load_members([room])
+            return room
+
+        room = await graph_executor.run(join_room)
+        await apply_presence(room.users)
+        return room
+
+    async def leave(self, room: Room, user_uuid: UUID | str) -> None:
+        """
+        Remove a user from the members of a room.
+        """
+        def leave_room() -> None:
+            user = User.nodes.get(uuid=UUID(str(user_uuid)).hex)
+            room.connected_users.disconnect(user)
+
+        await graph_executor.run(leave_room)
+
+
+room_repository = RoomRepository()
@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+from typing import Mapping, Optional, Tuple
+from uuid import UUID
+
+from neomodel import db
+
+from app.models import User, UserStates
+from app.schemas.user import UserSchema
+from app.util.graph import graph_executor
+from app.util.instrumentation import register_cypher_statements
+
+# Replaces the status relation of every user, `last_changed` is stored as a timestamp like `StatusRel` does
+STATUS_SNAPSHOT_QUERY = """
+UNWIND $statuses AS status
+MATCH (user:User {uuid: status.uuid}), (state:UserStatus {state: status.state})
+OPTIONAL MATCH (user)-[old:HAS_STATUS]->(:UserStatus)
+WITH user, state, status, collect(old) AS old_rels
+FOREACH (rel IN old_rels | DELETE rel)
+CREATE (user)-[:HAS_STATUS {last_changed: status.last_changed}]->(state)
+"""
+
+USER_COUNT_QUERY = 'MATCH (user:User) RETURN count(user)'
+
+register_cypher_statements({'save_status_snapshot': STATUS_SNAPSHOT_QUERY, 'count_users': USER_COUNT_QUERY})
+
+
+class UserRepository:
+    """
+    Async data access for users and their status.
+
+    neomodel only has a blocking API, so every operation in here runs as a whole on the graph executor: the event loop
+    never waits for Neo4j, and an operation that needs multiple queries only needs a single hop to the executor.
+    """
+
+    async def get_by_id(self, uuid: UUID | str, **kwargs) -> Optional[User]:
+        """
+        Get a user by its UUID.
+        :return: The user, or None if it does not exist
+        """
+        return await graph_executor.run(User.get_user_by_id, UUID(str(uuid)).hex, **kwargs)
+
+    async def get_by_username(self, username: str, **kwargs) -> Optional[User]:
+        """
+        Get a user by its username.
+        :return: The user, or None if it does not exist
+        """
+        return await graph_executor.run(User.get_user_by_username, username, **kwargs)
+
+    async def create(self, username: str, hashed_password: str) -> User:
+        """
+        Create and save a new user.
+        :param username: The (unique) username of the user
+        :param hashed_password: The hash of the password of the user
+        :return: The saved user
+        """
+        def create_user() -> User:
+            user = User(username=username, hashed_password=hashed_password)
+            user.save()
+            return user
+
+        return await graph_executor.run(create_user)
+
+    async def count(self) -> int:
+        """
+        Count all users, without loading them (Neo4j answers this from its count store).
+        """
+        results, _ = await graph_executor.run(db.cypher_query, USER_COUNT_QUERY)
+        return results[0][0]
+
+    async def save_status_snapshot(self, statuses: Mapping[UUID | str, Tuple[UserStates, datetime]]) -> None:
+        """
+        Save the status of users (kept by the presence store) in Neo4j, for analytics, using a single query.
+        Every user is connected to the node of its state, the relation keeps track of when the status changed.
+        :param statuses: The state and the time of the status change, per user
+        """
+        await graph_executor.run(db.cypher_query, STATUS_SNAPSHOT_QUERY, {'statuses': [
+            {
+                'uuid': UUID(str(user_id)).hex,
+                'state': state.value,
+                'last_changed': changed_at.replace(tzinfo=timezone.utc).timestamp(),
+            }
+            for user_id, (state, changed_at) in statuses.items()
+        ]})
+
+    async def to_schema(self, user: User) -> UserSchema:
+        """
+        Convert a user to a `UserSchema`, with the status of the user as last snapshotted in Neo4j (see
+        `apply_presence` for the live status).
+        """
+        return await graph_executor.run(UserSchema.from_orm, user)
+
+
+user_repository = UserRepository()
@@ -1,15 +1,15 @@
-from functools import partial
-import logging
+import asyncio
 import os
 from uuid import UUID
 
-from cassandra.cqlengine import connection as cassandra_connection
 from fastapi import APIRouter, Depends, Security
+from fastapi.responses import Response
 
-from app.models import Message
-from app.schemas.message import MessageFetchSchema, MessageSchema
+from app.repositories import message_repository, read_cursor_repository
+from app.schemas.message import MessageFetchSchema
 from app.util.authentication import MESSAGE_SCOPES, get_jwt_user
-from app.util.cassandra import CASSANDRA_DEFAULT_KEYSPACE, get_messages_pstmt
+from app.util.read_cursors import apply_read_cursors
+from app.util.serialization import message_encoder
 from app.routers.dependencies import ensure_cassandra_connection
 
 messages_router = APIRouter(
@@ -42,43 +42,26 @@ async def get_messages(room_id: UUID, c: int = None, ps: str = None):
     :param ps: (paging_state) Used for pagination.
     :return: `MessageFetchSchema`
     """
-    global get_messages_pstmt
-
     count = c
     paging_state = ps
 
     if not count:
-        count = os.environ['DEFAULT_MESSAGE_FETCH_COUNT']
-    query = Message.objects.filter(room_id=room_id)
-
-    if get_messages_pstmt is None:
-        logging.info('Cassandra: preparing get_messages_pstmt...')
-        get_messages_pstmt = cassandra_connection.get_session().prepare(
-            f'SELECT * FROM {CASSANDRA_DEFAULT_KEYSPACE}.message WHERE room_id = ? ORDER BY index_id DESC'
-        )
-    get_messages_pstmt.fetch_size = count
+        count = int(os.environ['DEFAULT_MESSAGE_FETCH_COUNT'])
 
-    query = partial(cassandra_connection.get_session().execute,
-        get_messages_pstmt, 
-        parameters=[room_id],
+    # The read cursors of the room are read alongside the page, the seen state of the messages is derived from them
+    results, cursors = await asyncio.gather(
+        message_repository.get_page(
+            room_id,
+            count,
+            paging_state=bytes.fromhex(paging_state) if paging_state else None,
+        ),
+        read_cursor_repository.get_room_cursors(room_id),
     )
-    if paging_state:
-        query = partial(query, paging_state=bytes.fromhex(paging_state))
-
-    results = query()
-
-    def result_to_schema(result):
-        result['date'] = result['date'].date().strftime('%d-%m-%Y')
-        result['time_stamp'] = result['stamp'].time().strftime('%H:%M:%S')
-        return MessageSchema(**result)
-
-    paging_state = results.paging_state
-    paging_state_decoded = paging_state.hex() if paging_state else None
-
-    messages = [result_to_schema(result) for result in results.current_rows]
+    apply_read_cursors(results.current_rows, cursors)
 
-    return MessageFetchSchema(
-        messages=messages,
-        count=len(messages),
-        paging_state=paging_state_decoded
+    # The rows are encoded straight to the JSON of a `MessageFetchSchema`, returning a Response skips the validation of
+    # the response model (which is still used for the documentation)
+    return Response(
+        content=message_encoder.encode_page(results.current_rows, results.paging_state),
+        media_type='application/json',
     )
@@ -3,10 +3,12 @@ from typing import List
 from uuid import UUID
 
 from fastapi import APIRouter, HTTPException, Security
+from redis.exceptions import RedisError
 
-from app.models import Room, User
+from app.repositories import room_repository
 from app.schemas.room import NewRoomSchema, RoomSchema
 from app.util.authentication import get_jwt_user, ROOM_SCOPES
+from app.util.websocket import websocket_manager
 
 rooms_router = APIRouter(
     prefix='/rooms',
@@ -27,6 +29,18 @@ room_id_router = APIRouter(
 )
 
 
+async def publish_room_membership(user_uuid: UUID, room_id: UUID | str, joined: bool) -> None:
+    """
+    Let all nodes know that the membership of a room changed. By then the change is already saved in Neo4j, so a broker
+    failure does not fail the request: the change is still applied on this node, other nodes resync the room
+    subscriptions of their connections once they reconnect to the broker.
+    """
+    try:
+        await websocket_manager.publish_room_membership(user_uuid, room_id, joined=joined)
+    except (RedisError, OSError) as e:
+        logging.error('Room %s: failed to publish membership change of user %s: %s', room_id, user_uuid, e)
+
+
 @rooms_router.get('', response_model=List[RoomSchema])
 async def get_rooms(user_uuid: UUID = Security(get_jwt_user, scopes=ROOM_SCOPES)):
     """
@@ -34,8 +48,8 @@ async def get_rooms(user_uuid: UUID = Security(get_jwt_user, scopes=ROOM_SCOPES)
     :param user_uuid: The UUID of the user to get rooms for.
     :return: `List[RoomSchema]`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    return [RoomSchema.from_orm(room) for room in user.rooms]
+    rooms = await room_repository.get_user_rooms(user_uuid)
+    return [RoomSchema.from_orm(room) for room in rooms]
 
 
 @rooms_router.post('', status_code=201, response_model=RoomSchema)
@@ -44,13 +58,11 @@ async def create_room(room_details: NewRoomSchema, user_uuid: UUID = Security(ge
     Create a new room for a user.
     :return: `RoomSchema`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    existing_room = Room.nodes.get_or_none(room_name=room_details.room_name)
+    existing_room = await room_repository.get_by_name(room_details.room_name)
     if existing_room:
         raise HTTPException(status_code=409, detail='Room already exists')
-    room = Room(room_name=room_details.room_name)
-    room.save()
-    room.connected_users.connect(user)
+    room = await room_repository.create(room_details.room_name, user_uuid)
+    await publish_room_membership(user_uuid, room.uuid, joined=True)
 
     logging.info('Room %s: created by user %s', room.uuid, user_uuid)
     return RoomSchema.from_orm(room)
@@ -64,11 +76,11 @@ async def join_room(room_details: NewRoomSchema, user_uuid: UUID = Security(get_
     :param user_uuid: The UUID of the user to join the room.
     :return: `RoomSchema`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    room = Room.nodes.get_or_none(room_name=room_details.room_name)
+    room = await room_repository.get_by_name(room_details.room_name)
     if not room:
         raise HTTPException(status_code=404, detail='Room not found')
-    user.rooms.connect(room)
+    room = await room_repository.join(room, user_uuid)
+    await publish_room_membership(user_uuid, room.uuid, joined=True)
     logging.info('Room %s: user %s joined room', room.uuid, user_uuid)
     return RoomSchema.from_orm(room)
 
@@ -81,13 +93,13 @@ async def leave_room(room_id: UUID, user_uuid: UUID = Security(get_jwt_user, sco
     :param user_uuid: The UUID of the user to leave the room.
     :return: `None`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    room = Room.nodes.get_or_none(uuid=room_id.hex)
+    room = await room_repository.get_by_id(room_id)
 
     if room is None:
         raise HTTPException(status_code=404, detail='Room not found')
 
-    room.connected_users.disconnect(user)
+    await room_repository.leave(room, user_uuid)
+    await publish_room_membership(user_uuid, room_id, joined=False)
 
     logging.info('Room %s: user %s left room', room_id, user_uuid)
     return None
@@ -1,15 +1,29 @@
-from datetime import datetime
-from itertools import groupby
+import os
+from typing import List, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Security
+from fastapi import APIRouter, HTTPException, Query, Security
+from fastapi.responses import Response
+import orjson
 
-from app.models import User, Message
-from app.schemas.message import MessageSchema
+from app.models import User
+from app.repositories import room_repository
 from app.schemas.room import RoomSchema
 from app.schemas.search import MessagesSearchResultSchema, RoomsSearchResultSchema
 from app.util.authentication import MESSAGE_SCOPES, ROOM_SCOPES, get_jwt_user
-from app.util.elasticsearch import es as elasticsearch_client, message_index
+from app.util.elasticsearch import es as elasticsearch_client, message_content_query, message_index
+from app.util.search_cache import search_result_cache
+from app.util.serialization import search_message_encoder
+
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', 100))
+# Messages per room of grouped searches
+SEARCH_GROUP_SIZE = int(os.environ.get('SEARCH_GROUP_SIZE', 5))
+
+# Newest messages first, the uuid breaks ties between messages written at the same time
+MESSAGE_SEARCH_SORT = [{'index_id': 'desc'}, {'uuid': 'asc'}]
+# Only the fields of the response are fetched
+MESSAGE_SEARCH_SOURCE = ['room_id', *search_message_encoder.columns]
 
 search_messages_router = APIRouter(
     prefix='/search/messages',
@@ -24,56 +38,129 @@ search_rooms_router = APIRouter(
 )
 
 
+def search_rooms_body(query: dict, rooms: int, size: int) -> dict:
+    """
+    The search of the newest matches of every room (a `top_hits` per `room_id` bucket), with the number of matches per
+    room. The rooms with the newest matches come first.
+    :param query: The query of the messages
+    :param rooms: The number of rooms that are searched, every room can get a bucket
+    :param size: The number of messages per room
+    """
+    return {
+        'query': query,
+        'size': 0,
+        'aggs': {
+            'rooms': {
+                'terms': {'field': 'room_id', 'size': rooms, 'order': {'newest': 'desc'}},
+                'aggs': {
+                    'newest': {'max': {'field': 'index_id'}},
+                    'messages': {
+                        'top_hits': {'size': size, 'sort': MESSAGE_SEARCH_SORT, '_source': MESSAGE_SEARCH_SOURCE},
+                    },
+                },
+            },
+        },
+    }
+
+
+def encode_search_paging_state(sort: List) -> str:
+    """
+    Encode the sort values of the last hit of a page, the next page is searched after them.
+    :param sort: The `index_id` (in epoch milliseconds) and `uuid` of the hit
+    """
+    index_id, uuid = sort
+    return f'{index_id}_{uuid}'
+
+
+def decode_search_paging_state(paging_state: str) -> List:
+    index_id, _, uuid = paging_state.partition('_')
+    try:
+        return [int(index_id), str(UUID(uuid))]
+    except ValueError:
+        raise HTTPException(status_code=422, detail='Invalid paging state')
+
+
 @search_messages_router.get('/content', response_model=MessagesSearchResultSchema)
-async def search_messages_by_content(c: str, user_uuid: UUID = Security(get_jwt_user, scopes=MESSAGE_SCOPES)):
+async def search_messages_by_content(
+    c: str,
+    s: Optional[int] = Query(None, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    ps: Optional[str] = None,
+    g: bool = False,
+    user_uuid: UUID = Security(get_jwt_user, scopes=MESSAGE_SCOPES),
+):
     """
-    Search messages by content, only within rooms the user is a member of.
+    Search messages by content, only within rooms the user is a member of. The newest messages are returned first,
+    grouped by room.
+
+    Results are either paged, or grouped (`g`): then the newest messages of every room with matches are returned at
+    once, with the number of matches per room, and the rooms with the newest matches come first. Grouped results are
+    not paged.
     :param c: The content to search for
+    :param s: (size) How many messages to get, per room when grouped
+    :param ps: (paging_state) The paging state of the previous page, to get the next page
+    :param g: (grouped) Whether to get the newest messages of every room
     :param user_uuid: The user's uuid, derived from the JWT token
     :return: `MessagesSearchResultSchema`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    allowed_rooms = [str(UUID(room.uuid)) for room in user.rooms.all()]
-    
-    body = {
-        'query': {
+    if g and ps:
+        raise HTTPException(status_code=422, detail='Grouped results are not paged')
+    search_after = decode_search_paging_state(ps) if ps else None
+    allowed_rooms = [str(UUID(room_id)) for room_id in await room_repository.get_user_room_ids(user_uuid)]
+    if not allowed_rooms:
+        return MessagesSearchResultSchema(results={}, total=0)
+
+    async def search() -> bytes:
+        query = {
             'bool': {
-                'must': [
-                    {
-                        'query_string': {
-                            'query': f'*{c}*',
-                            'fields': ['content']
-                        }
-                    },
-                    {'terms': {'room_id': allowed_rooms}}
-                ]
+                'must': [message_content_query(c)],
+                'filter': [{'terms': {'room_id': allowed_rooms}}]
             }
         }
-    }
-    search_results = await elasticsearch_client.search(
-        index=message_index,
-        body=body
-    )
-    result_count = search_results['hits']['total']
-
-    if result_count == 0:
-        return MessagesSearchResultSchema(
-            results={},
-            total=0
+        if g:
+            body = search_rooms_body(query, len(allowed_rooms), s or SEARCH_GROUP_SIZE)
+        else:
+            body = {
+                'query': query,
+                'size': s or SEARCH_PAGE_SIZE,
+                'sort': MESSAGE_SEARCH_SORT,
+                '_source': MESSAGE_SEARCH_SOURCE,
+            }
+            if search_after:
+                body['search_after'] = search_after
+        search_results = await elasticsearch_client.search(
+            index=message_index,
+            body=body
         )
-    
-    def create_message_schema(hit: dict) -> MessageSchema:
-        hit['message_date'] = datetime.strptime(hit['date'], '%Y-%m-%dT%H:%M:%S.%fZ').date()
-        hit['message_stamp'] = hit['stamp']
-        hit['index_id'] = datetime.strptime(hit['index_id'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        msg = Message(**hit)
-        return MessageSchema.from_orm(msg)
-
-    results = {
-        room_id: [create_message_schema(msg) for msg in messages] 
-        for room_id, messages in groupby([hit['_source'] for hit in search_results['hits']['hits']], key=lambda msg: msg['room_id'])
-    }
-    return MessagesSearchResultSchema(results=results, total=result_count)
+
+        # The hits are projected straight to the JSON of a `MessagesSearchResultSchema`
+        results, counts, paging_state = {}, {}, None
+        if g:
+            for bucket in search_results['aggregations']['rooms']['buckets']:
+                room_id = str(UUID(bucket['key']))
+                counts[room_id] = bucket['doc_count']
+                results[room_id] = [search_message_encoder.to_dict(hit['_source'])
+                                    for hit in bucket['messages']['hits']['hits']]
+        else:
+            hits = search_results['hits']['hits']
+            for hit in hits:
+                results.setdefault(str(UUID(hit['_source']['room_id'])), []).append(
+                    search_message_encoder.to_dict(hit['_source']))
+            # a full page might be followed by another one
+            if hits and len(hits) == body['size']:
+                paging_state = encode_search_paging_state(hits[-1]['sort'])
+        return orjson.dumps({
+            'results': results,
+            'counts': counts,
+            'total': search_results['hits']['total'],
+            'pagingState': paging_state,
+        })
+
+    # Repeated searches are served from the cache while none of the rooms got new messages. Returning a Response skips
+    # the validation of the response model (which is still used for the documentation)
+    return Response(
+        content=await search_result_cache.get(c, allowed_rooms, (g, s, ps), search),
+        media_type='application/json',
+    )
 
 
 @search_rooms_router.get('/name', response_model=RoomsSearchResultSchema)
@@ -84,7 +171,6 @@ async def search_rooms_by_name(n: str, user_uuid: User = Security(get_jwt_user,
     :param user_uuid: The user's uuid, derived from the JWT token
     :return: `RoomsSearchResultSchema`
     """
-    user = User.nodes.get(uuid=user_uuid)
-    rooms = user.rooms.filter(room_name__icontains=n)
+    rooms = await room_repository.get_user_rooms(user_uuid, name_contains=n)
     results = [RoomSchema.from_orm(room) for room in rooms]
     return RoomsSearchResultSchema(results=results, total=len(results))
@@ -1,14 +1,14 @@
-from datetime import datetime
 import logging
 from uuid import UUID
 
-from fastapi import APIRouter, HTTPException, Security
+from fastapi import APIRouter, Depends, HTTPException, Security
 
-from app.models import User, UserStatus
+from app.repositories import user_repository
 from app.schemas.jwt import JWTToken, LoginSchema
 from app.schemas.user import UserSchema
+from app.util.presence import apply_presence
 from app.util.authentication import ADMIN_SCOPES, authenticate_user, create_jwt_token, USER_SCOPES, get_jwt_user, \
-    get_password_hash
+    hash_password, oath2_scheme, verified_token_cache
 
 users_router = APIRouter(
     prefix='/users',
@@ -16,7 +16,8 @@ users_router = APIRouter(
     responses={
         401: {'description': 'Incorrect username or password'},
         403: {'description': 'User is not authorized to access this resource'},
-        409: {'description': 'User already exists'}
+        409: {'description': 'User already exists'},
+        503: {'description': 'Too many logins at the moment'},
     }
 )
 
@@ -42,15 +43,14 @@ async def create_user(login_data: LoginSchema):
     username = login_data.username
 
     # Check if user already exists
-    if User.get_user_by_username(username=username):
+    if await user_repository.get_by_username(username):
         raise HTTPException(status_code=409, detail='User already exists')
 
     # Create user
-    user = User(username=username, hashed_password=get_password_hash(login_data.password))
-    user.save()
+    user = await user_repository.create(username, await hash_password(login_data.password))
 
     logging.info('User %s: created', user.uuid)
-    return UserSchema.from_orm(user)
+    return await user_repository.to_schema(user)
 
 
 @users_router.post('/login', response_model=JWTToken)
@@ -60,20 +60,15 @@ async def login_user(login_data: LoginSchema):
     :param login_data: A combination of username and password
     :return: A JWT token for the user (consisting of the actual token, a type, user_uuid and whether it is an admin JWT)
     """
-    user = authenticate_user(login_data.username, login_data.password)
+    user = await authenticate_user(login_data.username, login_data.password)
 
     if not user:
         raise HTTPException(status_code=401, detail='Incorrect username or password')
     elif user.is_admin:
         raise HTTPException(status_code=401, detail='Admins cannot login to chat')
 
-    # create token
-    token = create_jwt_token(data={'sub': user.uuid, 'scopes': USER_SCOPES})
-
-    # Set user status to online
-    online_status = UserStatus.get_online_status()
-    user.status_rel.replace(online_status)
-    user.status_rel.last_changed = datetime.utcnow()
+    # create token, the user comes online once it connects to the websocket (see the presence service)
+    token = create_jwt_token(data={'sub': user.uuid, 'username': user.username, 'scopes': USER_SCOPES})
 
     logging.info('User %s: logged in', user.uuid)
     return JWTToken(token=token, token_type='bearer', user_uuid=user.uuid)
@@ -86,7 +81,7 @@ async def login_admin(login_data: LoginSchema):
     :param login_data: A combination of username and password
     :return: A JWT token for the admin user, JWT will have `is_admin` set to `True`.
     """
-    user = authenticate_user(login_data.username, login_data.password)
+    user = await authenticate_user(login_data.username, login_data.password)
 
     if not user:
         raise HTTPException(status_code=401, detail='Incorrect username or password')
@@ -100,18 +95,19 @@ async def login_admin(login_data: LoginSchema):
 
 
 @users_router.post('/logout', status_code=204)
-async def logout_user(user_uuid: UUID = Security(get_jwt_user, scopes=USER_SCOPES)):
+async def logout_user(
+    user_uuid: UUID = Security(get_jwt_user, scopes=USER_SCOPES),
+    token: str = Depends(oath2_scheme),
+):
     """
     Logout a user. User to logout is determined by the JWT token.
     :param user_uuid: The UUID of the user to logout, derived from the JWT token.
+    :param token: The JWT token, it is dropped from the verified token cache
     :return: 204 status code
     """
-    user = User.get_user_by_id(uuid=user_uuid)
-    offline_status = UserStatus.get_offline_status()
-    user.status_rel.replace(offline_status)
-    user.status_rel.last_changed = datetime.utcnow()
-
-    logging.info('User %s: logged out', user.uuid)
+    verified_token_cache.invalidate(token)
+    # the user goes offline once its websocket connections are closed (see the presence service)
+    logging.info('User %s: logged out', user_uuid)
     return None
 
 
@@ -122,7 +118,9 @@ async def get_user(user_id: UUID):
     :param user_id: The UUID of the user to get
     :return: `UserSchema`
     """
-    user = User.get_user_by_id(uuid=user_id)
+    user = await user_repository.get_by_id(user_id)
     if not user:
         raise HTTPException(status_code=404, detail='User not found')
-    return UserSchema.from_orm(user)
+    user_schema = await user_repository.to_schema(user)
+    await apply_presence([user_schema])
+    return user_schema
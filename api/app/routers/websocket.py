@@ -1,26 +1,61 @@
 import asyncio
 from datetime import datetime
 import logging
-from typing import Optional, Any
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
 from uuid import UUID, uuid4
 
+from cassandra import DriverException, RequestExecutionException
+from cassandra.cluster import NoHostAvailable
 from cassandra.cqlengine import CQLEngineException
 from distributed_websocket import Connection
 from distributed_websocket._message import Message as WSMessage
 from distributed_websocket._connection import Connection
 from fastapi import HTTPException
 from redis.exceptions import ConnectionError
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1013_TRY_AGAIN_LATER
 from starlette.websockets import WebSocket
 
-from app.models import Room
-from app.util import check_redis_connection, setup_websocket_manager
+from app.util import BrokerHealthMonitor
+from app.util.admission import WEBSOCKET_ADMISSIONS, websocket_admission
+from app.util.authentication import verify_websocket_token
+from app.util.ingestion import MESSAGE_INGESTION_ENABLED, IngestionError, MessageIngestionQueue
+from app.util.presence import PresenceService, presence_store
+from app.util.read_cursors import ReadCursorCoalescer
+from app.util.search_cache import search_result_cache
+from app.util.statistics import AdminStatistics
+from app.util.serialization import WEBSOCKET_INDEX_FORMAT, websocket_message_encoder
+from app.util.membership import get_rooms_member_ids, get_users_room_ids, invalidate_room_members, \
+    invalidate_user_rooms, is_room_member
+from app.util.websocket import WEBSOCKET_ACTION_TIME, WEBSOCKET_CONNECTIONS, EchoChatWebSocketManager, room_topic, \
+    websocket_manager
 from app.routers.dependencies import ensure_cassandra_connection
-from app.schemas.message import MessageSchema
-from app.models import Message as CassandraMessage, User
-
-WS_MANAGER_CONNECTED = True
-
-websocket_manager = setup_websocket_manager()
+from app.schemas.jwt import TokenData
+from app.repositories import message_repository, read_cursor_repository, room_repository, user_repository
+
+# Errors raised by the Cassandra driver and ORM
+CASSANDRA_ERRORS = (CQLEngineException, DriverException, RequestExecutionException, NoHostAvailable)
+
+websocket_manager.room_resolver = get_users_room_ids
+broker_health_monitor = BrokerHealthMonitor(websocket_manager)
+WEBSOCKET_CONNECTIONS.set_function(lambda: len(websocket_manager.active_connections))
+message_ingestion_queue = MessageIngestionQueue(message_repository.create_many)
+admin_statistics = AdminStatistics(
+    user_repository.count,
+    presence_store.online_count,
+    lambda: len(websocket_manager.active_connections),
+)
+websocket_manager.register_control_handler(
+    EchoChatWebSocketManager.ROOM_MEMBERSHIP,
+    lambda data: invalidate_room_members(data['roomId']),
+)
+websocket_manager.register_control_handler(
+    EchoChatWebSocketManager.ROOM_MEMBERSHIP,
+    lambda data: invalidate_user_rooms(data['userId']),
+)
+
+# Actions clients send over the websocket, other topics are measured as `unknown`
+WEBSOCKET_ACTIONS = ('new_message', 'read_cursor', 'message_seen')
 
 error_data = {
     'type': 'send',
@@ -50,7 +85,7 @@ def send_error_message(topic: str | UUID, message: str):
     websocket_manager.send(message)
 
 
-async def add_new_message(connection: Connection, msg: dict, user: User):
+async def add_new_message(connection: Connection, msg: dict, user: TokenData):
     """
     Adds a new message to the database and sends it to the other users in the room over the websocket
     (if they are connected)
@@ -61,11 +96,18 @@ async def add_new_message(connection: Connection, msg: dict, user: User):
     """
     try:
         msg_data = msg['data']
+        room_id = UUID(msg_data['roomId'])
+
+        # Only members of a room can send messages to it (membership is served from the in-process cache)
+        if not await is_room_member(room_id, user.user_uuid):
+            logging.warning('Websocket %s: user is not a member of room %s', user.user_uuid, room_id)
+            send_error_message(user.user_uuid, 'You are not a member of this room')
+            return
 
         await ensure_cassandra_connection()
 
-        # Convert the message to a Cassandra ORM object, and meanwhile save it
-        message_orm = CassandraMessage.create(
+        # Convert the message to a Cassandra ORM object
+        message_orm = message_repository.build(
             uuid=uuid4(),
             sender_id=msg_data['userId'],
             room_id=msg_data['roomId'],
@@ -79,135 +121,169 @@ async def add_new_message(connection: Connection, msg: dict, user: User):
             index_id=datetime.utcnow(),
             saved=True
         )
+        # Save it (without blocking the event loop), either batched with other messages of the room by the ingestion
+        # queue or on its own. Either way, it is only sent to the room once the write is acknowledged.
+        if MESSAGE_INGESTION_ENABLED:
+            await message_ingestion_queue.submit(message_orm)
+        else:
+            await message_repository.insert(message_orm)
+        written = time.perf_counter()
+
+        # Convert ORM model to the (JSON compatible) dictionary of its schema
+        message_schema = websocket_message_encoder.to_dict(message_orm)
+        # The time until the message is first sent is measured when the sender (or another member) is on this node
+        websocket_manager.track_delivery(message_schema['_id'], written)
+
+        # Send the message to the room, every node delivers it to its connections subscribed to the room
+        data = {
+            'type': 'send', 'topic': room_topic(room_id),
+            'data': {
+                'action': 'new_message',
+                'roomId': str(room_id),
+                'message': message_schema
+            }
+        }
+        logging.info('Message %s: publishing new_message message to room %s', message_orm.uuid, room_id)
+        # The cached search results of the room are invalidated alongside
+        await asyncio.gather(websocket_manager.publish(data), search_result_cache.room_written(room_id))
+        admin_statistics.record_message()
 
-        # Convert ORM model to a dictionary
-        message_schema = MessageSchema.from_orm(message_orm).dict(by_alias=True)
-        # Convert non-string types to string
-        message_schema['_id'] = str(message_schema['_id'])
-        message_schema['indexId'] = message_schema['indexId'].strftime('%Y-%m-%d %H:%M:%S.%f')
-        message_schema['senderId'] = str(message_schema['senderId'])
-        message_schema['date'] = message_schema['date'].strftime('%d-%m-%Y')
-        message_schema['time_stamp'] = message_schema['time_stamp'].strftime('%H:%M:%S')
+    except CASSANDRA_ERRORS + (ValueError, HTTPException, ConnectionError) as e:  # (hopefully) catch database (connection) errors
+        user_uuid = user.user_uuid
+        logging.error('Websocket %s: error while saving message to database: %s', user_uuid, e)
+        send_error_message(user_uuid, 'An error occurred while handling the new message')
+    except IngestionError as e:
+        user_uuid = user.user_uuid
+        logging.error('Websocket %s: message was not ingested: %s', user_uuid, e)
+        send_error_message(user_uuid, 'The server is too busy to handle the new message, please try again')
 
-        # Send the message to the other users in the room
-        room_id = UUID(msg_data['roomId'])
-        room = Room.nodes.get(uuid=room_id.hex)
 
-        for destination_user in room.users:
-            data = {
-                'type': 'send', 'topic': str(destination_user.uuid), 
-                'data': {
-                    'action': 'new_message', 
-                    'roomId': str(room_id),
-                    'message': message_schema
-                }
+async def publish_read_cursors(room_id: UUID, cursors: Dict[UUID, datetime]):
+    """
+    Sends the read cursors that moved forward in a room to the room, as a single `read_cursor` update
+    :param room_id: the room of the cursors
+    :param cursors: the new read cursors, by user id
+    """
+    data = {
+        'type': 'send', 'topic': room_topic(room_id),
+        'data': {
+            'action': 'read_cursor',
+            'roomId': str(room_id),
+            'cursors': {
+                str(user_id): index_id.strftime(WEBSOCKET_INDEX_FORMAT) for user_id, index_id in cursors.items()
             }
-            logging.info('Message %s: sending new_message message to user %s', message_orm.uuid, destination_user.uuid)
-            # Send the message to the user, if they are not connected this function will do nothing
-            await websocket_manager.receive(connection, data)
+        }
+    }
+    logging.info('Room %s: publishing read_cursor for %d users', room_id, len(cursors))
+    await websocket_manager.publish(data)
 
-    except (CQLEngineException, ValueError, HTTPException, ConnectionError) as e:  # (hopefully) catch database (connection) errors
-        user_uuid = UUID(user.uuid)
-        logging.error('Websocket %s: error while saving message to database: %s', user_uuid, e)
-        send_error_message(user_uuid, 'An error occurred while handling the new message')
+
+read_cursor_coalescer = ReadCursorCoalescer(read_cursor_repository.advance, publish_read_cursors)
 
 
-async def update_message_seen(connection: Connection, msg: dict, user: User):
+async def update_read_cursor(connection: Connection, msg: dict, user: TokenData):
     """
-    Updates the message seen property in the database and sends it to the other users in the room over the websocket
+    Moves the read cursor of the user in a room forward, up to the message the user has seen. The cursors are
+    coalesced for a short window, then written and sent to the other users in the room over the websocket
     :param connection: the connection that sent the message
-    :param msg: the message to update
+    :param msg: the read cursor (or, from older clients, the message seen event)
     :param user: the user that sent the message
     :return: None
     """
     try:
-        await ensure_cassandra_connection()
-
         msg_data = msg['data']
         room_id = UUID(msg_data['roomId'])
-        index_id = datetime.strptime(msg_data['messageIndex'], '%Y-%m-%d %H:%M:%S.%f')
-        message_id = msg_data['messageId']
-
-        # Obtain the message from the database
-        message_orm = CassandraMessage.filter(room_id=room_id).filter(index_id=index_id).get(uuid=message_id)
-        # Update the seen (and distributed) property
-        message_orm.distributed = True  # if its seen, that surely it has been received as well
-        message_orm.seen = True
-        message_orm.save()
-        logging.info('Message %s: updated message seen', message_id)
-
-        # Send the message to the other users in the room
-        room = Room.nodes.get(uuid=room_id.hex)
-        for destination_user in room.users:
-            data = {
-                'type': 'send', 'topic': str(destination_user.uuid), 
-                'data': {
-                    'action': 'message_update',
-                    'roomId': str(room_id),
-                    'messageId': str(message_orm.uuid),
-                    'props': {
-                        'distributed': True,
-                        'seen': True
-                    }
-                }
-            }
-            logging.info('Message %s: sending update_message_seen to %s', message_id, destination_user.uuid)
-            await websocket_manager.receive(connection, data)
-        
-    except (CQLEngineException, ValueError, ConnectionError) as e:  # (hopefully) catch database (connection) errors
-        logging.error('Websocket %s: error while updating message seen: %s', user.uuid, e)
-        send_error_message(str(user.uuid), 'An error occurred while handling the message seen event')
+        # older clients send a `message_seen` event for every message, with its index as `messageIndex`
+        index_id = datetime.strptime(msg_data.get('indexId') or msg_data['messageIndex'], WEBSOCKET_INDEX_FORMAT)
+
+        if not await is_room_member(room_id, user.user_uuid):
+            logging.warning('Websocket %s: user is not a member of room %s', user.user_uuid, room_id)
+            send_error_message(str(user.user_uuid), 'You are not a member of this room')
+            return
+
+        # A cursor never moves back, so one in the future would hide all new messages from the seen state
+        read_cursor_coalescer.advance(room_id, user.user_uuid, min(index_id, datetime.utcnow()))
+
+    except (KeyError, ValueError) as e:
+        logging.error('Websocket %s: error while updating read cursor: %s', user.user_uuid, e)
+        send_error_message(str(user.user_uuid), 'An error occurred while handling the message seen event')
 
 
-async def send_user_status_change(connection: Connection, user: User, status: str):
+async def get_presence_recipients(user_ids: Iterable[str]) -> Dict[str, Set[str]]:
     """
-    Sends a user status change message to all the users connected to any room the user is in
+    Get the users that should be told about status changes of users: the other members of all rooms they are in
+    :param user_ids: the users of which the status changed
+    :return: the uuids of the recipients per user uuid, in canonical form
     """
-    user_uuid = UUID(user.uuid)
-    try:
-        data = {
-            'type': 'send',
-            'data': {
-                'action': 'user_update',
-                'userId': str(user_uuid),
-                'props': {
-                    'status': status
-                }
-            }
+    users_room_ids = await get_users_room_ids(user_ids)
+    rooms_member_ids = await get_rooms_member_ids(set().union(*users_room_ids.values()))
+    return {
+        user_id: set().union(*(rooms_member_ids[room_id] for room_id in room_ids)) - {user_id}
+        for user_id, room_ids in users_room_ids.items()
+    }
+
+
+async def publish_user_updates(recipients: List[str], updates: List[dict]):
+    """
+    Sends status changes of users to the recipients, every node delivers the same encoded frame to the connections
+    of these users
+    :param recipients: the uuids of the users to send the changes to
+    :param updates: the changes, as `userId` and the changed `props` of every user
+    """
+    logging.info('Presence: sending user_update with %d changes to %d users', len(updates), len(recipients))
+    await websocket_manager.publish({
+        'type': 'send_by_conn_id',
+        'conn_id': recipients,
+        'data': {
+            'action': 'user_update',
+            'users': updates
         }
+    })
+
+
+presence_service = PresenceService(
+    presence_store,
+    get_presence_recipients,
+    publish_user_updates,
+    save_snapshot=user_repository.save_status_snapshot,
+)
 
-        # Send the message to all the users in the rooms the user is in
-        # Use a set to avoid sending the message to the same user twice
-        destination_user_uuids = set([usr.uuid for room in user.rooms for usr in room.users])
-        
-        for destination_user_uuid in destination_user_uuids:
-            logging.info(
-                'User %s: sending user_status_change with status %s message to %s',
-                user_uuid,
-                status, 
-                destination_user_uuid
-            )
-            await websocket_manager.receive(connection, {**data, 'topic': str(destination_user_uuid)})
-
-    except (ValueError, ConnectionError) as e:
-        logging.error('Websocket %s: error while sending user status change: %s', user_uuid, e)
-        send_error_message(user_uuid, 'An error occurred while handling the user status change event')
-
-
-async def handle_message(connection: Connection, msg, user: User):
+
+async def setup_connection(connection: Connection, user: TokenData):
+    """
+    Per-connection setup that is done after the connection is accepted
+    :param connection: the new connection
+    :param user: the user of the connection, its username is loaded when its token does not contain it
+    """
+    try:
+        # Subscribe the connection to the topics of the rooms the user is in, so room messages reach it
+        await websocket_manager.resync_room_subscriptions([connection])
+        if user.username is None:
+            stored_user = await user_repository.get_by_id(user.user_uuid)
+            if stored_user is not None:
+                user.username = stored_user.username
+    except Exception as e:
+        logging.error('Websocket %s: error while setting up connection: %s', connection.id, e)
+
+
+async def handle_message(connection: Connection, msg, user: TokenData):
     """
     Async wrapper around the message handlers
     :param msg: the message to handle
     :param user: the user that sent the message
     :return: None
     """
-    if msg['type'] == 'send':
-        if msg['topic'] == 'new_message':
+    if msg['type'] != 'send':
+        return
+    action = msg['topic'] if msg['topic'] in WEBSOCKET_ACTIONS else 'unknown'
+    started = time.perf_counter()
+    try:
+        if action == 'new_message':
             await add_new_message(connection, msg, user)
-        elif msg['topic'] == 'message_seen':
-            await update_message_seen(connection, msg, user)
-    elif msg['type'] == 'user_status_change':
-        await send_user_status_change(connection, user, msg['data']['new_status'])
+        elif action in ('read_cursor', 'message_seen'):
+            await update_read_cursor(connection, msg, user)
+    finally:
+        WEBSOCKET_ACTION_TIME.labels(action=action).observe(time.perf_counter() - started)
 
 
 async def websocket_endpoint(
@@ -230,30 +306,37 @@ async def websocket_endpoint(
     :return:
     """
 
-    global websocket_manager, WS_MANAGER_CONNECTED
-
-    # TODO: add JWT to websocket connection and check if user is authenticated
-
-    # Obtain the user from the database, for validation and caching purposes
-    user = User.get_user_by_id(uuid=UUID(conn_id).hex)
+    # The user is authenticated from the signature of its token alone, the handshake does not hit a database
+    user = verify_websocket_token(ws.query_params.get('token'), conn_id)
     if user is None:
-        logging.warning('Websocket %s: could not find user for websocket connection', conn_id)
-        await ws.close()
+        logging.warning('Websocket %s: unauthorized websocket connection', conn_id)
+        WEBSOCKET_ADMISSIONS.labels(result='unauthorized').inc()
+        await ws.close(code=WS_1008_POLICY_VIOLATION)
         return
 
-    connection: Connection = await websocket_manager.new_connection(ws, conn_id, topic=conn_id)
+    # Connections are admitted at a bounded rate, so a herd of reconnecting clients is spread out over time
+    if not websocket_admission.try_acquire():
+        retry_after = websocket_admission.retry_after()
+        logging.info('Websocket %s: connection rejected, retry after %.1fs', conn_id, retry_after)
+        WEBSOCKET_ADMISSIONS.labels(result='rejected').inc()
+        # accepted first, the close code and reason of a connection that is refused during the handshake are lost
+        await ws.accept()
+        await ws.close(code=WS_1013_TRY_AGAIN_LATER, reason=str(round(retry_after * 1000)))
+        return
+    WEBSOCKET_ADMISSIONS.labels(result='admitted').inc()
+
+    connection: Connection = await websocket_manager.new_connection(ws, conn_id)
     logging.info('Websocket %s: accepted new connection', connection.id)
-    # Send user online to other users that have a connection with the user
-    await asyncio.create_task(
-        handle_message(connection, {'type': 'user_status_change', 'data': {'new_status': 'online'}}, user)
-    )
-    
+    # The other users in the rooms of the user are told that the user is online by the presence service
+    presence_service.connected(connection.id)
+    # Subscribing to the rooms of the user takes a graph query, so it is done while frames are already read
+    setup = asyncio.create_task(setup_connection(connection, user))
+
     async for msg in connection.iter_json():
         logging.info('Websocket %s: Got new message', connection.id)
 
-        redis_connected = await check_redis_connection()
-        if not redis_connected:
-            WS_MANAGER_CONNECTED = False
+        # The broker is checked (and reconnected) by the background health monitor, we only read its state here
+        if not broker_health_monitor.healthy:
             logging.error('Websocket %s: Redis connection lost', connection.id)
             await ws.send_json({
                 **error_data,
@@ -263,26 +346,14 @@ async def websocket_endpoint(
                 }
             })
             continue
-        elif not WS_MANAGER_CONNECTED and redis_connected:
-            # Redis connection restored, reconnect the websocket manager
-            try:
-                await websocket_manager.shutdown()
-            except:
-                pass
-            logging.warning('Redis: trying to reconnect to Redis')
-            websocket_manager = setup_websocket_manager()
-            await websocket_manager.startup()
-            WS_MANAGER_CONNECTED = True
-            logging.warning('Redis: reconnected to Redis')
 
         await asyncio.create_task(handle_message(connection, msg, user))
 
+    setup.cancel()
     try:
         logging.info('Websocket %s: closing websocket connection', connection.id)
-        # Send user offline to other users that have a connection with the user
-        await asyncio.create_task(
-            handle_message({'type': 'user_status_change', 'data': {'new_status': 'offline'}}, user)
-        )
+        # The presence service tells the other users that the user is offline, unless the user reconnects in time
+        presence_service.disconnected(connection.id)
         await websocket_manager.remove_connection(connection)
     except:
         pass
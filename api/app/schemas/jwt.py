@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 from app.schemas import BaseSchema
@@ -19,3 +19,5 @@ class JWTToken(BaseSchema):
 class TokenData(BaseSchema):
     user_uuid: UUID or None = None
     scopes: List[str] = []
+    # not in the tokens issued before it was added
+    username: Optional[str] = None
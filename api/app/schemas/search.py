@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 from uuid import UUID
 
 from app.schemas import BaseSchema
@@ -12,6 +12,9 @@ class SearchResultSchema(BaseSchema):
 
 class MessagesSearchResultSchema(SearchResultSchema):
     results: Dict[UUID, List[MessageSchema]]
+    # number of matches per room, of grouped searches
+    counts: Dict[UUID, int] = {}
+    paging_state: Optional[str] = None
 
 
 class RoomsSearchResultSchema(SearchResultSchema):
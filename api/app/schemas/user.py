@@ -14,7 +14,7 @@ if TYPE_CHECKING:
 
 class UserStateSchema(BaseSchema):
     state: UserStates
-    last_changed: datetime
+    last_changed: datetime | None
 
 
 class UserSchema(BaseSchema):
@@ -1,3 +1,3 @@
 from .cassandra import setup_cassandra
 from .neo4j import setup_neo4j
-from .websocket import check_redis_connection, setup_websocket_manager
+from .websocket import BrokerHealthMonitor, check_redis_connection, setup_websocket_manager
@@ -0,0 +1,73 @@
+import os
+import random
+import time
+
+from prometheus_client import Counter
+
+# New websocket connections admitted per second by this node, and the burst of connections admitted at once
+WEBSOCKET_ADMISSION_RATE = float(os.environ.get('WEBSOCKET_ADMISSION_RATE', 200))
+WEBSOCKET_ADMISSION_BURST = int(os.environ.get('WEBSOCKET_ADMISSION_BURST', 400))
+WEBSOCKET_ADMISSION_MAX_RETRY_AFTER = float(os.environ.get('WEBSOCKET_ADMISSION_MAX_RETRY_AFTER', 60))
+WEBSOCKET_ADMISSION_JITTER = float(os.environ.get('WEBSOCKET_ADMISSION_JITTER', 0.2))
+
+WEBSOCKET_ADMISSIONS = Counter(
+    'echochat_websocket_admissions_total',
+    'Total count of websocket handshakes by result (admitted, rejected by the limiter, or unauthorized)',
+    ['result'],
+)
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket that admits at most `rate` operations per second, with bursts of up to `burst` operations.
+
+    Rejected callers get a retry hint. The hints reserve consecutive slots of the bucket, so a herd of rejected
+    clients (e.g. all clients of a node that was restarted) is spread out over time at the rate of the bucket instead
+    of coming back at once. Every hint is jittered by `jitter` (a fraction of it), and capped at `max_retry_after`.
+    """
+
+    def __init__(
+        self,
+        rate: float = WEBSOCKET_ADMISSION_RATE,
+        burst: int = WEBSOCKET_ADMISSION_BURST,
+        max_retry_after: float = WEBSOCKET_ADMISSION_MAX_RETRY_AFTER,
+        jitter: float = WEBSOCKET_ADMISSION_JITTER,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_retry_after = max_retry_after
+        self.jitter = jitter
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # the time up to which retry hints have been handed out
+        self._next_retry = self._updated
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token from the bucket.
+        :return: True if the operation is admitted, False if the bucket is empty
+        """
+        self._refill(time.monotonic())
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        """
+        Hand out a retry hint to a rejected caller.
+        :return: The number of seconds after which the caller should try again
+        """
+        now = time.monotonic()
+        self._refill(now)
+        first_token = now + (1 - self._tokens) / self.rate
+        self._next_retry = min(max(self._next_retry + 1 / self.rate, first_token), now + self.max_retry_after)
+        delay = self._next_retry - now
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+websocket_admission = TokenBucketLimiter()
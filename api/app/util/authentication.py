@@ -1,20 +1,45 @@
+import hashlib
 import logging
 import os
+import time
 from datetime import timedelta, datetime
+from uuid import UUID
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from prometheus_client import Counter, Histogram
 from pydantic import ValidationError
 
 from app.models import User
+from app.repositories.user import user_repository
 from app.schemas.jwt import TokenData
+from app.util.cache import TTLCache
+from app.util.passwords import PasswordHasherBusy, password_hasher
 
 JWT_KEY = os.environ['JWT_KEY']
 ALGORITHM = 'HS256'
 JWT_TOKEN_EXPIRE_MINUTES = os.environ.get('JWT_TOKEN_EXPIRE_MINUTES', 60)
 
+# Verified tokens are cached until they expire, but never longer than the TTL, after which the user is checked again
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 10000))
+VERIFIED_TOKEN_CACHE_TTL = float(os.environ.get('VERIFIED_TOKEN_CACHE_TTL', 300))
+
+TOKEN_CACHE_LOOKUPS = Counter(
+    'echochat_verified_token_cache_lookups_total',
+    'Total count of verified token cache lookups by result (hit, or miss when the token had to be verified)',
+    ['result'],
+)
+TOKEN_VERIFICATION_TIME = Histogram(
+    'echochat_token_verification_duration_seconds',
+    'Histogram of the time it takes to verify a token by cache result (in seconds)',
+    ['result'],
+)
+TOKEN_CACHE_SAVED_TIME = Counter(
+    'echochat_verified_token_cache_saved_seconds_total',
+    'Estimated time saved by verified token cache hits (the difference with the average time of a full verification)',
+)
+
 ROOM_SCOPES = [
     # Permissions for rooms
     'get_rooms',
@@ -35,8 +60,6 @@ ADMIN_SCOPES = USER_SCOPES + [
     'admin'
 ]
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
 oath2_scheme = OAuth2PasswordBearer(
     tokenUrl='/users/login',
     scopes={
@@ -54,32 +77,99 @@ oath2_scheme = OAuth2PasswordBearer(
 )
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+class VerifiedTokenCache:
     """
-    Verify a plain password against a stored hash.
-    :param plain_password: The plain password to verify
-    :param hashed_password: The stored hash
-    :return: True if the password matches the hash, False otherwise
+    Bounded LRU cache of verified tokens, so repeated requests with the same token skip decoding the JWT and checking
+    that its user exists in Neo4j. Tokens are keyed by their SHA-256 digest, so the tokens themselves are not kept.
     """
-    return pwd_context.verify(plain_password, hashed_password)
+
+    def __init__(self, maxsize: int = VERIFIED_TOKEN_CACHE_SIZE, ttl: float = VERIFIED_TOKEN_CACHE_TTL) -> None:
+        self._cache: TTLCache[bytes, TokenData] = TTLCache(maxsize=maxsize, ttl=ttl)
+        # average duration of a full verification, to estimate the time saved by a hit
+        self._miss_time = 0.0
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> TokenData | None:
+        return self._cache.get(self.digest(token))
+
+    def set(self, token: str, token_data: TokenData, expires_at: float) -> None:
+        """
+        Cache a verified token until it expires (or until the TTL of the cache has passed, if that is sooner).
+        :param token: The verified token
+        :param token_data: The user and scopes of the token
+        :param expires_at: The `exp` claim of the token, as a unix timestamp
+        """
+        ttl = min(self._cache.ttl, expires_at - time.time())
+        if ttl > 0:
+            self._cache.set(self.digest(token), token_data, ttl=ttl)
+
+    def invalidate(self, token: str) -> None:
+        self._cache.invalidate(self.digest(token))
+
+    def invalidate_user(self, user_uuid: UUID | str) -> int:
+        """
+        Drop all cached tokens of a user, e.g. when the user is deleted.
+        :return: The number of dropped tokens
+        """
+        user_uuid = UUID(str(user_uuid))
+        return self._cache.invalidate_where(lambda _, token_data: token_data.user_uuid == user_uuid)
+
+    def observe(self, hit: bool, duration: float) -> None:
+        result = 'hit' if hit else 'miss'
+        TOKEN_CACHE_LOOKUPS.labels(result=result).inc()
+        TOKEN_VERIFICATION_TIME.labels(result=result).observe(duration)
+        if hit:
+            TOKEN_CACHE_SAVED_TIME.inc(max(self._miss_time - duration, 0))
+        else:
+            # exponential moving average, so it follows changes in the latency of Neo4j
+            self._miss_time = duration if not self._miss_time else 0.9 * self._miss_time + 0.1 * duration
+
+
+verified_token_cache = VerifiedTokenCache()
+
+
+def _password_hasher_busy(e: PasswordHasherBusy) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail='Too many logins at the moment, try again later',
+        headers={'Retry-After': str(e.retry_after)},
+    )
 
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    """
+    Hash a password on the password hasher.
+    :param password: The plain password to hash
+    :return: The hash of the password
+    :raises HTTPException: 503 when the password hasher is saturated
+    """
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy as e:
+        raise _password_hasher_busy(e)
 
 
-def authenticate_user(username: str, password: str) -> bool | User:
+async def authenticate_user(username: str, password: str) -> bool | User:
     """
     Authenticate a user by username and password.
     :param username: The username to authenticate
     :param password: The password to authenticate
     :return: The user if the authentication was successful, False otherwise
+    :raises HTTPException: 503 when the password hasher is saturated
     """
-    user = User.get_user_by_username(username=username)
+    user = await user_repository.get_by_username(username)
     if not user:
         logging.error('User %s: user does not exist', username)
         return False
-    if not verify_password(password, user.hashed_password):
+    try:
+        verified = await password_hasher.verify(password, user.hashed_password)
+    except PasswordHasherBusy as e:
+        logging.warning('User %s: password hasher is saturated', username)
+        raise _password_hasher_busy(e)
+    if not verified:
         logging.error('User %s: password does not match', username)
         return False
     logging.info('User %s: successfully authenticated', username)
@@ -118,26 +208,35 @@ async def get_jwt_user(security_scopes: SecurityScopes, token: str = Depends(oat
         headers={'WWW-Authenticate': authenticate_value},
     )
 
-    try:
-        payload = jwt.decode(token, JWT_KEY, algorithms=[ALGORITHM])
-        # check if token is expired
-        expires = datetime.fromtimestamp(payload.get('exp'))
-        if expires is None or expires < datetime.utcnow():
+    start = time.perf_counter()
+    token_data = verified_token_cache.get(token)
+    if token_data is not None:
+        verified_token_cache.observe(hit=True, duration=time.perf_counter() - start)
+    else:
+        try:
+            payload = jwt.decode(token, JWT_KEY, algorithms=[ALGORITHM])
+            # check if token is expired
+            expires = datetime.fromtimestamp(payload.get('exp'))
+            if expires is None or expires < datetime.utcnow():
+                raise credentials_exception
+            # check if token has user id
+            user_uuid: str = payload.get('sub')
+            if user_uuid is None:
+                raise credentials_exception
+            token_scopes = payload.get('scopes', [])
+            token_data = TokenData(scopes=token_scopes, user_uuid=user_uuid, username=payload.get('username'))
+        except (JWTError, ValidationError) as e:
+            logging.error('JWT %s: invalid JWT token used with error %s', token, e)
             raise credentials_exception
-        # check if token has user id
-        user_uuid: str = payload.get('sub')
-        if user_uuid is None:
+
+        # check if user exists
+        user = await user_repository.get_by_id(user_uuid, lazy=True)
+        if user is None:
             raise credentials_exception
-        token_scopes = payload.get('scopes', [])
-        token_data = TokenData(scopes=token_scopes, user_uuid=user_uuid)
-    except (JWTError, ValidationError) as e:
-        logging.error('JWT %s: invalid JWT token used with error %s', token, e)
-        raise credentials_exception
-
-    # check if user exists
-    user = User.get_user_by_id(uuid=user_uuid, lazy=True)
-    if user is None:
-        raise credentials_exception
+        verified_token_cache.set(token, token_data, payload['exp'])
+        verified_token_cache.observe(hit=False, duration=time.perf_counter() - start)
+
+    user_uuid = token_data.user_uuid.hex
     # check if token has valid scopes
     for scope in security_scopes.scopes:
         if scope not in token_data.scopes:
@@ -149,3 +248,37 @@ async def get_jwt_user(security_scopes: SecurityScopes, token: str = Depends(oat
             )
 
     return user_uuid
+
+
+def verify_websocket_token(token: str | None, conn_id: str) -> TokenData | None:
+    """
+    Verify the token of a websocket connection from its signature alone, without looking up the user in Neo4j, so
+    the handshake stays cheap when many clients reconnect at once. A token of a deleted user is accepted until it
+    expires, but such a user is not a member of any room anymore.
+    :param token: The JWT token, passed as query parameter as browsers cannot set headers on websockets
+    :param conn_id: The connection id, which has to be the uuid of the user of the token
+    :return: The user and scopes of the token, or None if the token is invalid or of another user
+    """
+    if not token:
+        return None
+    token_data = verified_token_cache.get(token)
+    if token_data is None:
+        try:
+            payload = jwt.decode(token, JWT_KEY, algorithms=[ALGORITHM])
+            token_data = TokenData(
+                scopes=payload.get('scopes', []),
+                user_uuid=payload.get('sub'),
+                username=payload.get('username'),
+            )
+        except (JWTError, ValidationError) as e:
+            logging.error('Websocket %s: invalid JWT token used with error %s', conn_id, e)
+            return None
+    try:
+        if token_data.user_uuid != UUID(conn_id):
+            logging.error('Websocket %s: JWT token of user %s used', conn_id, token_data.user_uuid)
+            return None
+    except ValueError:
+        return None
+    if 'send_messages' not in token_data.scopes:
+        return None
+    return token_data
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import time
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """
+    In-process cache with a maximum size and a time to live per entry.
+    When the cache is full, the least recently used entry is evicted.
+
+    The cache is not thread safe, it is meant to be used from the event loop only.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._entries: 'OrderedDict[K, Tuple[float, V]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: K) -> Optional[Tuple[float, V]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self._timer():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """
+        Get the value for a key, if it is present and not expired.
+        :param key: The key to look up
+        :param default: The value to return when the key is not cached
+        :return: The cached value, or `default`
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        """
+        Cache a value, evicting the least recently used entries if the cache is full.
+        :param key: The key to cache the value under
+        :param value: The value to cache
+        :param ttl: The time to live of this entry in seconds, defaults to the ttl of the cache
+        """
+        self._entries[key] = (self._timer() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[K, V], bool]) -> int:
+        """
+        Drop all entries for which the predicate holds, this has to check every entry.
+        :param predicate: Called with the key and value of every entry
+        :return: The number of dropped entries
+        """
+        keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -1,24 +1,63 @@
+import asyncio
 import logging
 import os
+import time
+from typing import Any, Dict, Sequence
 
-from cassandra.cluster import Cluster, DCAwareRoundRobinPolicy
+from cassandra.cluster import Cluster, DCAwareRoundRobinPolicy, ResponseFuture, ResultSet, Session
 from cassandra.cqlengine import connection as cassandra_connection
 from cassandra.cqlengine.management import sync_table
+from cassandra.query import BatchStatement, BatchType, PreparedStatement
+from prometheus_client import Counter, Histogram
 
-from app.models import Message
-from app.util.dummy_data import add_dummy_messages
+from app.models import Message, ReadCursor
 from app.util.config import DEBUG, TESTING
+from app.util.instrumentation import cassandra_instrumentation
 
 CASSANDRA_URI = os.environ.get('CASSANDRA_URI', 'localhost:9042')
 CASSANDRA_DEFAULT_KEYSPACE = os.environ['CASSANDRA_DEFAULT_KEYSPACE'] \
     if not TESTING else 'test'
 
-get_messages_pstmt = None
+MESSAGE_TABLE = f'{CASSANDRA_DEFAULT_KEYSPACE}.message'
+# (attribute name, column name) of all columns of the Message table, in a fixed order
+MESSAGE_COLUMNS = [(name, column.db_field_name) for name, column in Message._columns.items()]
+
+MESSAGE_QUERIES = {
+    'get_messages': f'SELECT * FROM {MESSAGE_TABLE} WHERE room_id = ? ORDER BY index_id DESC',
+    'get_message': f'SELECT * FROM {MESSAGE_TABLE} WHERE room_id = ? AND index_id = ? AND uuid = ?',
+    'insert_message': f'INSERT INTO {MESSAGE_TABLE} ({", ".join(column for _, column in MESSAGE_COLUMNS)}) '
+                      f'VALUES ({", ".join("?" for _ in MESSAGE_COLUMNS)})',
+}
+
+READ_CURSOR_TABLE = f'{CASSANDRA_DEFAULT_KEYSPACE}.{ReadCursor.__table_name__}'
+
+READ_CURSOR_QUERIES = {
+    'get_read_cursors': f'SELECT user_id, index_id FROM {READ_CURSOR_TABLE} WHERE room_id = ?',
+    # the write timestamp is the time of the cursor, so the newest cursor always wins
+    'advance_read_cursor': f'UPDATE {READ_CURSOR_TABLE} USING TIMESTAMP ? SET index_id = ? '
+                           f'WHERE room_id = ? AND user_id = ?',
+}
+
+STATEMENT_LOOKUPS = Counter(
+    'echochat_cassandra_statement_lookups_total',
+    'Total count of prepared statement lookups by statement and result (hit when it was prepared at startup)',
+    ['statement', 'result'],
+)
+STATEMENT_EXECUTION_TIME = Histogram(
+    'echochat_cassandra_statement_duration_seconds',
+    'Histogram of the execution time of prepared statements by statement (in seconds)',
+    ['statement'],
+)
+STATEMENT_ERRORS = Counter(
+    'echochat_cassandra_statement_errors_total',
+    'Total count of failed executions of prepared statements by statement and exception type',
+    ['statement', 'exception_type'],
+)
 
 
 def setup_cassandra():
     """
-    Sets up the Cassandra connection, and makes sure the keyspace and Message table exist.
+    Sets up the Cassandra connection, and makes sure the keyspace and the Message and ReadCursor tables exist.
     """
     # connect to Cassandra cluster
     cluster = Cluster(
@@ -51,10 +90,147 @@ def setup_cassandra():
     )
     logging.info('Connecting to Cassandra (%s)...', CASSANDRA_URI)
 
+    # every query of the ORM session (and of the prepared statements) gets a span and is observed in the metrics
+    cassandra_connection.get_session().add_request_init_listener(cassandra_instrumentation)
+
     # apply ORM model to database
     sync_table(Message)
+    sync_table(ReadCursor)
+
+    # prepare all queries once, so requests never have to wait for a prepare round trip
+    message_statements.prepare_all(cassandra_connection.get_session())
+    read_cursor_statements.prepare_all(cassandra_connection.get_session())
 
     # add dummy data (if local development)
     if DEBUG:
+        # imported here, the dummy data needs the authentication module, which needs the repositories using this module
+        from app.util.dummy_data import add_dummy_messages
+
         if Message.objects.count() == 0:
             add_dummy_messages()
+
+
+def to_asyncio_future(response_future: ResponseFuture) -> asyncio.Future:
+    """
+    Bridge a future of the Cassandra driver to an asyncio future.
+    The driver completes its futures on its own event loop thread, so the result is handed over thread safely.
+    :param response_future: The future returned by `Session.execute_async`
+    :return: An asyncio future that resolves to the `ResultSet` of the query
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(rows):
+        if future.done():
+            return
+        try:
+            future.set_result(ResultSet(response_future, rows))
+        except Exception as e:
+            future.set_exception(e)
+
+    def set_exception(exc):
+        if not future.done():
+            future.set_exception(exc)
+
+    response_future.add_callbacks(
+        lambda rows: loop.call_soon_threadsafe(set_result, rows),
+        lambda exc: loop.call_soon_threadsafe(set_exception, exc),
+    )
+    return future
+
+
+async def execute_async(statement: Any, parameters: Sequence | None = None, **kwargs) -> ResultSet:
+    """
+    Execute a statement without blocking the event loop, so many queries can be in flight at once.
+    :param statement: The (prepared) statement to execute
+    :param parameters: The parameters to bind to the statement
+    :param kwargs: Any other keyword argument of `Session.execute_async`, e.g. `paging_state`
+    :return: The `ResultSet` of the query, only the current page is fetched
+    """
+    session = cassandra_connection.get_session()
+    return await to_asyncio_future(session.execute_async(statement, parameters, **kwargs))
+
+
+class PreparedStatementRegistry:
+    """
+    Registry of named statements, prepared once (by `setup_cassandra`) and shared by all requests.
+
+    The shared prepared statements are never changed: every execution binds its own statement, on which per execution
+    options like the page size are set. Lookups (hits, or misses when a statement has to be prepared on demand),
+    execution times and errors are exported per statement as Prometheus metrics.
+    """
+
+    def __init__(self, queries: Dict[str, str]) -> None:
+        self.queries = queries
+        self.statements: Dict[str, PreparedStatement] = {}
+
+    def prepare_all(self, session: Session) -> None:
+        for name, query in self.queries.items():
+            self.statements[name] = session.prepare(query)
+            cassandra_instrumentation.register(name, self.statements[name].query_id)
+        logging.info('Cassandra: prepared %d statements', len(self.statements))
+
+    def get(self, name: str) -> PreparedStatement:
+        """
+        Get a prepared statement, it is prepared on demand if it was not prepared at startup.
+        :param name: The name of the statement
+        :return: The prepared statement
+        """
+        statement = self.statements.get(name)
+        if statement is not None:
+            STATEMENT_LOOKUPS.labels(statement=name, result='hit').inc()
+            return statement
+
+        STATEMENT_LOOKUPS.labels(statement=name, result='miss').inc()
+        logging.warning('Cassandra: statement %s was not prepared at startup, preparing it now', name)
+        # blocks for a single round trip, only until the statement is prepared
+        statement = cassandra_connection.get_session().prepare(self.queries[name])
+        self.statements[name] = statement
+        cassandra_instrumentation.register(name, statement.query_id)
+        return statement
+
+    async def _execute(self, label: str, statement: Any, parameters: Sequence | None = None, **kwargs) -> ResultSet:
+        start = time.perf_counter()
+        try:
+            return await execute_async(statement, parameters, **kwargs)
+        except Exception as e:
+            STATEMENT_ERRORS.labels(statement=label, exception_type=type(e).__name__).inc()
+            raise
+        finally:
+            STATEMENT_EXECUTION_TIME.labels(statement=label).observe(time.perf_counter() - start)
+
+    async def execute(
+        self, name: str, parameters: Sequence | None = None, fetch_size: int | None = None, **kwargs
+    ) -> ResultSet:
+        """
+        Execute a prepared statement without blocking the event loop.
+        :param name: The name of the statement
+        :param parameters: The parameters to bind to the statement
+        :param fetch_size: The page size of this execution, defaults to the page size of the session
+        :param kwargs: Any other keyword argument of `Session.execute_async`, e.g. `paging_state`
+        :return: The `ResultSet` of the query, only the current page is fetched
+        """
+        statement = self.get(name).bind(parameters or [])
+        if fetch_size is not None:
+            statement.fetch_size = fetch_size
+        return await self._execute(name, statement, **kwargs)
+
+    async def execute_batch(
+        self, name: str, parameters: Sequence[Sequence], batch_type: BatchType = BatchType.UNLOGGED
+    ) -> ResultSet:
+        """
+        Execute a prepared statement for multiple sets of parameters, with a single batch.
+        :param name: The name of the statement
+        :param parameters: The parameters to bind to the statement, for every statement in the batch
+        :param batch_type: The type of the batch, unlogged by default
+        :return: The `ResultSet` of the batch
+        """
+        statement = self.get(name)
+        batch = BatchStatement(batch_type=batch_type)
+        for statement_parameters in parameters:
+            batch.add(statement, statement_parameters)
+        return await self._execute(f'{name}_batch', batch)
+
+
+message_statements = PreparedStatementRegistry(MESSAGE_QUERIES)
+read_cursor_statements = PreparedStatementRegistry(READ_CURSOR_QUERIES)
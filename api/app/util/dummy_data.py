@@ -5,7 +5,7 @@ from uuid import uuid4, UUID
 
 from app.models import Room, User, UserStatus, Message
 from app.models.enums import UserStates
-from app.util.authentication import get_password_hash
+from app.util.passwords import get_password_hash
 
 
 def add_dummy_rooms():
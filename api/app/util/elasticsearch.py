@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 from typing import Any, Mapping, Optional, Union, Collection, Tuple
 
 from elasticsearch import AsyncElasticsearch 
@@ -8,12 +9,68 @@ from elastic_transport._models import DEFAULT, DefaultType
 from elastic_transport._transport import TransportApiResponse
 
 from app.util.config import TESTING
+from app.util.instrumentation import QuerySpan, elasticsearch_statement_name
 
-message_index = os.environ['CASSANDRA_DEFAULT_KEYSPACE'] if not TESTING else 'test'
+message_keyspace = os.environ['CASSANDRA_DEFAULT_KEYSPACE'] if not TESTING else 'test'
+
+# The index of the message table before the content had an n-gram subfield, named after the keyspace
+LEGACY_MESSAGE_INDEX = message_keyspace
+# Bumped with every change of the mapping, `setup_elasticsearch` migrates to the new index
+MESSAGE_INDEX_VERSION = 2
+MESSAGE_INDEX = f'{message_keyspace}_messages_v{MESSAGE_INDEX_VERSION}'
+# The alias all searches go through
+message_index = f'{message_keyspace}_messages'
+
+CONTENT_NGRAM_SIZE = 3
+
+MESSAGE_INDEX_SETTINGS = {
+    'analysis': {
+        'tokenizer': {
+            'content_trigram': {
+                'type': 'ngram',
+                'min_gram': CONTENT_NGRAM_SIZE,
+                'max_gram': CONTENT_NGRAM_SIZE,
+                'token_chars': ['letter', 'digit'],
+            },
+        },
+        'analyzer': {
+            'content_ngram': {
+                'type': 'custom',
+                'tokenizer': 'content_trigram',
+                'filter': ['lowercase'],
+            },
+        },
+    },
+}
+
+MESSAGE_INDEX_MAPPINGS = {
+    'message': {
+        'discover': '^((?!content).)*$',
+        'properties': {
+            'content': {
+                'type': 'text',
+                'cql_collection': 'singleton',
+                'fields': {
+                    'ngram': {
+                        'type': 'text',
+                        'analyzer': 'content_ngram',
+                    },
+                },
+            },
+        },
+    },
+}
+
+# Whether `message_index` has the n-gram subfield, set by `setup_elasticsearch`
+ngram_content_search = False
 
 
 class NoCompatibleWithHeaderTransport(AsyncTransport):
-    """Ugly hack to make elasticsearch 8.x work with Elassandra 6.x"""
+    """
+    Ugly hack to make elasticsearch 8.x work with Elassandra 6.x
+
+    Every request gets a span, and its latency and number of hits are observed per API and node.
+    """
     async def perform_request(
         self,
         method: str,
@@ -30,17 +87,24 @@ class NoCompatibleWithHeaderTransport(AsyncTransport):
         if 'Content-Type' in headers:
             headers['Content-Type'] = 'application/json'
 
-        meta, resp_body = await super().perform_request(
-            method,
-            target,
-            body=body,
-            headers=headers,
-            max_retries=max_retries,
-            retry_on_status=retry_on_status,
-            retry_on_timeout=retry_on_timeout,
-            request_timeout=request_timeout,
-            client_meta=client_meta,
-        )
+        query = QuerySpan('elasticsearch', elasticsearch_statement_name(method, target), {'http.method': method})
+        try:
+            meta, resp_body = await super().perform_request(
+                method,
+                target,
+                body=body,
+                headers=headers,
+                max_retries=max_retries,
+                retry_on_status=retry_on_status,
+                retry_on_timeout=retry_on_timeout,
+                request_timeout=request_timeout,
+                client_meta=client_meta,
+            )
+        except Exception as e:
+            query.end(error=e)
+            raise
+        hits = resp_body.get('hits', {}).get('hits') if isinstance(resp_body, dict) else None
+        query.end(host=f'{meta.node.host}:{meta.node.port}', rows=len(hits) if isinstance(hits, list) else None)
 
         if not meta.headers.get("x-elastic-product", None):
             meta.headers["x-elastic-product"] = "Elasticsearch"
@@ -56,20 +120,68 @@ else:
     logging.info('Elasticsearch: connection established...')
 
 
+async def _index_count(index: str) -> int:
+    return (await es.count(index=index))['count']
+
+
 async def setup_elasticsearch():
+    """
+    Sets up the message index, and migrates the search to it from an index with an older mapping.
+
+    The versioned index covers the same Cassandra table (`index.keyspace`), so Elassandra builds it from the messages
+    that are already stored. Searches go through `message_index` (an alias), which is moved to the new index once it
+    has caught up with the old one. Until then the old index is searched with the old (wildcard) query, and the next
+    startup tries again. The old index is kept, so the alias can be moved back.
+    """
+    global ngram_content_search
     logging.info('Elasticsearch: setting up Elasticsearch indices from Cassandra schema...')
-    if not await es.indices.exists(index=message_index):
+    if not await es.indices.exists(index=MESSAGE_INDEX):
+        logging.info('Elasticsearch: creating index %s', MESSAGE_INDEX)
         await es.indices.create(
-            index=message_index, 
-            mappings={
-                "message": {
-                    "discover": "^((?!content).)*$",
-                    "properties": {
-                        "content": {
-                            "type": "text",
-                            "cql_collection": "singleton",
-                        },
-                    }
-                }
-            }
+            index=MESSAGE_INDEX,
+            settings={
+                'index.keyspace': message_keyspace,
+                **MESSAGE_INDEX_SETTINGS,
+            },
+            mappings=MESSAGE_INDEX_MAPPINGS,
         )
+
+    target = MESSAGE_INDEX
+    if await es.indices.exists(index=LEGACY_MESSAGE_INDEX):
+        indexed, legacy_indexed = await _index_count(MESSAGE_INDEX), await _index_count(LEGACY_MESSAGE_INDEX)
+        if indexed < legacy_indexed:
+            logging.warning('Elasticsearch: index %s is still being built (%d of %d messages), searching %s',
+                            MESSAGE_INDEX, indexed, legacy_indexed, LEGACY_MESSAGE_INDEX)
+            target = LEGACY_MESSAGE_INDEX
+
+    # moved in a single update, so searches never find the alias missing
+    actions = [{'add': {'index': target, 'alias': message_index}}]
+    if await es.indices.exists_alias(name=message_index):
+        actions.insert(0, {'remove': {'index': '*', 'alias': message_index}})
+    await es.indices.update_aliases(actions=actions)
+    ngram_content_search = target == MESSAGE_INDEX
+    logging.info('Elasticsearch: searching messages in %s', target)
+
+
+def message_content_query(content: str) -> dict:
+    """
+    The query for messages that contain a text, also in the middle of words (like `*content*`).
+
+    Every trigram of the text has to be in the trigram subfield of the content, which is a term lookup per trigram
+    instead of a scan of all terms. Texts that are too short for a trigram match words that start with them, and
+    messages where the text starts a word (or phrase) score higher.
+    :param content: The text to search for
+    :return: The query, without the filter on rooms
+    """
+    if not ngram_content_search:
+        return {'query_string': {'query': f'*{content}*', 'fields': ['content']}}
+
+    prefix = {'match_phrase_prefix': {'content': {'query': content}}}
+    if all(len(word) < CONTENT_NGRAM_SIZE for word in re.findall(r'\w+', content)):
+        return prefix
+    return {
+        'bool': {
+            'must': [{'match': {'content.ngram': {'query': content, 'operator': 'and'}}}],
+            'should': [prefix],
+        }
+    }
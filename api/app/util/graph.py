@@ -0,0 +1,113 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import time
+from typing import Any, Callable, Optional, TypeVar
+
+from neomodel import db
+from prometheus_client import Gauge, Histogram
+
+from app.util.instrumentation import graph_operation
+
+T = TypeVar('T')
+
+NEO4J_EXECUTOR_WORKERS = int(os.environ.get('NEO4J_EXECUTOR_WORKERS', 8))
+
+GRAPH_QUERIES_WAITING = Gauge(
+    'echochat_graph_queries_waiting',
+    'Number of Neo4j operations waiting for a free worker of the graph executor',
+)
+GRAPH_QUERIES_IN_PROGRESS = Gauge(
+    'echochat_graph_queries_in_progress',
+    'Number of Neo4j operations currently being executed by the graph executor',
+)
+GRAPH_QUERY_WAIT_TIME = Histogram(
+    'echochat_graph_query_wait_seconds',
+    'Histogram of the time Neo4j operations wait for a free worker (in seconds)',
+)
+GRAPH_QUERY_TIME = Histogram(
+    'echochat_graph_query_duration_seconds',
+    'Histogram of the execution time of Neo4j operations by operation (in seconds)',
+    ['operation'],
+)
+
+
+def _share_connection(driver: Any, url: str, database_name: str) -> None:
+    # neomodel keeps its connection per thread, let the workers share the driver (and thereby the connection pool) that
+    # was set up on the main thread instead of every worker creating its own
+    if driver is not None:
+        db.driver = driver
+        db.url = url
+        db._database_name = database_name
+        db._pid = os.getpid()
+
+
+class GraphExecutor:
+    """
+    Runs the (blocking) neomodel calls in a bounded thread pool, so slow graph queries do not block the event loop.
+
+    At most `max_workers` operations run at once, the others wait for a free worker. This limit is separate from the
+    default executor of the event loop, so a burst of graph queries cannot starve other blocking work (or the other
+    way around). Waiting and execution times are exported as Prometheus metrics. Operations run in the context of
+    their caller, so the spans of their Cypher queries belong to the trace of the request.
+    """
+
+    def __init__(self, max_workers: int = NEO4J_EXECUTOR_WORKERS) -> None:
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # created on first use, by then `setup_neo4j` has connected the main thread and the workers can share it
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='neo4j',
+                initializer=_share_connection,
+                initargs=(db.driver, db.url, db._database_name),
+            )
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run a blocking Neo4j operation on a worker of the executor.
+        :param func: The operation to run, its name is used as the `operation` label of the metrics
+        :return: The result of the operation
+        """
+        operation = getattr(func, '__name__', 'unknown')
+        context = contextvars.copy_context()
+        context.run(graph_operation.set, operation)
+        submitted = time.perf_counter()
+        waiting = [True]  # popped exactly once, either by the worker or by a caller that gave up waiting
+        GRAPH_QUERIES_WAITING.inc()
+
+        def stop_waiting() -> None:
+            try:
+                waiting.pop()
+            except IndexError:
+                return
+            GRAPH_QUERIES_WAITING.dec()
+
+        def call() -> T:
+            started = time.perf_counter()
+            stop_waiting()
+            GRAPH_QUERY_WAIT_TIME.observe(started - submitted)
+            GRAPH_QUERIES_IN_PROGRESS.inc()
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                GRAPH_QUERIES_IN_PROGRESS.dec()
+                GRAPH_QUERY_TIME.labels(operation=operation).observe(time.perf_counter() - started)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), call)
+        finally:
+            stop_waiting()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+graph_executor = GraphExecutor()
@@ -0,0 +1,167 @@
+import asyncio
+from collections import defaultdict
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+from app.models import Message
+
+MESSAGE_INGESTION_ENABLED = os.environ.get('MESSAGE_INGESTION_ENABLED', False)
+MESSAGE_INGESTION_QUEUE_SIZE = int(os.environ.get('MESSAGE_INGESTION_QUEUE_SIZE', 10000))
+MESSAGE_INGESTION_BATCH_SIZE = int(os.environ.get('MESSAGE_INGESTION_BATCH_SIZE', 50))
+MESSAGE_INGESTION_MAX_IN_FLIGHT = int(os.environ.get('MESSAGE_INGESTION_MAX_IN_FLIGHT', 64))
+MESSAGE_INGESTION_SUBMIT_TIMEOUT = float(os.environ.get('MESSAGE_INGESTION_SUBMIT_TIMEOUT', 2))
+
+INGESTION_QUEUE_DEPTH = Gauge(
+    'echochat_message_ingestion_queue_depth',
+    'Number of messages waiting in the ingestion queue',
+)
+INGESTION_BATCH_SIZE = Histogram(
+    'echochat_message_ingestion_batch_size',
+    'Histogram of the number of messages per batch written by the ingestion queue',
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+
+PendingMessage = Tuple[Message, asyncio.Future]
+
+
+class IngestionError(Exception):
+    """
+    Raised when a message could not be ingested, because the ingestion queue is full or stopped.
+    """
+
+
+class IngestionQueueFull(IngestionError):
+    """
+    Raised when a message could not be queued for ingestion in time, because the queue stayed full.
+    """
+
+
+class MessageIngestionQueue:
+    """
+    Write-behind stage for new messages.
+
+    Messages are submitted to a bounded queue, a single background task takes all pending messages at once, groups
+    them by room (the partition key of the Message table) and writes every group with one unlogged batch. While those
+    writes are in flight, new messages pile up in the queue and end up in the next batches, so the busier a room is,
+    the fewer writes it takes.
+
+    `submit` only returns once the write of the message has been acknowledged, so callers can fan the message out
+    afterwards. When the queue is full, submitting waits for room in the queue (backpressure), and gives up with
+    `IngestionQueueFull` after `submit_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable[[Sequence[Message]], Awaitable[Any]],
+        maxsize: int = MESSAGE_INGESTION_QUEUE_SIZE,
+        batch_size: int = MESSAGE_INGESTION_BATCH_SIZE,
+        max_in_flight: int = MESSAGE_INGESTION_MAX_IN_FLIGHT,
+        submit_timeout: float = MESSAGE_INGESTION_SUBMIT_TIMEOUT,
+    ) -> None:
+        self.write_batch = write_batch
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.submit_timeout = submit_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._writes: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def submit(self, message: Message) -> None:
+        """
+        Queue a message for ingestion, and wait until it is written.
+        :param message: The (built) message to save
+        :raises IngestionQueueFull: When the queue stayed full for `submit_timeout` seconds
+        """
+        if not self.running:
+            raise IngestionError('Ingestion: queue is not running')
+        future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self._queue.put((message, future)), self.submit_timeout)
+        except asyncio.TimeoutError:
+            raise IngestionQueueFull(f'Ingestion: queue is full ({self.maxsize} messages)')
+        INGESTION_QUEUE_DEPTH.set(self._queue.qsize())
+        await future
+
+    def _take_pending(self, first: PendingMessage) -> Dict[Any, List[PendingMessage]]:
+        pending = defaultdict(list)
+        pending[first[0].room_id].append(first)
+        while not self._queue.empty():
+            message, future = self._queue.get_nowait()
+            pending[message.room_id].append((message, future))
+        INGESTION_QUEUE_DEPTH.set(0)
+        return pending
+
+    async def _write(self, batch: List[PendingMessage]) -> None:
+        try:
+            await self.write_batch([message for message, _ in batch])
+        except Exception as e:
+            logging.error('Ingestion: failed to write batch of %d messages: %s', len(batch), e)
+            self._fail([batch], e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self._in_flight.release()
+
+    @staticmethod
+    def _fail(batches: List[List[PendingMessage]], e: Exception) -> None:
+        for batch in batches:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _run(self) -> None:
+        while True:
+            pending = self._take_pending(await self._queue.get())
+            batches = [
+                room_pending[i:i + self.batch_size]
+                for room_pending in pending.values()
+                for i in range(0, len(room_pending), self.batch_size)
+            ]
+            for index, batch in enumerate(batches):
+                try:
+                    # no more than `max_in_flight` batches at once, meanwhile the queue fills up (and applies
+                    # backpressure)
+                    await self._in_flight.acquire()
+                except asyncio.CancelledError:
+                    self._fail(batches[index:], IngestionError('Ingestion: queue was stopped'))
+                    raise
+                INGESTION_BATCH_SIZE.observe(len(batch))
+                task = asyncio.create_task(self._write(batch))
+                self._writes.add(task)
+                task.add_done_callback(self._writes.discard)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        # created here, so they belong to the event loop that runs the queue
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop taking messages from the queue, and wait for the batches that are already being written.
+        Messages still in the queue are failed, so their senders get an error instead of waiting forever.
+        """
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            self._fail([[self._queue.get_nowait()]], IngestionError('Ingestion: queue was stopped'))
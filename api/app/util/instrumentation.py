@@ -0,0 +1,177 @@
+from contextvars import ContextVar
+from functools import lru_cache
+import re
+import time
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+from opentelemetry import trace
+from opentelemetry.trace import Span, SpanKind, Status, StatusCode
+from prometheus_client import Histogram
+
+tracer = trace.get_tracer(__name__)
+
+DB_QUERY_TIME = Histogram(
+    'echochat_db_query_duration_seconds',
+    'Histogram of the time of database queries by system, statement and coordinator or target host (in seconds)',
+    ['system', 'statement', 'host'],
+)
+DB_QUERY_ROWS = Histogram(
+    'echochat_db_query_rows',
+    'Histogram of the number of rows (or hits) returned by database queries by system and statement',
+    ['system', 'statement'],
+    buckets=(0, 1, 5, 10, 20, 50, 100, 200, 500, 1000, 5000),
+)
+
+# The graph executor operation that is running, names the Cypher queries that are not registered (those of neomodel)
+graph_operation: ContextVar[Optional[str]] = ContextVar('graph_operation', default=None)
+
+# Table of the statements that are not registered (those of cqlengine), e.g. `SELECT * FROM "echochat"."message"`
+CQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(?:"?\w+"?\.)?"?(\w+)"?', re.IGNORECASE)
+
+
+class QuerySpan:
+    """
+    A span and the latency (and rows returned) of a single database query.
+    """
+
+    def __init__(self, system: str, statement: str, attributes: Optional[Mapping[str, Any]] = None) -> None:
+        self.system = system
+        self.statement = statement
+        self.span: Span = tracer.start_span(f'{system} {statement}', kind=SpanKind.CLIENT, attributes={
+            'db.system': system,
+            'db.operation': statement,
+            **(attributes or {}),
+        })
+        self.started = time.perf_counter()
+        self.ended = False
+
+    def end(
+        self, host: Optional[str] = None, rows: Optional[int] = None, error: Optional[BaseException] = None
+    ) -> None:
+        """
+        End the span and observe the query, only the first call counts (a paged query completes once per page).
+        :param host: The coordinator or target host of the query
+        :param rows: The number of rows returned, if the query returns rows
+        :param error: The exception the query failed with
+        """
+        if self.ended:
+            return
+        self.ended = True
+        DB_QUERY_TIME.labels(system=self.system, statement=self.statement, host=host or 'unknown').observe(
+            time.perf_counter() - self.started)
+        if host:
+            self.span.set_attribute('net.peer.name', host)
+        if rows is not None:
+            DB_QUERY_ROWS.labels(system=self.system, statement=self.statement).observe(rows)
+            self.span.set_attribute('db.rows', rows)
+        if error is not None:
+            self.span.record_exception(error)
+            self.span.set_status(Status(StatusCode.ERROR, type(error).__name__))
+        self.span.end()
+
+
+class CassandraInstrumentation:
+    """
+    Request init listener of the Cassandra session: every query (of the prepared statements and of cqlengine, either
+    with `execute` or `execute_async`) gets a span and is observed once the driver completes it.
+    """
+
+    def __init__(self) -> None:
+        # names of the prepared statements by query id
+        self.names: Dict[bytes, str] = {}
+
+    def register(self, name: str, query_id: bytes) -> None:
+        self.names[query_id] = name
+
+    def statement_name(self, statement: Any) -> str:
+        prepared = getattr(statement, 'prepared_statement', None)
+        if prepared is not None:
+            return self.names.get(prepared.query_id, 'prepared')
+        batch = getattr(statement, '_statements_and_parameters', None)
+        if batch is not None:
+            if not batch:
+                return 'batch'
+            # (whether it is prepared, the query id or the query, parameters) of the first statement of the batch
+            is_prepared, query, _ = batch[0]
+            return f'{self.names.get(query, "prepared") if is_prepared else cql_statement_name(query)}_batch'
+        query = getattr(statement, 'query_string', statement)
+        return cql_statement_name(query) if isinstance(query, str) else 'unknown'
+
+    def __call__(self, response_future: Any) -> None:
+        query = QuerySpan('cassandra', self.statement_name(response_future.query))
+
+        def completed(rows: Any) -> None:
+            rows = len(rows) if isinstance(rows, list) else None
+            query.end(host=_host_name(response_future.coordinator_host), rows=rows)
+
+        def failed(exc: BaseException) -> None:
+            query.end(host=_host_name(response_future.coordinator_host), error=exc)
+
+        response_future.add_callbacks(completed, failed)
+
+
+@lru_cache(maxsize=256)
+def cql_statement_name(query: str) -> str:
+    verb = query.split(None, 1)[0].lower() if query.strip() else 'unknown'
+    table = CQL_TABLE.search(query)
+    return f'{verb}_{table.group(1).lower()}' if table else verb
+
+
+def _host_name(host: Any) -> Optional[str]:
+    # the coordinator is an `address:port` string in recent drivers, and a `Host` in older ones
+    return None if host is None else str(getattr(host, 'address', host))
+
+
+cassandra_instrumentation = CassandraInstrumentation()
+
+# names of the Cypher queries of the repositories by query
+cypher_statement_names: Dict[str, str] = {}
+
+
+def register_cypher_statements(statements: Mapping[str, str]) -> None:
+    """
+    Name Cypher queries, by which they are labelled in the spans and metrics.
+    :param statements: The queries by name
+    """
+    cypher_statement_names.update({query: name for name, query in statements.items()})
+
+
+@lru_cache(maxsize=8)
+def _neo4j_host(url: Optional[str]) -> Optional[str]:
+    return urlparse(url).hostname if url else None
+
+
+def instrument_neo4j(database: Any) -> None:
+    """
+    Wrap `cypher_query` of the neomodel database, every Cypher query (of the repositories and of neomodel itself)
+    passes through it. Named queries are labelled by their name, the others by the running graph executor operation.
+    :param database: The neomodel `db` object
+    """
+    if getattr(database.cypher_query, 'instrumented', False):
+        return
+    cypher_query: Callable[..., Tuple[list, Any]] = database.cypher_query
+
+    def instrumented_cypher_query(query: str, *args, **kwargs) -> Tuple[list, Any]:
+        statement = cypher_statement_names.get(query) or graph_operation.get() or 'cypher'
+        span = QuerySpan('neo4j', statement)
+        host = _neo4j_host(getattr(database, 'url', None))
+        try:
+            with trace.use_span(span.span, end_on_exit=False):
+                results, meta = cypher_query(query, *args, **kwargs)
+        except Exception as e:
+            span.end(host=host, error=e)
+            raise
+        span.end(host=host, rows=len(results) if results is not None else None)
+        return results, meta
+
+    instrumented_cypher_query.instrumented = True
+    database.cypher_query = instrumented_cypher_query
+
+
+def elasticsearch_statement_name(method: str, target: str) -> str:
+    """
+    Name an Elasticsearch request by its method and API, e.g. `POST _search` for `/messages/_search?size=10`.
+    """
+    api = [part for part in target.split('?', 1)[0].split('/') if part.startswith('_')]
+    return f'{method} {api[0] if api else "index"}'
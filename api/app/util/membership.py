@@ -0,0 +1,140 @@
+import logging
+import os
+from typing import Dict, FrozenSet, Iterable
+from uuid import UUID
+
+from neomodel import db
+
+from app.util.cache import TTLCache
+from app.util.graph import graph_executor
+from app.util.instrumentation import register_cypher_statements
+
+# Cached memberships are invalidated on every node through the `room_membership` control message. The TTL is only the
+# safety net for control messages that are lost (e.g. while the broker is unreachable), it bounds how long a node can
+# serve a stale membership.
+ROOM_MEMBERSHIP_CACHE_TTL = float(os.environ.get('ROOM_MEMBERSHIP_CACHE_TTL', 30))
+ROOM_MEMBERSHIP_CACHE_SIZE = int(os.environ.get('ROOM_MEMBERSHIP_CACHE_SIZE', 10000))
+
+room_members_cache: TTLCache[str, FrozenSet[str]] = TTLCache(
+    maxsize=ROOM_MEMBERSHIP_CACHE_SIZE,
+    ttl=ROOM_MEMBERSHIP_CACHE_TTL,
+)
+# Bumped on every invalidation of the members of a room, members loaded before it are not cached
+_room_members_invalidations = 0
+# The rooms of users (the allowed rooms of their searches), invalidated through the same control message
+user_rooms_cache: TTLCache[str, FrozenSet[str]] = TTLCache(
+    maxsize=ROOM_MEMBERSHIP_CACHE_SIZE,
+    ttl=ROOM_MEMBERSHIP_CACHE_TTL,
+)
+# Bumped on every invalidation of the rooms of a user, rooms loaded before it are not cached
+_user_rooms_invalidations = 0
+
+
+ROOM_MEMBER_IDS_QUERY = """
+UNWIND $room_uuids AS room_uuid
+MATCH (room:Room {uuid: room_uuid})
+OPTIONAL MATCH (user:User)-[:IN_ROOM]->(room)
+RETURN room.uuid, collect(user.uuid)
+"""
+
+
+async def get_rooms_member_ids(room_ids: Iterable[UUID | str]) -> Dict[str, FrozenSet[str]]:
+    """
+    Get the uuids of all members of multiple rooms. Served from the membership cache, the rooms that are not cached
+    are loaded from Neo4j using a single query (on the graph executor).
+    :param room_ids: The UUIDs of the rooms (either in hex or in canonical form)
+    :return: The uuids of the members per room hex uuid, in canonical UUID form
+    """
+    room_uuids = {UUID(str(room_id)).hex for room_id in room_ids}
+    members = {}
+    for room_uuid in room_uuids:
+        cached = room_members_cache.get(room_uuid)
+        if cached is not None:
+            members[room_uuid] = cached
+
+    missing = [room_uuid for room_uuid in room_uuids if room_uuid not in members]
+    if missing:
+        invalidations = _room_members_invalidations
+        results, _ = await graph_executor.run(db.cypher_query, ROOM_MEMBER_IDS_QUERY, {'room_uuids': missing})
+        # a user joined or left a room while the members were loaded, they might not include the change
+        cacheable = invalidations == _room_members_invalidations
+        for room_uuid, member_uuids in results:
+            members[room_uuid] = frozenset(str(UUID(member_uuid)) for member_uuid in member_uuids)
+            if cacheable:
+                room_members_cache.set(room_uuid, members[room_uuid])
+        logging.debug('Rooms %s: loaded members (cached: %s)', missing, cacheable)
+
+    # rooms that do not exist have no members
+    return {room_uuid: members.get(room_uuid, frozenset()) for room_uuid in room_uuids}
+
+
+USER_ROOM_IDS_QUERY = """
+UNWIND $user_uuids AS user_uuid
+MATCH (user:User {uuid: user_uuid})-[:IN_ROOM]->(room:Room)
+RETURN user.uuid, collect(room.uuid)
+"""
+
+register_cypher_statements({'get_rooms_member_ids': ROOM_MEMBER_IDS_QUERY, 'get_users_room_ids': USER_ROOM_IDS_QUERY})
+
+
+async def get_users_room_ids(user_ids: Iterable[UUID | str]) -> Dict[str, FrozenSet[str]]:
+    """
+    Get the uuids of the rooms of multiple users, using a single query (this is not cached).
+    :param user_ids: The UUIDs of the users (either in hex or in canonical form)
+    :return: The hex uuids of the rooms per user uuid in canonical form
+    """
+    user_uuids = [UUID(str(user_id)).hex for user_id in user_ids]
+    if not user_uuids:
+        return {}
+    results, _ = await graph_executor.run(db.cypher_query, USER_ROOM_IDS_QUERY, {'user_uuids': user_uuids})
+    return {str(UUID(user_uuid)): frozenset(room_uuids) for user_uuid, room_uuids in results}
+
+
+async def get_user_room_ids(user_id: UUID | str) -> FrozenSet[str]:
+    """
+    Get the uuids of the rooms of a user. Served from the user rooms cache, falls back to Neo4j on a miss.
+    :param user_id: The UUID of the user (either in hex or in canonical form)
+    :return: The hex uuids of the rooms
+    """
+    user_uuid = str(UUID(str(user_id)))
+    room_ids = user_rooms_cache.get(user_uuid)
+    if room_ids is None:
+        invalidations = _user_rooms_invalidations
+        room_ids = (await get_users_room_ids([user_uuid])).get(user_uuid, frozenset())
+        # the user joined or left a room while the rooms were loaded, they might not include the change
+        if invalidations == _user_rooms_invalidations:
+            user_rooms_cache.set(user_uuid, room_ids)
+    return room_ids
+
+
+async def get_room_member_ids(room_id: UUID | str) -> FrozenSet[str]:
+    """
+    Get the uuids of all members of a room. Served from the membership cache, falls back to Neo4j on a miss.
+    :param room_id: The UUID of the room (either in hex or in canonical form)
+    :return: The uuids of the members, in canonical UUID form
+    """
+    return (await get_rooms_member_ids([room_id]))[UUID(str(room_id)).hex]
+
+
+async def is_room_member(room_id: UUID | str, user_id: UUID | str) -> bool:
+    return str(UUID(str(user_id))) in await get_room_member_ids(room_id)
+
+
+def invalidate_room_members(room_id: UUID | str) -> None:
+    """
+    Drop the cached members of a room on this node.
+    Other nodes are notified through the `room_membership` control message of the websocket manager.
+    """
+    global _room_members_invalidations
+    _room_members_invalidations += 1
+    room_members_cache.invalidate(UUID(str(room_id)).hex)
+
+
+def invalidate_user_rooms(user_id: UUID | str) -> None:
+    """
+    Drop the cached rooms of a user on this node.
+    Other nodes are notified through the `room_membership` control message of the websocket manager.
+    """
+    global _user_rooms_invalidations
+    _user_rooms_invalidations += 1
+    user_rooms_cache.invalidate(str(UUID(str(user_id))))
@@ -1,5 +1,7 @@
+import os
+import re
 import time
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import \
@@ -12,13 +14,11 @@ from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from prometheus_client import REGISTRY, Counter, Gauge, Histogram
 from prometheus_client.openmetrics.exposition import (CONTENT_TYPE_LATEST,
                                                       generate_latest)
-from starlette.middleware.base import (BaseHTTPMiddleware,
-                                       RequestResponseEndpoint)
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import Match
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 INFO = Gauge(
     "fastapi_app_info", "FastAPI application information.", [
@@ -50,57 +50,117 @@ REQUESTS_IN_PROGRESS = Gauge(
 )
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
-        super().__init__(app)
+# Segments of a path that are ids (uuids or numbers), replaced to get the shape of the path
+ID_SEGMENT = re.compile(
+    r"(?<=/)(?:[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}|\d+)(?=/|$)"
+)
+# Shapes that did not match a route are cached as well, up to this many shapes in total
+PROMETHEUS_ROUTE_CACHE_SIZE = int(os.environ.get("PROMETHEUS_ROUTE_CACHE_SIZE", 1024))
+
+
+class RouteMetrics:
+    """
+    The labelled metrics of a route template and method, looked up once instead of on every request.
+    """
+
+    def __init__(self, method: str, path: str, app_name: str) -> None:
+        self.method = method
+        self.path = path
+        self.app_name = app_name
+        self.requests = REQUESTS.labels(method=method, path=path, app_name=app_name)
+        self.in_progress = REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=app_name)
+        self.processing_time = REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=app_name)
+        self._responses: Dict[int, Counter] = {}
+
+    def responses(self, status_code: int) -> Counter:
+        counter = self._responses.get(status_code)
+        if counter is None:
+            counter = self._responses[status_code] = RESPONSES.labels(
+                method=self.method, path=self.path, status_code=status_code, app_name=self.app_name)
+        return counter
+
+
+class PrometheusMiddleware:
+    """
+    Pure ASGI middleware that exports the requests, responses and processing times of the HTTP routes.
+
+    The route template of a request is resolved once per method and path shape (the path with its ids replaced), and
+    cached together with the labelled metrics of the route. Websocket (and lifespan) scopes are passed on as they are.
+    """
+
+    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app",
+                 cache_size: int = PROMETHEUS_ROUTE_CACHE_SIZE) -> None:
+        self.app = app
         self.app_name = app_name
+        self.cache_size = cache_size
+        self._routes: Dict[Tuple[str, str], Optional[RouteMetrics]] = {}
         INFO.labels(app_name=self.app_name).inc()
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-        if not is_handled_path:
-            return await call_next(request)
+        route = self.get_route(scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
 
-        REQUESTS_IN_PROGRESS.labels(
-            method=method, path=path, app_name=self.app_name).inc()
-        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        route.in_progress.inc()
+        route.requests.inc()
         before_time = time.perf_counter()
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, send_wrapper)
         except BaseException as e:
             status_code = HTTP_500_INTERNAL_SERVER_ERROR
-            EXCEPTIONS.labels(method=method, path=path, exception_type=type(
+            EXCEPTIONS.labels(method=route.method, path=route.path, exception_type=type(
                 e).__name__, app_name=self.app_name).inc()
             raise e from None
         else:
-            status_code = response.status_code
             after_time = time.perf_counter()
             # retrieve trace id for exemplar
-            span = trace.get_current_span()
-            trace_id = trace.format_trace_id(
-                span.get_span_context().trace_id)
-
-            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
-                after_time - before_time, exemplar={'TraceID': trace_id}
-            )
+            span_context = trace.get_current_span().get_span_context()
+            exemplar = {"TraceID": trace.format_trace_id(span_context.trace_id)} if span_context.is_valid else None
+            route.processing_time.observe(after_time - before_time, exemplar=exemplar)
         finally:
-            RESPONSES.labels(method=method, path=path,
-                             status_code=status_code, app_name=self.app_name).inc()
-            REQUESTS_IN_PROGRESS.labels(
-                method=method, path=path, app_name=self.app_name).dec()
-
-        return response
+            route.responses(status_code).inc()
+            route.in_progress.dec()
+
+    def get_route(self, scope: Scope) -> Optional[RouteMetrics]:
+        """
+        Get the metrics of the route a request matches, resolved once per method and path shape.
+        :return: The metrics of the route, or None if the request does not match a route
+        """
+        key = (scope["method"], ID_SEGMENT.sub("{id}", scope["path"]))
+        try:
+            return self._routes[key]
+        except KeyError:
+            pass
+
+        route = None
+        path = self.get_path(scope)
+        if path is not None:
+            route = RouteMetrics(scope["method"], path, self.app_name)
+        if len(self._routes) < self.cache_size:
+            self._routes[key] = route
+        return route
 
     @staticmethod
-    def get_path(request: Request) -> Tuple[str, bool]:
-        for route in request.app.routes:
-            match, child_scope = route.matches(request.scope)
+    def get_path(scope: Scope) -> Optional[str]:
+        for route in scope["app"].routes:
+            match, child_scope = route.matches(scope)
             if match == Match.FULL:
-                return route.path, True
+                return route.path
 
-        return request.url.path, False
+        return None
 
 
 def metrics(request: Request) -> Response:
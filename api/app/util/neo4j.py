@@ -1,12 +1,13 @@
 import logging
 import os
 
-from neomodel import config as neo4j_config, install_labels, drop_constraints
+from neomodel import config as neo4j_config, db, install_labels, drop_constraints
 
 from app.models import Room, User
 from app.models.user import UserStatus, UserStates
 from app.util.dummy_data import add_admin_user, add_dummy_users, add_dummy_rooms
 from app.util.config import DEBUG
+from app.util.instrumentation import instrument_neo4j
 
 
 def setup_neo4j():
@@ -15,6 +16,8 @@ def setup_neo4j():
         f"neo4j://{os.environ['NEO4J_USERNAME']}:{os.environ['NEO4J_PASSWORD']}@{os.environ['NEO4J_URI']}:7687"
     logging.info('Neo4j: connecting to Neo4j (%s)...', neo4j_config.DATABASE_URL)
     neo4j_config.AUTO_INSTALL_LABELS = True
+    # every Cypher query gets a span and is observed in the metrics
+    instrument_neo4j(db)
 
     # reset database if we are in development mode
     if DEBUG:
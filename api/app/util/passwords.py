@@ -0,0 +1,137 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import time
+from typing import Callable, Optional, TypeVar
+
+from passlib.context import CryptContext
+from prometheus_client import Counter, Gauge, Histogram
+
+T = TypeVar('T')
+
+# one core is left for the event loop, the hashing workers get the others
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) - 1)))
+# operations waiting for (or running on) a worker, beyond this new logins are turned away right away
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', PASSWORD_HASH_WORKERS * 8))
+PASSWORD_HASH_RETRY_AFTER = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', 1))
+
+PASSWORD_HASH_PENDING = Gauge(
+    'echochat_password_hash_pending',
+    'Number of password hash operations waiting for or running on a worker of the password hasher',
+)
+PASSWORD_HASH_REJECTED = Counter(
+    'echochat_password_hash_rejected_total',
+    'Total count of password hash operations rejected because the password hasher was saturated',
+)
+PASSWORD_HASH_TIME = Histogram(
+    'echochat_password_hash_duration_seconds',
+    'Histogram of the time password hash operations take by operation, including waiting for a worker (in seconds)',
+    ['operation'],
+)
+
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify a plain password against a stored hash.
+    :param plain_password: The plain password to verify
+    :param hashed_password: The stored hash
+    :return: True if the password matches the hash, False otherwise
+    """
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _warm_up() -> None:
+    pass
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when a password could not be hashed or verified, because too many operations are pending already.
+    """
+
+    def __init__(self, message: str, retry_after: int = PASSWORD_HASH_RETRY_AFTER) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt (which is slow on purpose) in a bounded process pool, so a burst of logins neither blocks the event
+    loop nor competes for the GIL with it.
+
+    At most `max_workers` passwords are hashed at once. Operations beyond that wait for a free worker, up to
+    `max_pending` operations in total: after that `PasswordHasherBusy` is raised right away, instead of letting
+    requests queue up for longer than a client would wait for them.
+    """
+
+    def __init__(self, max_workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING) -> None:
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def start(self) -> None:
+        """
+        Start the workers, so the first logins do not wait for them. Call this before the database drivers start
+        their threads, the workers are forked from this process.
+        """
+        self._get_executor().submit(_warm_up)
+
+    async def _run(self, operation: str, func: Callable[..., T], *args) -> T:
+        if self.pending >= self.max_pending:
+            PASSWORD_HASH_REJECTED.inc()
+            raise PasswordHasherBusy(f'Passwords: {self.pending} operations pending')
+        started = time.perf_counter()
+        self.pending += 1
+        PASSWORD_HASH_PENDING.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            # a worker died, the pool cannot be used anymore: start a new one for the next operations
+            logging.error('Passwords: worker pool broke, restarting it')
+            self.shutdown()
+            raise
+        finally:
+            self.pending -= 1
+            PASSWORD_HASH_PENDING.dec()
+            PASSWORD_HASH_TIME.labels(operation=operation).observe(time.perf_counter() - started)
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password on a worker.
+        :param password: The plain password to hash
+        :return: The hash of the password
+        :raises PasswordHasherBusy: When too many operations are pending
+        """
+        return await self._run('hash', get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """
+        Verify a plain password against a stored hash on a worker.
+        :param plain_password: The plain password to verify
+        :param hashed_password: The stored hash
+        :return: True if the password matches the hash, False otherwise
+        :raises PasswordHasherBusy: When too many operations are pending
+        """
+        return await self._run('verify', verify_password, plain_password, hashed_password)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,431 @@
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from prometheus_client import Counter as MetricCounter, Histogram
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.models import UserStates
+from app.schemas.user import UserSchema, UserStateSchema
+from app.util.websocket import redis_client
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 30))
+PRESENCE_OFFLINE_RETENTION = int(os.environ.get('PRESENCE_OFFLINE_RETENTION', 7 * 24 * 3600))
+PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get('PRESENCE_HEARTBEAT_INTERVAL', 10))
+PRESENCE_GRACE_PERIOD = float(os.environ.get('PRESENCE_GRACE_PERIOD', 5))
+PRESENCE_TICK = float(os.environ.get('PRESENCE_TICK', 1))
+PRESENCE_SNAPSHOT_INTERVAL = float(os.environ.get('PRESENCE_SNAPSHOT_INTERVAL', 60))
+PRESENCE_REAP_BATCH_SIZE = int(os.environ.get('PRESENCE_REAP_BATCH_SIZE', 1000))
+PRESENCE_KEY_PREFIX = 'presence:user:'
+PRESENCE_ONLINE_KEY = 'presence:online'
+# Heartbeat deadlines of the connections of all nodes, by `<node id>:<user id>`
+PRESENCE_DEADLINES_KEY = 'presence:deadlines'
+
+PRESENCE_TRANSITIONS = MetricCounter(
+    'echochat_presence_transitions_total',
+    'Total count of presence transitions by status and result (published, or suppressed by the grace period)',
+    ['status', 'result'],
+)
+PRESENCE_FANOUT_RECIPIENTS = Histogram(
+    'echochat_presence_fanout_recipients',
+    'Histogram of the number of recipients of the user updates of a presence tick',
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000),
+)
+
+# Marks this node as connected for a user. Returns 1 when the user came online (was not in the online set).
+# KEYS: presence hash of the user, online set, deadlines zset. ARGV: node field, heartbeat deadline, last changed, ttl,
+# user id, deadline member
+CONNECT_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[6])
+if redis.call('SADD', KEYS[2], ARGV[5]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', 'online', 'last_changed', ARGV[3])
+return 1
+"""
+
+# Marks a node as no longer connected for a user. Returns 1 when the user went offline: no node (with a heartbeat
+# deadline in the future) is connected for the user anymore, and the user was in the online set. When reaping, the
+# node is only removed if its deadline has still passed (it did not send a heartbeat since it was found).
+# KEYS: presence hash of the user, online set, deadlines zset. ARGV: node field, now, last changed, retention, user id,
+# deadline member, whether reaping (1 or 0)
+DISCONNECT_SCRIPT = """
+if ARGV[7] == '1' then
+    local deadline = redis.call('ZSCORE', KEYS[3], ARGV[6])
+    if deadline and tonumber(deadline) > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('ZREM', KEYS[3], ARGV[6])
+redis.call('HDEL', KEYS[1], ARGV[1])
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+    if string.sub(fields[i], 1, 5) == 'node:' and tonumber(fields[i + 1]) > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+if redis.call('SREM', KEYS[2], ARGV[5]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', 'offline', 'last_changed', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class RedisPresenceStore:
+    """
+    The authoritative online state of users, shared by all nodes through Redis.
+
+    A user is online while it is in the online set, so counting the online users is a single `SCARD`. Every user also
+    has a hash with its state and the time of its last status change, in which every node that has connections of the
+    user keeps a field with the deadline of its last heartbeat. The deadlines are also kept in a sorted set (by
+    `<node id>:<user id>`), so `reap` only has to look at the connections of nodes that missed their deadline (that
+    crashed): those users are taken offline, unless another node is connected.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        node_id: Optional[str] = None,
+        ttl: int = PRESENCE_TTL,
+        offline_retention: int = PRESENCE_OFFLINE_RETENTION,
+        reap_batch_size: int = PRESENCE_REAP_BATCH_SIZE,
+    ) -> None:
+        self.redis = redis
+        self.node_id = node_id or uuid4().hex
+        self.ttl = ttl
+        self.offline_retention = offline_retention
+        self.reap_batch_size = reap_batch_size
+        self._connect = redis.register_script(CONNECT_SCRIPT)
+        self._disconnect = redis.register_script(DISCONNECT_SCRIPT)
+
+    async def _run_script(
+        self, script: Any, connections: List[Tuple[str, str]], args: List[Any], reaping: bool = False
+    ) -> Set[str]:
+        """
+        Run a script for connections of nodes, in a single pipeline.
+        :param connections: The (node id, user id) of every connection
+        :return: The users for which the script returned 1
+        """
+        if not connections:
+            return set()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for node_id, user_id in connections:
+                await script(
+                    keys=[f'{PRESENCE_KEY_PREFIX}{user_id}', PRESENCE_ONLINE_KEY, PRESENCE_DEADLINES_KEY],
+                    args=[f'node:{node_id}', *args, user_id, f'{node_id}:{user_id}', int(reaping)],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        return {user_id for (_, user_id), changed in zip(connections, results) if changed}
+
+    async def connect(self, user_ids: Iterable[str], changed_at: datetime) -> Set[str]:
+        """
+        Mark the users as connected to this node.
+        :return: The users that came online, i.e. were not connected to any other node
+        """
+        return await self._run_script(
+            self._connect, [(self.node_id, user_id) for user_id in user_ids],
+            [time.time() + self.ttl, changed_at.isoformat(), self.ttl],
+        )
+
+    async def disconnect(self, user_ids: Iterable[str], changed_at: datetime) -> Set[str]:
+        """
+        Mark the users as no longer connected to this node.
+        :return: The users that went offline, i.e. are not connected to any other node either
+        """
+        return await self._run_script(
+            self._disconnect, [(self.node_id, user_id) for user_id in user_ids],
+            [time.time(), changed_at.isoformat(), self.offline_retention],
+        )
+
+    async def reap(self, changed_at: datetime) -> Set[str]:
+        """
+        Take the users offline whose connections have all missed their heartbeat deadline (their nodes are gone). Only
+        the connections that missed their deadline are looked at, at most `reap_batch_size` of them (the others are
+        reaped on the next heartbeat). Every node reaps, the scripts make sure a user is only taken offline once.
+        :return: The users that went offline
+        """
+        now = time.time()
+        expired = await self.redis.zrangebyscore(
+            PRESENCE_DEADLINES_KEY, '-inf', now, start=0, num=self.reap_batch_size
+        )
+        connections = [tuple(member.decode().split(':', 1)) for member in expired]
+        return await self._run_script(
+            self._disconnect, connections, [now, changed_at.isoformat(), self.offline_retention], reaping=True
+        )
+
+    async def heartbeat(self, user_ids: Iterable[str]) -> None:
+        """
+        Extend the deadline of this node for users that are still connected to it.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        deadline = time.time() + self.ttl
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                key = f'{PRESENCE_KEY_PREFIX}{user_id}'
+                pipe.hset(key, f'node:{self.node_id}', deadline)
+                pipe.expire(key, self.ttl)
+            pipe.zadd(PRESENCE_DEADLINES_KEY, {f'{self.node_id}:{user_id}': deadline for user_id in user_ids})
+            await pipe.execute()
+
+    async def online_count(self) -> int:
+        return await self.redis.scard(PRESENCE_ONLINE_KEY)
+
+    async def get_statuses(self, user_ids: Iterable[str]) -> Dict[str, Tuple[UserStates, Optional[datetime]]]:
+        """
+        Get the state and the time of the last status change of users.
+        :param user_ids: The uuids of the users, in canonical form
+        :return: The status per user, users that have not been seen (for a while) are left out
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hmget(f'{PRESENCE_KEY_PREFIX}{user_id}', 'state', 'last_changed')
+            results = await pipe.execute()
+        return {
+            user_id: (UserStates(state.decode()), datetime.fromisoformat(last_changed.decode()) if last_changed else None)
+            for user_id, (state, last_changed) in zip(user_ids, results) if state is not None
+        }
+
+
+presence_store = RedisPresenceStore(redis_client)
+
+
+async def apply_presence(users: Iterable[UserSchema]) -> None:
+    """
+    Replace the status of users (as snapshotted in Neo4j) with their live status from the presence store. When Redis
+    is unreachable, the snapshotted status is kept.
+    :param users: The users to update, in place
+    """
+    users = list(users)
+    try:
+        statuses = await presence_store.get_statuses({str(user.uuid) for user in users})
+    except (RedisError, OSError) as e:
+        logging.warning('Presence: could not get the status of %d users: %s', len(users), e)
+        return
+    for user in users:
+        if str(user.uuid) in statuses:
+            state, last_changed = statuses[str(user.uuid)]
+            user.status = UserStateSchema(state=state, last_changed=last_changed)
+
+
+# {user id: the users that should be told about its status}
+RecipientsResolver = Callable[[Iterable[str]], Awaitable[Dict[str, Set[str]]]]
+# (recipients, user updates) of a single frame
+UpdatesPublisher = Callable[[List[str], List[dict]], Awaitable[Any]]
+# {user id: (state, changed at)} of the users that changed state since the last snapshot
+SnapshotWriter = Callable[[Dict[str, Tuple[UserStates, datetime]]], Awaitable[Any]]
+
+
+class PresenceService:
+    """
+    Tracks which users are connected to this node, and tells their contacts when they come online or go offline.
+
+    Connects and disconnects only change local state, all work is done by a single background task every `tick`
+    seconds:
+    - A user that disconnects is only marked offline after `grace_period` seconds, a reconnect within that period
+      (a flapping mobile client, or a page reload) cancels the transition, so no update is sent at all.
+    - The transitions that are due are applied to the shared store at once, only users that actually changed state
+      (e.g. not those still connected to another node) are announced.
+    - The recipients of all announced changes are resolved at once, and every recipient gets a single `user_update`
+      frame with all changes it should know about. Recipients that get the same changes share one published message.
+    Every `heartbeat_interval` seconds, the presence of all users connected to this node is extended in the store, and
+    users of nodes that are gone are taken offline. Every `snapshot_interval` seconds, the changes of this node are
+    saved with `save_snapshot` (to Neo4j, for analytics), so the store is the only one written on every change.
+    """
+
+    def __init__(
+        self,
+        store: RedisPresenceStore,
+        resolve_recipients: RecipientsResolver,
+        publish: UpdatesPublisher,
+        grace_period: float = PRESENCE_GRACE_PERIOD,
+        tick: float = PRESENCE_TICK,
+        heartbeat_interval: float = PRESENCE_HEARTBEAT_INTERVAL,
+        save_snapshot: Optional[SnapshotWriter] = None,
+        snapshot_interval: float = PRESENCE_SNAPSHOT_INTERVAL,
+    ) -> None:
+        self.store = store
+        self.resolve_recipients = resolve_recipients
+        self.publish = publish
+        self.grace_period = grace_period
+        self.tick = tick
+        self.heartbeat_interval = heartbeat_interval
+        self.save_snapshot = save_snapshot
+        self.snapshot_interval = snapshot_interval
+        self._connections: Counter = Counter()
+        # users of which this node is registered in the store
+        self._registered: Set[str] = set()
+        # {user id: (status, due at)} of the transitions that have not been applied yet
+        self._pending: Dict[str, Tuple[UserStates, float]] = {}
+        # {user id: (status, changed at)} of the changes that have not been saved by `save_snapshot` yet
+        self._unsaved: Dict[str, Tuple[UserStates, datetime]] = {}
+        self._last_heartbeat = 0.0
+        self._last_snapshot = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def is_connected(self, user_id: str) -> bool:
+        return self._connections[user_id] > 0
+
+    def connected(self, user_id: str) -> None:
+        """
+        Register a new connection of a user to this node.
+        """
+        self._connections[user_id] += 1
+        if self._connections[user_id] > 1:
+            return
+        pending = self._pending.pop(user_id, None)
+        if pending is not None and pending[0] is UserStates.OFFLINE:
+            # reconnected within the grace period, the user never went offline
+            PRESENCE_TRANSITIONS.labels(status=UserStates.OFFLINE.value, result='suppressed').inc()
+        elif user_id not in self._registered:
+            self._pending[user_id] = (UserStates.ONLINE, time.monotonic())
+
+    def disconnected(self, user_id: str) -> None:
+        """
+        Register a closed connection of a user to this node.
+        """
+        if self._connections[user_id] > 1:
+            self._connections[user_id] -= 1
+            return
+        del self._connections[user_id]
+        pending = self._pending.pop(user_id, None)
+        if pending is not None and pending[0] is UserStates.ONLINE:
+            # disconnected before the user was announced online
+            PRESENCE_TRANSITIONS.labels(status=UserStates.ONLINE.value, result='suppressed').inc()
+        elif user_id in self._registered:
+            self._pending[user_id] = (UserStates.OFFLINE, time.monotonic() + self.grace_period)
+
+    def _take_due(self) -> Dict[UserStates, List[str]]:
+        now = time.monotonic()
+        due = defaultdict(list)
+        for user_id, (status, due_at) in list(self._pending.items()):
+            if due_at <= now:
+                due[status].append(user_id)
+                del self._pending[user_id]
+        return due
+
+    async def _publish_changes(self, changes: Dict[str, dict]) -> None:
+        recipients = await self.resolve_recipients(changes.keys())
+        updates_per_recipient = defaultdict(set)
+        for user_id, user_recipients in recipients.items():
+            for recipient in user_recipients:
+                updates_per_recipient[recipient].add(user_id)
+
+        # recipients that have to be told about the same users get the same frame
+        recipients_per_updates: Dict[FrozenSet[str], List[str]] = defaultdict(list)
+        for recipient, user_ids in updates_per_recipient.items():
+            recipients_per_updates[frozenset(user_ids)].append(recipient)
+        PRESENCE_FANOUT_RECIPIENTS.observe(len(updates_per_recipient))
+
+        for user_ids, frame_recipients in recipients_per_updates.items():
+            updates = [{'userId': user_id, 'props': changes[user_id]} for user_id in sorted(user_ids)]
+            await self.publish(sorted(frame_recipients), updates)
+
+    def _requeue(self, user_ids: List[str], status: UserStates) -> None:
+        # transitions that could not be applied are retried in the next tick, unless the user changed state already
+        for user_id in user_ids:
+            self._pending.pop(user_id, None)
+            if self.is_connected(user_id) == (status is UserStates.ONLINE):
+                self._pending[user_id] = (status, time.monotonic())
+
+    async def _apply(self, user_ids: List[str], status: UserStates, changed_at: datetime) -> Set[str]:
+        # `_registered` is updated before the store, so (dis)connects while the store is updated are queued correctly
+        if status is UserStates.ONLINE:
+            self._registered.update(user_ids)
+            apply, revert = self.store.connect, self._registered.difference_update
+        else:
+            self._registered.difference_update(user_ids)
+            apply, revert = self.store.disconnect, self._registered.update
+        try:
+            return await apply(user_ids, changed_at)
+        except Exception:
+            revert(user_ids)
+            self._requeue(user_ids, status)
+            raise
+
+    async def _snapshot(self) -> None:
+        self._last_snapshot = time.monotonic()
+        unsaved, self._unsaved = self._unsaved, {}
+        if not unsaved:
+            return
+        try:
+            await self.save_snapshot(unsaved)
+        except Exception:
+            # saved with the next snapshot, unless the user changed state again in the meantime
+            self._unsaved = {**unsaved, **self._unsaved}
+            raise
+
+    async def run_tick(self, force_snapshot: bool = False) -> None:
+        """
+        Send the heartbeat if it is time to, apply the transitions that are due and announce the changes.
+        :param force_snapshot: Save the unsaved changes, even if the snapshot interval has not passed yet
+        """
+        changed_at = datetime.utcnow()
+        changes: Dict[str, UserStates] = {}
+        if time.monotonic() - self._last_heartbeat >= self.heartbeat_interval:
+            self._last_heartbeat = time.monotonic()
+            await self.store.heartbeat(self._registered)
+            changes.update(dict.fromkeys(await self.store.reap(changed_at), UserStates.OFFLINE))
+
+        due = self._take_due()
+        for status in (UserStates.ONLINE, UserStates.OFFLINE):
+            if due[status]:
+                changes.update(dict.fromkeys(await self._apply(due[status], status, changed_at), status))
+
+        if changes:
+            for user_id, status in changes.items():
+                PRESENCE_TRANSITIONS.labels(status=status.value, result='published').inc()
+                self._unsaved[user_id] = (status, changed_at)
+            await self._publish_changes({
+                user_id: {'status': {'state': status.value, 'lastChanged': changed_at.isoformat()}}
+                for user_id, status in changes.items()
+            })
+
+        if self.save_snapshot is not None and \
+                (force_snapshot or time.monotonic() - self._last_snapshot >= self.snapshot_interval):
+            await self._snapshot()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_tick()
+            except Exception as e:
+                logging.error('Presence: error in presence tick: %s', e)
+            await asyncio.sleep(self.tick)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background task, mark all users of this node offline right away (their connections are closed with
+        the node) and save the last snapshot.
+        """
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._pending = {user_id: (UserStates.OFFLINE, 0) for user_id in self._registered}
+        try:
+            await self.run_tick(force_snapshot=True)
+        except Exception as e:
+            logging.error('Presence: failed to mark users of this node offline: %s', e)
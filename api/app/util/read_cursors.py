@@ -0,0 +1,107 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, Mapping, MutableMapping, Optional
+from uuid import UUID
+
+from prometheus_client import Counter
+
+READ_CURSOR_COALESCE_WINDOW = float(os.environ.get('READ_CURSOR_COALESCE_WINDOW', 0.5))
+
+READ_CURSOR_UPDATES = Counter(
+    'echochat_read_cursor_updates_total',
+    'Total count of read cursor updates by result (received from clients, or written after coalescing)',
+    ['result'],
+)
+
+# (room id, {user id: index id}) of the cursors that moved forward in a room
+CursorsCallback = Callable[[UUID, Dict[UUID, datetime]], Awaitable[Any]]
+
+
+class ReadCursorCoalescer:
+    """
+    Coalesces the read cursor updates of clients on this node.
+
+    A client reports every message it sees, while only the newest one matters. Updates are kept in memory for
+    `window` seconds, in which only the furthest cursor of every user in every room is kept. After the window, the
+    cursors of every room are written at once (`write`), and announced to the room with a single update (`publish`).
+    """
+
+    def __init__(self, write: CursorsCallback, publish: CursorsCallback, window: float = READ_CURSOR_COALESCE_WINDOW):
+        self.write = write
+        self.publish = publish
+        self.window = window
+        self._pending: Dict[UUID, Dict[UUID, datetime]] = defaultdict(dict)
+        self._task: Optional[asyncio.Task] = None
+
+    def advance(self, room_id: UUID, user_id: UUID, index_id: datetime) -> None:
+        """
+        Move the read cursor of a user in a room forward, it is written after the coalescing window.
+        :param room_id: The room the user read messages in
+        :param user_id: The user that read the messages
+        :param index_id: The `index_id` of the last message the user has seen
+        """
+        READ_CURSOR_UPDATES.labels(result='received').inc()
+        cursors = self._pending[room_id]
+        if user_id not in cursors or cursors[user_id] < index_id:
+            cursors[user_id] = index_id
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def _flush_room(self, room_id: UUID, cursors: Dict[UUID, datetime]) -> None:
+        try:
+            await self.write(room_id, cursors)
+        except Exception as e:
+            logging.error('Read cursors: failed to write %d cursors of room %s: %s', len(cursors), room_id, e)
+            return
+        READ_CURSOR_UPDATES.labels(result='written').inc(len(cursors))
+        try:
+            await self.publish(room_id, cursors)
+        except Exception as e:
+            logging.error('Read cursors: failed to publish cursors of room %s: %s', room_id, e)
+
+    async def flush(self) -> None:
+        """
+        Write and publish all pending cursors now.
+        """
+        pending, self._pending = self._pending, defaultdict(dict)
+        await asyncio.gather(*(self._flush_room(room_id, cursors) for room_id, cursors in pending.items()))
+
+    async def stop(self) -> None:
+        """
+        Stop waiting for the coalescing window, and flush the pending cursors.
+        """
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
+
+
+def apply_read_cursors(rows: Iterable[MutableMapping[str, Any]], cursors: Mapping[UUID, datetime]) -> None:
+    """
+    Derive the seen (and distributed) state of messages from the read cursors of a room, a message has been seen
+    when any member other than its sender has read up to (or past) it.
+    :param rows: Rows of the Message table, updated in place
+    :param cursors: The read cursors of the room, by user id
+    """
+    if not cursors:
+        return
+    # only the two furthest cursors are needed: the furthest one, unless it is of the sender of the message
+    furthest = sorted(cursors.items(), key=lambda cursor: cursor[1], reverse=True)[:2]
+    for row in rows:
+        if row['seen']:
+            continue
+        others = [index_id for user_id, index_id in furthest if user_id != row['sender_id']]
+        if others and others[0] >= row['index_id']:
+            row['seen'] = True
+            row['distributed'] = True
@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+from typing import Awaitable, Callable, FrozenSet, Hashable, Iterable, List, Tuple
+from uuid import UUID
+
+from prometheus_client import Counter
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.util.cache import TTLCache
+from app.util.websocket import redis_client
+
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+# Cached results are validated by the write versions of their rooms. The TTL is only the safety net for version bumps
+# that are lost (e.g. while Redis is unreachable), it bounds how long a node can serve a stale result.
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 300))
+# A new message is only searchable once Elasticsearch refreshed the index (every second by default), results of
+# searches within this many seconds of a write to one of their rooms are not cached
+SEARCH_CACHE_SETTLE_TIME = float(os.environ.get('SEARCH_CACHE_SETTLE_TIME', 2))
+ROOM_VERSIONS_KEY = 'search:room_versions'
+ROOM_WRITES_KEY = 'search:room_writes'
+
+SEARCH_CACHE_REQUESTS = Counter(
+    'echochat_search_cache_requests_total',
+    'Total count of message searches by result of the search cache (hit, miss, stale, or unavailable)',
+    ['result'],
+)
+
+SearchKey = Tuple[str, FrozenSet[str], Hashable]
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+class RoomVersions:
+    """
+    Write versions of rooms in Redis, shared by all nodes. The version of a room is bumped after every write of a
+    message to it, along with the time of the write.
+    """
+
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+
+    async def bump(self, room_id: str) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hincrby(ROOM_VERSIONS_KEY, room_id, 1)
+            pipe.hset(ROOM_WRITES_KEY, room_id, time.time())
+            await pipe.execute()
+
+    async def get(self, room_ids: List[str]) -> Tuple[Tuple[int, ...], float]:
+        """
+        Get the versions of rooms, using a single round trip.
+        :param room_ids: The rooms to get the versions of
+        :return: The version of every room (0 if it was never written to), and the time of the last write to any of
+            them
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(ROOM_VERSIONS_KEY, room_ids)
+            pipe.hmget(ROOM_WRITES_KEY, room_ids)
+            versions, writes = await pipe.execute()
+        return (
+            tuple(int(version or 0) for version in versions),
+            max((float(written) for written in writes if written is not None), default=0.0),
+        )
+
+
+class SearchResultCache:
+    """
+    In-process cache of the results of message searches, by the normalized query, the rooms that are searched and the
+    other parameters of the search.
+
+    Every result is cached with the write versions of its rooms, read before the search. A result is only served while
+    none of the versions changed, i.e. none of the rooms got a new message since, so it is never stale and does not
+    expire by guessing. Joining or leaving a room changes the rooms that are searched, which is another key.
+    """
+
+    def __init__(
+        self,
+        versions: RoomVersions,
+        maxsize: int = SEARCH_CACHE_SIZE,
+        ttl: float = SEARCH_CACHE_TTL,
+        settle_time: float = SEARCH_CACHE_SETTLE_TIME,
+        timer: Callable[[], float] = time.time,
+    ) -> None:
+        self.versions = versions
+        self.settle_time = settle_time
+        self._timer = timer
+        self._results: TTLCache[SearchKey, Tuple[Tuple[int, ...], bytes]] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(
+        self, query: str, room_ids: Iterable[str], params: Hashable, search: Callable[[], Awaitable[bytes]]
+    ) -> bytes:
+        """
+        Get the result of a search from the cache, or search and cache the result.
+        :param query: The searched content
+        :param room_ids: The rooms that are searched
+        :param params: The other parameters of the search, e.g. the page
+        :param search: Runs the search, and returns its (encoded) result
+        :return: The (encoded) result
+        """
+        rooms = sorted(room_ids)
+        try:
+            versions, last_write = await self.versions.get(rooms)
+        except (RedisError, OSError) as e:
+            logging.warning('Search cache: failed to get room versions, searching without cache: %s', e)
+            SEARCH_CACHE_REQUESTS.labels(result='unavailable').inc()
+            return await search()
+
+        key = (normalize_query(query), frozenset(rooms), params)
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == versions:
+            SEARCH_CACHE_REQUESTS.labels(result='hit').inc()
+            return cached[1]
+        SEARCH_CACHE_REQUESTS.labels(result='miss' if cached is None else 'stale').inc()
+
+        result = await search()
+        if self._timer() - last_write >= self.settle_time:
+            self._results.set(key, (versions, result))
+        return result
+
+    async def room_written(self, room_id: UUID | str) -> None:
+        """
+        Bump the version of a room after a message was written to it, which invalidates the cached results of searches
+        in the room on every node. Does not raise: when Redis is unreachable, the results are dropped on this node only.
+        """
+        room_id = str(UUID(str(room_id)))
+        try:
+            await self.versions.bump(room_id)
+        except (RedisError, OSError) as e:
+            logging.error('Search cache: failed to bump the version of room %s: %s', room_id, e)
+            self._results.invalidate_where(lambda key, _: room_id in key[1])
+
+
+search_result_cache = SearchResultCache(RoomVersions(redis_client))
@@ -0,0 +1,140 @@
+from datetime import date, datetime, time
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from cassandra.util import Date, Time
+import orjson
+
+from app.models import Message
+
+# Format of `indexId` in websocket payloads, the client sends it back as is to mark a message as seen
+WEBSOCKET_INDEX_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _uuid(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _date(value: Date | date | None) -> Optional[str]:
+    if value is None:
+        return None
+    return (value.date() if isinstance(value, Date) else value).strftime('%d-%m-%Y')
+
+
+def _time(value: Time | time | None) -> Optional[str]:
+    if value is None:
+        return None
+    return (value.time() if isinstance(value, Time) else value).strftime('%H:%M:%S')
+
+
+def _index(index_format: Optional[str]) -> Callable[[datetime], str]:
+    if index_format is None:
+        return datetime.isoformat
+    return lambda value: value.strftime(index_format)
+
+
+def _search_index(value: Optional[str]) -> Optional[str]:
+    # Elasticsearch returns `2023-01-31T12:00:00.000Z`, the time zone is left out like in the other responses
+    return None if value is None else value.rstrip('Z')
+
+
+def _search_date(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    return f'{value[8:10]}-{value[5:7]}-{value[:4]}'
+
+
+def _search_time(value: int | str | None) -> Optional[str]:
+    # Elassandra indexes times as nanoseconds since midnight
+    if not isinstance(value, int):
+        return value
+    seconds = value // 1_000_000_000
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class MessageEncoder:
+    """
+    Encodes messages straight to the JSON representation of `MessageSchema`, from a Cassandra row (a dict keyed by
+    column name) or from a `Message`.
+
+    Building a `MessageSchema` validates every field, after which FastAPI (or `.dict()`) walks the model again to
+    serialize it. Messages come from our own database, so that is not needed: the conversion of every field is looked
+    up once, when the encoder is created, and the result is encoded with orjson.
+    """
+
+    def __init__(
+        self,
+        index_format: Optional[str] = None,
+        conversions: Optional[Mapping[str, Callable[[Any], Any]]] = None,
+        sparse: bool = False,
+    ) -> None:
+        """
+        :param index_format: The strftime format of `indexId`, defaults to ISO 8601 (like FastAPI encodes datetimes)
+        :param conversions: Conversions of columns whose values are not of their Cassandra type, by column
+        :param sparse: Whether rows might leave out columns (that are null), like the source of Elasticsearch hits
+        """
+        # (key in the payload, column of the Message table, conversion), in the order of the `MessageSchema` fields
+        fields: List[Tuple[str, str, Callable[[Any], Any]]] = [
+            ('_id', 'uuid', _uuid),
+            ('indexId', 'index_id', _index(index_format)),
+            ('content', 'content', str),
+            ('senderId', 'sender_id', _uuid),
+            ('username', 'username', lambda value: value),
+            ('date', 'date', _date),
+            ('time_stamp', 'stamp', _time),
+            ('saved', 'saved', bool),
+            ('distributed', 'distributed', bool),
+            ('seen', 'seen', bool),
+            ('deleted', 'deleted', bool),
+            ('failure', 'failure', bool),
+            ('replyMessage', 'reply_message', _uuid),
+        ]
+        attributes = {column.db_field_name: name for name, column in Message._columns.items()}
+        conversions = conversions or {}
+
+        self.columns = [column for _, column, _ in fields]
+        self._keys = [key for key, _, _ in fields]
+        self._conversions = [conversions.get(column, conversion) for _, column, conversion in fields]
+        self._get_row_values = itemgetter(*self.columns)
+        if sparse:
+            self._get_row_values = lambda row: [row.get(column) for column in self.columns]
+        self._get_message_values = attrgetter(*(attributes[column] for _, column, _ in fields))
+
+    def to_dict(self, message: Message | Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Convert a message to the (JSON compatible) dict of its `MessageSchema`, by alias.
+        :param message: A `Message`, or a row of the Message table
+        """
+        values = self._get_message_values(message) if isinstance(message, Message) else self._get_row_values(message)
+        data = {key: conversion(value) for key, conversion, value in zip(self._keys, self._conversions, values)}
+        data['avatar'] = Message.avatar
+        data['disableActions'] = Message.disable_actions
+        data['disableReactions'] = Message.disable_reactions
+        data['files'] = []
+        data['reactions'] = []
+        return data
+
+    def encode(self, message: Message | Mapping[str, Any]) -> bytes:
+        return orjson.dumps(self.to_dict(message))
+
+    def encode_page(self, rows: Iterable[Mapping[str, Any]], paging_state: Optional[bytes]) -> bytes:
+        """
+        Encode a page of messages as a `MessageFetchSchema`.
+        :param rows: The rows of the page
+        :param paging_state: The paging state of the next page, if any
+        """
+        messages = [self.to_dict(row) for row in rows]
+        return orjson.dumps({
+            'messages': messages,
+            'count': len(messages),
+            'pagingState': paging_state.hex() if paging_state else None,
+        })
+
+
+message_encoder = MessageEncoder()
+websocket_message_encoder = MessageEncoder(index_format=WEBSOCKET_INDEX_FORMAT)
+# Messages from the source of Elasticsearch hits, which has dates as strings and leaves out null values
+search_message_encoder = MessageEncoder(
+    conversions={'index_id': _search_index, 'date': _search_date, 'stamp': _search_time},
+    sparse=True,
+)
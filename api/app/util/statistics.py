@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import orjson
+from starlette.websockets import WebSocket
+
+ADMIN_STATISTICS_INTERVAL = float(os.environ.get('ADMIN_WEBSOCKET_INTERVAL', 10))
+
+
+class AdminStatistics:
+    """
+    Aggregates the statistics shown on the admin page, once per node.
+
+    A single background task collects the statistics every `interval` seconds (only while an admin is connected) and
+    sends the same encoded snapshot to all admin sockets of this node. Every statistic is a cheap lookup: the user
+    count is a Cypher `count()` (served from the count store of Neo4j), the online count is the size of the online
+    set of the presence store, and the message rate and connection count are kept by this node. So the cost of the
+    statistics grows with neither the number of users nor the number of admins.
+    """
+
+    def __init__(
+        self,
+        count_users: Callable[[], Awaitable[int]],
+        count_online_users: Callable[[], Awaitable[int]],
+        count_connections: Callable[[], int],
+        interval: float = ADMIN_STATISTICS_INTERVAL,
+    ) -> None:
+        self.count_users = count_users
+        self.count_online_users = count_online_users
+        self.count_connections = count_connections
+        self.interval = interval
+        self.sockets: Set[WebSocket] = set()
+        # the last known value of every statistic, kept when collecting it fails
+        self.statistics: Dict[str, Any] = {
+            'userCount': 0,
+            'onlineUsers': 0,
+            'messagesPerSecond': 0.0,
+            'connections': 0,
+            'adminConnections': 0,
+        }
+        self._messages = 0
+        # (time, message count) of the last collect
+        self._last_collect: Tuple[float, int] = (time.monotonic(), 0)
+        self._collected = False
+        self._task: Optional[asyncio.Task] = None
+
+    def record_message(self) -> None:
+        """
+        Count a new message handled by this node, for the message rate.
+        """
+        self._messages += 1
+
+    async def register(self, websocket: WebSocket) -> None:
+        """
+        Start sending the statistics to an (accepted) admin socket, the last snapshot is sent right away.
+        """
+        self.sockets.add(websocket)
+        if not self._collected:
+            await self.collect()
+        await self._send(websocket, self._frame())
+
+    def unregister(self, websocket: WebSocket) -> None:
+        self.sockets.discard(websocket)
+
+    async def _collect_count(self, key: str, count: Awaitable[int]) -> None:
+        try:
+            self.statistics[key] = await count
+        except Exception as e:
+            logging.error('Admin: failed to collect %s: %s', key, e)
+
+    async def collect(self) -> None:
+        """
+        Update all statistics.
+        """
+        await asyncio.gather(
+            self._collect_count('userCount', self.count_users()),
+            self._collect_count('onlineUsers', self.count_online_users()),
+        )
+        self._update_message_rate()
+        self.statistics['connections'] = self.count_connections()
+        self.statistics['adminConnections'] = len(self.sockets)
+        self._collected = True
+
+    def _update_message_rate(self) -> None:
+        now = time.monotonic()
+        last_time, last_messages = self._last_collect
+        if now > last_time:
+            self.statistics['messagesPerSecond'] = round((self._messages - last_messages) / (now - last_time), 2)
+        self._last_collect = (now, self._messages)
+
+    def _frame(self) -> str:
+        return orjson.dumps({
+            'type': 'user_statistics',
+            'data': {
+                'action': 'user_statistics_update',
+                'statistics': self.statistics,
+            }
+        }).decode()
+
+    async def _send(self, websocket: WebSocket, frame: str) -> None:
+        try:
+            await websocket.send_text(frame)
+        except Exception as e:
+            logging.warning('Admin: failed to send statistics, dropping admin socket: %s', e)
+            self.unregister(websocket)
+
+    async def broadcast(self) -> None:
+        """
+        Collect the statistics, and send them to all admin sockets (encoded once).
+        """
+        await self.collect()
+        frame = self._frame()
+        await asyncio.gather(*(self._send(websocket, frame) for websocket in list(self.sockets)))
+
+    async def _run(self) -> None:
+        while True:
+            if self.sockets:
+                try:
+                    await self.broadcast()
+                except Exception as e:
+                    logging.error('Admin: error while sending statistics: %s', e)
+            else:
+                # nothing else is collected without admins, but the message rate stays a rate of the last interval
+                self._update_message_rate()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
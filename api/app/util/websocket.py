@@ -1,10 +1,21 @@
+import asyncio
+from enum import Enum
 import logging
 import os
+import time
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional
+from uuid import UUID
 
-from distributed_websocket import WebSocketManager
+from distributed_websocket import WebSocketManager, create_broker, matches
+from distributed_websocket._connection import Connection
+from distributed_websocket._message import Message
+from distributed_websocket.utils import serialize
+import orjson
+from prometheus_client import Counter, Gauge, Histogram
 from redis.asyncio import Redis
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, RedisError
 
+from app.util.cache import TTLCache
 from app.util.config import TESTING
 
 REDIS_HOST = os.environ.get('REDIS_URI', 'redis://localhost')
@@ -12,6 +23,46 @@ REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', '')
 REDIS_PORT = os.environ.get('REDIS_PORT', 6379)
 REDIS_CONNECTION_URI = f'redis://:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/0'
 
+ROOM_TOPIC_PREFIX = 'room/'
+
+BROKER_HEALTH_CHECK_INTERVAL = float(os.environ.get('BROKER_HEALTH_CHECK_INTERVAL', 2))
+BROKER_HEALTH_CHECK_TIMEOUT = float(os.environ.get('BROKER_HEALTH_CHECK_TIMEOUT', 1))
+BROKER_FAILURE_THRESHOLD = int(os.environ.get('BROKER_FAILURE_THRESHOLD', 2))
+BROKER_MAX_BACKOFF = float(os.environ.get('BROKER_MAX_BACKOFF', 30))
+
+# New messages of which the time until the first send on this node is measured, and how long they are tracked
+MESSAGE_DELIVERY_TRACKING_SIZE = int(os.environ.get('MESSAGE_DELIVERY_TRACKING_SIZE', 10000))
+MESSAGE_DELIVERY_TRACKING_TTL = float(os.environ.get('MESSAGE_DELIVERY_TRACKING_TTL', 30))
+
+WEBSOCKET_CONNECTIONS = Gauge(
+    'echochat_websocket_connections',
+    'Number of websocket connections to this node',
+)
+WEBSOCKET_ACTION_TIME = Histogram(
+    'echochat_websocket_action_duration_seconds',
+    'Histogram of the time it takes to handle a websocket message by action (in seconds)',
+    ['action'],
+)
+WEBSOCKET_FANOUT_RECIPIENTS = Histogram(
+    'echochat_websocket_fanout_recipients',
+    'Histogram of the number of local connections a frame is sent to by action',
+    ['action'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000),
+)
+WEBSOCKET_SENDS = Counter(
+    'echochat_websocket_sends_total',
+    'Total count of frames sent to connections by action and result (sent, or failed and dropped)',
+    ['action', 'result'],
+)
+BROKER_PUBLISH_TIME = Histogram(
+    'echochat_broker_publish_duration_seconds',
+    'Histogram of the time it takes to publish a message to the broker (in seconds)',
+)
+MESSAGE_DELIVERY_TIME = Histogram(
+    'echochat_message_delivery_seconds',
+    'Histogram of the time from the acknowledged write of a new message to its first send on this node (in seconds)',
+)
+
 redis_client = Redis(
     host=REDIS_HOST,
     port=REDIS_PORT,
@@ -20,6 +71,255 @@ redis_client = Redis(
 )
 
 
+def room_topic(room_id: UUID | str) -> str:
+    """
+    Get the broker topic of a room, every connection of a member of the room is subscribed to it.
+    :param room_id: The UUID of the room (either in hex or in canonical form)
+    :return: The topic of the room
+    """
+    return f'{ROOM_TOPIC_PREFIX}{UUID(str(room_id))}'
+
+
+def normalize_conn_id(conn_id: UUID | str) -> str:
+    """
+    Connection ids are user uuids, but clients might send them in hex form or in canonical form.
+    :param conn_id: The connection id to normalize
+    :return: The connection id in canonical UUID form
+    """
+    return str(UUID(str(conn_id)))
+
+
+class EchoChatWebSocketManager(WebSocketManager):
+    """
+    WebSocketManager that knows about rooms.
+
+    Every connection is subscribed to the topic of its user, and to the topics of all rooms the user is a member of.
+    The rooms of the users are looked up with the `room_resolver`, when a connection is made and after every reconnect
+    to the broker (as membership control messages might have been lost in the meantime).
+    Messages for a room are therefore published to the broker only once, after which every node delivers them to its
+    local connections that are subscribed to the room topic.
+
+    Messages are delivered to the local connections as text frames that are encoded once per message, instead of once
+    per connection, so the cost of a message in a large room hardly grows with the number of members. The number of
+    recipients of every frame, failed sends and broker publish times are exported as Prometheus metrics.
+
+    Next to the regular message types, the manager supports control messages. These are published to the broker just
+    like other messages, but are handled by every node itself instead of being sent to connections.
+    """
+    ROOM_MEMBERSHIP = 'room_membership'
+
+    def __init__(
+        self, broker_channel: str, broker_url: str | None = None, broker_class: Any | None = None, **kwargs
+    ) -> None:
+        super().__init__(broker_channel, broker_url, broker_class, **kwargs)
+        self._broker_url = broker_url
+        self._broker_class = broker_class
+        self._control_handlers: Dict[str, List[Callable[[dict], None]]] = {}
+        self.room_resolver: Optional[Callable[[Iterable[str]], Awaitable[Dict[str, FrozenSet[str]]]]] = None
+        # perf_counter of the write of new messages by message id, until they are first sent
+        self._deliveries: TTLCache[str, float] = TTLCache(
+            maxsize=MESSAGE_DELIVERY_TRACKING_SIZE,
+            ttl=MESSAGE_DELIVERY_TRACKING_TTL,
+        )
+        self.register_control_handler(self.ROOM_MEMBERSHIP, self._handle_room_membership)
+
+    def register_control_handler(self, typ: str, handler: Callable[[dict], None]) -> None:
+        """
+        Register a handler for a control message type, it will be called on every node with the message data.
+        Multiple handlers can be registered for the same type, they are called in order of registration.
+        """
+        self._control_handlers.setdefault(typ, []).append(handler)
+
+    def _handle_control_message(self, typ: str, data: dict) -> None:
+        for handler in self._control_handlers[typ]:
+            try:
+                handler(data)
+            except Exception as e:
+                logging.error('Websocket: error while handling control message %s: %s', typ, e)
+
+    def send_msg(self, message: Message) -> None:
+        if message.typ in self._control_handlers:
+            self._handle_control_message(message.typ, message.data)
+        else:
+            super().send_msg(message)
+
+    async def _send_frame(self, connections: Iterable[Connection], data: Any) -> None:
+        """
+        Send the same data to multiple connections, it is encoded only once (and only if there is a connection).
+        A connection that fails does not keep the data from the other connections.
+        """
+        # the frames are the messages as published, with the payload for the client (and its action) as `data`
+        payload = data.get('data') if isinstance(data, dict) else None
+        action = payload.get('action', 'unknown') if isinstance(payload, dict) else 'unknown'
+        frame = None
+        sent = failed = 0
+        for connection in connections:
+            if frame is None:
+                frame = orjson.dumps(data).decode()
+            try:
+                await connection.websocket.send_text(frame)
+            except Exception as e:
+                failed += 1
+                logging.warning('Websocket %s: failed to send message: %s', connection.id, e)
+            else:
+                if not sent and action == 'new_message':
+                    self._observe_delivery(payload)
+                sent += 1
+        WEBSOCKET_FANOUT_RECIPIENTS.labels(action=action).observe(sent + failed)
+        if sent:
+            WEBSOCKET_SENDS.labels(action=action, result='sent').inc(sent)
+        if failed:
+            WEBSOCKET_SENDS.labels(action=action, result='failed').inc(failed)
+
+    def track_delivery(self, message_id: str, written: float) -> None:
+        """
+        Measure the time until a new message is first sent to a connection, when that happens on this node.
+        :param message_id: The `_id` of the message, as it is sent to the connections
+        :param written: The `time.perf_counter()` at which the write of the message was acknowledged
+        """
+        self._deliveries.set(message_id, written)
+
+    def _observe_delivery(self, payload: dict) -> None:
+        if not len(self._deliveries):
+            return
+        try:
+            message_id = payload['message']['_id']
+        except (KeyError, TypeError):
+            return
+        written = self._deliveries.get(message_id)
+        if written is not None:
+            self._deliveries.invalidate(message_id)
+            MESSAGE_DELIVERY_TIME.observe(time.perf_counter() - written)
+
+    async def _send(self, message: Message) -> None:
+        await self._send_frame(
+            [
+                connection for connection in self.active_connections
+                # the set lookup covers the exact topics of users and rooms, the pattern match any wildcard topics
+                if message.topic in connection.topics or matches(message.topic, connection.topics)
+            ],
+            message.data,
+        )
+
+    async def _broadcast(self, message: Message) -> None:
+        await self._send_frame(list(self.active_connections), message.data)
+
+    async def _send_by_conn_id(self, message: Message) -> None:
+        await self._send_frame(
+            [connection for connection in self.active_connections if connection.id == message.conn_id][:1],
+            message.data,
+        )
+
+    async def _send_multi_by_conn_id(self, message: Message) -> None:
+        conn_ids = set(message.conn_id)
+        await self._send_frame(
+            [connection for connection in self.active_connections if connection.id in conn_ids],
+            message.data,
+        )
+
+    def get_user_connections(self, user_id: UUID | str) -> list[Connection]:
+        conn_id = normalize_conn_id(user_id)
+        return [connection for connection in self.active_connections if connection.id == conn_id]
+
+    def subscribe_rooms(self, connection: Connection, room_ids: Iterable[UUID | str]) -> None:
+        connection.topics.update(room_topic(room_id) for room_id in room_ids)
+
+    def unsubscribe_rooms(self, connection: Connection, room_ids: Iterable[UUID | str]) -> None:
+        connection.topics.difference_update(room_topic(room_id) for room_id in room_ids)
+
+    async def resync_room_subscriptions(self, connections: Optional[Iterable[Connection]] = None) -> None:
+        """
+        Replace the room subscriptions of connections with the rooms their users are currently a member of.
+        :param connections: The connections to resync, defaults to all active connections
+        """
+        connections = list(self.active_connections if connections is None else connections)
+        if self.room_resolver is None or not connections:
+            return
+        room_ids = await self.room_resolver({connection.id for connection in connections})
+        for connection in connections:
+            connection.topics.difference_update(
+                [topic for topic in connection.topics if topic.startswith(ROOM_TOPIC_PREFIX)]
+            )
+            self.subscribe_rooms(connection, room_ids.get(connection.id, ()))
+
+    async def new_connection(self, websocket: Any, conn_id: str, topic: str | None = None) -> Connection:
+        """
+        Accept a new connection, subscribed to the topic of its user (the connection id) unless another topic is given.
+        """
+        conn_id = normalize_conn_id(conn_id)
+        return await super().new_connection(websocket, conn_id, topic=topic or conn_id)
+
+    async def publish(self, data: dict) -> None:
+        """
+        Publish a server side message to the broker, without validating it as a client message.
+        The message is encoded with orjson here, the broker publishes encoded messages as they are.
+        :param data: The message, containing at least a `type` and, depending on the type, a `topic`
+        """
+        message = orjson.dumps(serialize(Message.from_client_message(data=data)))
+        started = time.perf_counter()
+        await self._publish_to_broker(message)
+        BROKER_PUBLISH_TIME.observe(time.perf_counter() - started)
+
+    async def publish_room_membership(self, user_id: UUID | str, room_id: UUID | str, joined: bool) -> None:
+        """
+        Let every node (un)subscribe the connections of a user to the topic of a room, and drop what it cached about
+        the membership of the room. The change is applied on this node right away, other nodes follow when the control
+        message reaches them.
+        :param user_id: The user that joined or left the room
+        :param room_id: The room that was joined or left
+        :param joined: Whether the user joined (True) or left (False) the room
+        """
+        data = {
+            'userId': normalize_conn_id(user_id),
+            'roomId': str(UUID(str(room_id))),
+            'joined': joined,
+        }
+        self._handle_control_message(self.ROOM_MEMBERSHIP, data)
+        await self.publish({'type': self.ROOM_MEMBERSHIP, **data})
+
+    def _handle_room_membership(self, data: dict) -> None:
+        for connection in self.get_user_connections(data['userId']):
+            if data['joined']:
+                self.subscribe_rooms(connection, [data['roomId']])
+            else:
+                self.unsubscribe_rooms(connection, [data['roomId']])
+
+    @property
+    def listening(self) -> bool:
+        """
+        Whether the task that delivers broker messages to the connections is running.
+        """
+        return self._main_task is not None and not self._main_task.done()
+
+    async def reconnect(self) -> None:
+        """
+        Replace the broker connection, while keeping all websocket connections open.
+        Room subscriptions are resynced afterwards, membership changes published while the broker was unreachable
+        never reached this node.
+        """
+        if self._main_task is not None and not self._main_task.done():
+            self._main_task.cancel()
+            try:
+                await self._main_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logging.error('Websocket: broker listener failed: %s', e)
+        try:
+            await self.broker.disconnect()
+        except Exception:
+            pass
+        self.broker = self._broker_class() if self._broker_class else create_broker(self._broker_url)
+        await self.broker.connect()
+        await self.broker.subscribe(self.broker_channel)
+        self._main_task = asyncio.create_task(self._broker_listener())
+
+        try:
+            await self.resync_room_subscriptions()
+        except Exception as e:
+            logging.error('Websocket: failed to resync room subscriptions after reconnect: %s', e)
+
+
 async def check_redis_connection():
     try:
         await redis_client.ping()
@@ -29,10 +329,112 @@ async def check_redis_connection():
         return False
 
 
+class BrokerState(Enum):
+    CLOSED = 'closed'        # broker is healthy
+    OPEN = 'open'            # broker is unreachable, messages are refused
+    HALF_OPEN = 'half_open'  # broker is reachable again, the websocket manager is reconnecting
+
+
+class BrokerHealthMonitor:
+    """
+    Circuit breaker around the broker of the websocket manager.
+
+    A single background task per node pings Redis every `interval` seconds. After `failure_threshold` consecutive
+    failures the circuit opens, and the broker is probed with an exponential backoff. Once it is reachable again, the
+    monitor reconnects the websocket manager (once for the whole node) and closes the circuit.
+
+    The websocket hot path only has to read `healthy`.
+    """
+
+    def __init__(
+        self,
+        manager: EchoChatWebSocketManager,
+        interval: float = BROKER_HEALTH_CHECK_INTERVAL,
+        timeout: float = BROKER_HEALTH_CHECK_TIMEOUT,
+        failure_threshold: int = BROKER_FAILURE_THRESHOLD,
+        max_backoff: float = BROKER_MAX_BACKOFF,
+    ) -> None:
+        self.manager = manager
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.max_backoff = max_backoff
+        self.state = BrokerState.CLOSED
+        self.failures = 0
+        self._task: asyncio.Task | None = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.state is BrokerState.CLOSED
+
+    async def _ping(self) -> bool:
+        try:
+            return await asyncio.wait_for(check_redis_connection(), self.timeout)
+        except (asyncio.TimeoutError, RedisError):
+            logging.error('Redis: health check timed out or failed')
+            return False
+
+    async def check(self) -> None:
+        """
+        Perform a single health check, and update the state of the circuit.
+        """
+        if not await self._ping():
+            self.failures += 1
+            if self.state is BrokerState.HALF_OPEN or \
+                    (self.state is BrokerState.CLOSED and self.failures >= self.failure_threshold):
+                logging.error('Redis: broker unreachable, opening circuit')
+                self.state = BrokerState.OPEN
+            return
+
+        if self.state is not BrokerState.CLOSED or not self.manager.listening:
+            self.state = BrokerState.HALF_OPEN
+            logging.warning('Redis: broker reachable, reconnecting websocket manager')
+            try:
+                await self.manager.reconnect()
+            except Exception as e:
+                logging.error('Redis: failed to reconnect websocket manager: %s', e)
+                self.failures += 1
+                self.state = BrokerState.OPEN
+                return
+            logging.warning('Redis: reconnected websocket manager')
+        self.state = BrokerState.CLOSED
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        if self.state is BrokerState.CLOSED:
+            return self.interval
+        backoff = self.interval * 2 ** max(self.failures - self.failure_threshold, 0)
+        return min(backoff, self.max_backoff)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logging.error('Redis: error in broker health monitor: %s', e)
+            await asyncio.sleep(self.next_delay())
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
 def setup_websocket_manager():
     if TESTING:
-        return WebSocketManager('channel:1', broker_url='memory://')
-    return WebSocketManager(
+        return EchoChatWebSocketManager('channel:1', broker_url='memory://')
+    return EchoChatWebSocketManager(
         'echochat:messages',
         REDIS_CONNECTION_URI
     )
+
+
+websocket_manager = setup_websocket_manager()
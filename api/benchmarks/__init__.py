@@ -0,0 +1,11 @@
+import os
+
+from neomodel import config as neo4j_config
+
+
+def setup_neo4j_connection():
+    """
+    Connect neomodel to Neo4j, without the dummy data and default nodes that `setup_neo4j` creates.
+    """
+    neo4j_config.DATABASE_URL = \
+        f"neo4j://{os.environ['NEO4J_USERNAME']}:{os.environ['NEO4J_PASSWORD']}@{os.environ['NEO4J_URI']}:7687"
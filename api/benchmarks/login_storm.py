@@ -0,0 +1,79 @@
+"""
+Benchmark of the event loop latency during a login storm.
+
+Verifies `--logins` passwords, at most `--concurrency` at once, and meanwhile measures how late a probe task that
+sleeps for 10 ms wakes up (the event loop lag, which every other request on the node is delayed by). Compares
+verifying the passwords on the event loop (like `authenticate_user` used to) with the `PasswordHasher`, which
+verifies them in a process pool and turns away the logins beyond `--max-pending`.
+
+Does not need any database. Run from the `/api` directory:
+    python -m benchmarks.login_storm --logins 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.util.passwords import PASSWORD_HASH_WORKERS, PasswordHasher, PasswordHasherBusy, get_password_hash, \
+    verify_password
+
+PROBE_INTERVAL = 0.01
+
+
+async def probe(lags, stopped):
+    while not stopped.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def storm(name, verify, hashed_password, logins, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    rejected = [0]
+
+    async def login():
+        async with semaphore:
+            try:
+                await verify('password', hashed_password)
+            except PasswordHasherBusy:
+                rejected[0] += 1
+
+    lags, stopped = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stopped))
+    await asyncio.sleep(PROBE_INTERVAL * 2)
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stopped.set()
+    await probe_task
+
+    lags.sort()
+    print(f'{name:<8} {(logins - rejected[0]) / elapsed:>8.1f} logins/s {rejected[0]:>5} rejected   event loop lag '
+          f'p50 {statistics.median(lags) * 1000:>7.1f} ms  p99 {lags[int(len(lags) * 0.99)] * 1000:>7.1f} ms  '
+          f'max {lags[-1] * 1000:>7.1f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=PASSWORD_HASH_WORKERS)
+    parser.add_argument('--max-pending', type=int, default=None, help='default: no logins are rejected')
+    args = parser.parse_args()
+
+    hashed_password = get_password_hash('password')
+
+    async def verify_inline(plain_password, hashed):
+        return verify_password(plain_password, hashed)
+
+    hasher = PasswordHasher(max_workers=args.workers, max_pending=args.max_pending or args.logins)
+    hasher.start()
+    try:
+        await storm('inline', verify_inline, hashed_password, args.logins, args.concurrency)
+        await storm('pool', hasher.verify, hashed_password, args.logins, args.concurrency)
+    finally:
+        hasher.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
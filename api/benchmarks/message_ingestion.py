@@ -0,0 +1,83 @@
+"""
+Benchmark of the throughput and latency of saving new messages.
+
+Compares saving every message on its own (the default path of `add_new_message`) with the write-behind ingestion
+queue, that batches the pending messages per room. Every sender sends its messages one after the other (like a
+websocket connection does), the senders are spread over the rooms with a skew towards the first room, to mimic a
+popular room during an event. The latency of a message is the time until its write is acknowledged, which is when
+it would be fanned out.
+
+Requires a running Cassandra cluster (see the docker-compose file in the root of the project) and the usual
+`CASSANDRA_*` environment variables. Run from the `/api` directory:
+    python -m benchmarks.message_ingestion --senders 500 --messages 20 --rooms 10
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import random
+import statistics
+import time
+from uuid import uuid4
+
+from app.repositories import message_repository
+from app.util.cassandra import MESSAGE_TABLE, execute_async, setup_cassandra
+from app.util.ingestion import MessageIngestionQueue
+
+
+def build_message(room_id, sender_id, i):
+    now = datetime.utcnow()
+    return message_repository.build(
+        uuid=uuid4(), room_id=room_id, sender_id=sender_id, content=f'benchmark message {i}', username='bench',
+        index_id=now, message_date=now.date(), message_stamp=now.time(), saved=True,
+    )
+
+
+async def run_senders(name, save, rooms, senders, messages):
+    latencies = []
+
+    async def sender(room_id):
+        sender_id = uuid4()
+        for i in range(messages):
+            message = build_message(room_id, sender_id, i)
+            start = time.perf_counter()
+            await save(message)
+            latencies.append(time.perf_counter() - start)
+
+    # half of the senders are in the first room, the others are spread over all rooms
+    room_ids = [rooms[0] if i % 2 == 0 else random.choice(rooms) for i in range(senders)]
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(room_id) for room_id in room_ids))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f'{name:<16} {len(latencies) / elapsed:>10.0f} msg/s '
+          f'p50 {statistics.median(latencies) * 1000:>7.1f} ms p99 {p99 * 1000:>7.1f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--senders', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    setup_cassandra()
+    print(f'{args.senders} senders sending {args.messages} messages each to {args.rooms} rooms')
+
+    # fresh rooms for every run, so the runs do not share partitions
+    single_rooms, queue_rooms = [uuid4() for _ in range(args.rooms)], [uuid4() for _ in range(args.rooms)]
+    queue = MessageIngestionQueue(message_repository.create_many, batch_size=args.batch_size)
+    queue.start()
+    try:
+        await run_senders('single inserts', message_repository.insert, single_rooms, args.senders, args.messages)
+        await run_senders('ingestion queue', queue.submit, queue_rooms, args.senders, args.messages)
+    finally:
+        await queue.stop()
+        for room_id in single_rooms + queue_rooms:
+            await execute_async(f'DELETE FROM {MESSAGE_TABLE} WHERE room_id = %s', [room_id])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""
+Benchmark of the latency of searching messages by content, in milliseconds per search.
+
+Indexes synthetic messages (sentences of random words, spread over `--rooms` rooms) into two throwaway indices, one
+with the old mapping (searched with a `*text*` wildcard, like `search_messages_by_content` used to) and one with the
+trigram subfield of the content (searched with `message_content_query`). Once each of the `--messages` sizes has been
+indexed, both are searched for `--searches` infixes of words, filtered on the rooms of a user, like the API does.
+
+Needs Elasticsearch (or Elassandra), and the indices are deleted afterwards unless `--keep` is given. Run from the
+`/api` directory (`TESTING` keeps the app from connecting to the databases of the API):
+    TESTING=1 ELASTICSEARCH_URI=localhost python -m benchmarks.message_search --messages 1000000 10000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import string
+import time
+from uuid import uuid4
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+
+import app.util.elasticsearch as message_search
+from app.util.elasticsearch import MESSAGE_INDEX_SETTINGS, message_content_query
+
+LEGACY_INDEX = 'bench_messages_legacy'
+NGRAM_INDEX = 'bench_messages_ngram'
+DOC_TYPE = 'message'
+WORDS = [''.join(random.choices(string.ascii_lowercase, k=random.randint(3, 10))) for _ in range(50000)]
+
+
+def mappings(ngram):
+    content = {'type': 'text'}
+    if ngram:
+        content['fields'] = {'ngram': {'type': 'text', 'analyzer': 'content_ngram'}}
+    return {DOC_TYPE: {'properties': {'content': content, 'room_id': {'type': 'keyword'}}}}
+
+
+def messages(count, rooms):
+    for _ in range(count):
+        yield {
+            'room_id': random.choice(rooms),
+            'content': ' '.join(random.choices(WORDS, k=random.randint(3, 20))),
+        }
+
+
+async def index_messages(es, count, rooms, chunk_size):
+    def actions(index, docs):
+        for doc in docs:
+            yield {'_index': index, '_type': DOC_TYPE, '_source': doc}
+
+    batch = []
+    for doc in messages(count, rooms):
+        batch.append(doc)
+        if len(batch) == chunk_size * 10:
+            await async_bulk(es, actions(LEGACY_INDEX, batch), chunk_size=chunk_size)
+            await async_bulk(es, actions(NGRAM_INDEX, batch), chunk_size=chunk_size)
+            batch = []
+    if batch:
+        await async_bulk(es, actions(LEGACY_INDEX, batch), chunk_size=chunk_size)
+        await async_bulk(es, actions(NGRAM_INDEX, batch), chunk_size=chunk_size)
+    await es.indices.refresh(index=f'{LEGACY_INDEX},{NGRAM_INDEX}')
+
+
+async def measure(name, es, index, ngram, terms, rooms, user_rooms):
+    message_search.ngram_content_search = ngram
+    latencies, hits = [], 0
+    for term in terms:
+        body = {
+            'query': {
+                'bool': {
+                    'must': [message_content_query(term)],
+                    'filter': [{'terms': {'room_id': random.sample(rooms, user_rooms)}}],
+                }
+            }
+        }
+        start = time.perf_counter()
+        response = await es.search(index=index, body=body)
+        latencies.append(time.perf_counter() - start)
+        hits += len(response['hits']['hits'])
+
+    latencies.sort()
+    print(f'  {name:<9} p50 {statistics.median(latencies) * 1000:>8.1f} ms  '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:>8.1f} ms  {hits / len(terms):>5.1f} hits/search')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--user-rooms', type=int, default=20)
+    parser.add_argument('--searches', type=int, default=200)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--keep', action='store_true', help='do not delete the indices afterwards')
+    args = parser.parse_args()
+
+    es = AsyncElasticsearch(f'http://{os.environ["ELASTICSEARCH_URI"]}:{os.environ.get("ELASTICSEARCH_PORT", 9200)}',
+                            request_timeout=300)
+    rooms = [str(uuid4()) for _ in range(args.rooms)]
+    # infixes of words, e.g. `ell` of `hello`
+    terms = []
+    for word in random.sample(WORDS, args.searches):
+        start = random.randint(0, len(word) - 3)
+        terms.append(word[start:start + random.randint(3, len(word) - start)])
+
+    try:
+        for index, ngram in ((LEGACY_INDEX, False), (NGRAM_INDEX, True)):
+            if not await es.indices.exists(index=index):
+                await es.indices.create(index=index, settings=MESSAGE_INDEX_SETTINGS, mappings=mappings(ngram))
+
+        indexed = 0
+        for size in sorted(args.messages):
+            started = time.perf_counter()
+            await index_messages(es, size - indexed, rooms, args.chunk_size)
+            print(f'{size} messages (indexed {size - indexed} in {time.perf_counter() - started:.0f} s)')
+            indexed = size
+            await measure('wildcard', es, LEGACY_INDEX, False, terms, rooms, args.user_rooms)
+            await measure('trigram', es, NGRAM_INDEX, True, terms, rooms, args.user_rooms)
+    finally:
+        if not args.keep:
+            await es.indices.delete(index=f'{LEGACY_INDEX},{NGRAM_INDEX}', ignore_unavailable=True)
+        await es.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Microbenchmark of the serialization of messages, in rows per second.
+
+Compares the pydantic path (a `MessageSchema` per row, validated again as response model by FastAPI and encoded with
+`jsonable_encoder` and json) with the `MessageEncoder`, for a page of `get_messages` and for the payload of a new
+message sent over the websocket.
+
+Does not need any database. Run from the `/api` directory:
+    python -m benchmarks.message_serialization --rows 50 --repeat 2000
+"""
+import argparse
+from datetime import datetime
+import json
+import time
+from uuid import uuid4
+
+from cassandra.util import Date, Time
+from fastapi.encoders import jsonable_encoder
+
+from app.models import Message
+from app.schemas.message import MessageFetchSchema, MessageSchema
+from app.util.serialization import message_encoder, websocket_message_encoder
+
+
+def build_row(i):
+    now = datetime.utcnow()
+    return {
+        'room_id': uuid4(), 'index_id': now, 'uuid': uuid4(), 'sender_id': uuid4(), 'content': f'message {i}',
+        'username': 'bench', 'date': Date(now.date()), 'stamp': Time(now.time()), 'saved': True,
+        'distributed': True, 'seen': False, 'deleted': False, 'failure': False, 'reply_message': None,
+    }
+
+
+def page_pydantic(rows):
+    def result_to_schema(result):
+        result = dict(result)
+        result['date'] = result['date'].date().strftime('%d-%m-%Y')
+        result['time_stamp'] = result['stamp'].time().strftime('%H:%M:%S')
+        return MessageSchema(**result)
+
+    messages = [result_to_schema(row) for row in rows]
+    response = MessageFetchSchema(messages=messages, count=len(messages), paging_state=None)
+    # FastAPI validates the returned value against the response model, and encodes it by alias
+    response = MessageFetchSchema.validate(response)
+    return json.dumps(jsonable_encoder(response, by_alias=True)).encode()
+
+
+def page_encoder(rows):
+    return message_encoder.encode_page(rows, None)
+
+
+def payload_pydantic(message):
+    message_schema = MessageSchema.from_orm(message).dict(by_alias=True)
+    message_schema['_id'] = str(message_schema['_id'])
+    message_schema['indexId'] = message_schema['indexId'].strftime('%Y-%m-%d %H:%M:%S.%f')
+    message_schema['senderId'] = str(message_schema['senderId'])
+    message_schema['date'] = message_schema['date'].strftime('%d-%m-%Y')
+    message_schema['time_stamp'] = message_schema['time_stamp'].strftime('%H:%M:%S')
+    return json.dumps(message_schema).encode()
+
+
+def payload_encoder(message):
+    return websocket_message_encoder.encode(message)
+
+
+def measure(name, func, argument, rows_per_call, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(argument)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<20} {rows_per_call * repeat / elapsed:>12.0f} rows/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = [build_row(i) for i in range(args.rows)]
+    now = datetime.utcnow()
+    message = Message(
+        uuid=uuid4(), room_id=uuid4(), sender_id=uuid4(), content='message', username='bench',
+        index_id=now, message_date=now.date(), message_stamp=now.time(), saved=True,
+    )
+
+    print(f'get_messages, pages of {args.rows} rows')
+    measure('pydantic', page_pydantic, rows, args.rows, args.repeat)
+    measure('encoder', page_encoder, rows, args.rows, args.repeat)
+    print('websocket new_message payload')
+    measure('pydantic', payload_pydantic, message, 1, args.repeat * args.rows)
+    measure('encoder', payload_encoder, message, 1, args.repeat * args.rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Microbenchmark of the per-request overhead of the Prometheus middleware, in microseconds per request.
+
+Compares an app without metrics, the previous `BaseHTTPMiddleware` implementation (which resolves the route template
+by matching every route on every request) and the pure ASGI `PrometheusMiddleware` (which resolves it once per path
+shape). The app has the routes of the API, with endpoints that return right away, and requests are sent to it as ASGI
+calls, so only the middleware overhead is measured.
+
+Does not need any database. Run from the `/api` directory:
+    python -m benchmarks.prometheus_middleware --requests 20000
+"""
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response
+from starlette.routing import Match, Route
+
+from app.util.monitoring import REQUESTS, REQUESTS_PROCESSING_TIME, RESPONSES, PrometheusMiddleware
+
+ROUTES = [
+    ('GET', '/healthz'), ('POST', '/users'), ('POST', '/users/login'), ('POST', '/users/login/admin'),
+    ('POST', '/users/logout'), ('GET', '/users/{user_id}'), ('GET', '/rooms'), ('POST', '/rooms'),
+    ('POST', '/rooms/join'), ('POST', '/rooms/{room_id}/leave'), ('GET', '/room/{room_id}/message'),
+    ('GET', '/search/messages/content'), ('GET', '/search/rooms/name'),
+]
+
+
+class BaseHTTPPrometheusMiddleware(BaseHTTPMiddleware):
+    """
+    The previous implementation, without the in-progress gauge and exceptions counter.
+    """
+
+    def __init__(self, app, app_name):
+        super().__init__(app)
+        self.app_name = app_name
+
+    async def dispatch(self, request, call_next):
+        method = request.method
+        path = None
+        for route in request.app.routes:
+            match, _ = route.matches(request.scope)
+            if match == Match.FULL:
+                path = route.path
+                break
+        if path is None:
+            return await call_next(request)
+        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
+        before_time = time.perf_counter()
+        response = await call_next(request)
+        REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
+            time.perf_counter() - before_time)
+        RESPONSES.labels(method=method, path=path, status_code=response.status_code, app_name=self.app_name).inc()
+        return response
+
+
+async def endpoint(request):
+    return Response(b'{}', media_type='application/json')
+
+
+def build_app(middleware):
+    app = Starlette(routes=[Route(path, endpoint, methods=[method]) for method, path in ROUTES])
+    if middleware is not None:
+        app.add_middleware(middleware, app_name='bench')
+    return app
+
+
+def build_scopes(count):
+    scopes = []
+    for i in range(count):
+        method, path = ROUTES[i % len(ROUTES)]
+        path = path.replace('{room_id}', str(uuid4())).replace('{user_id}', str(uuid4()))
+        scopes.append({
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'headers': [],
+            'server': ('bench', 80), 'client': ('bench', 1234),
+        })
+    return scopes
+
+
+async def request(app, scope):
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        # the client disconnects after the request, once the response has been sent
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        pass
+
+    await app(dict(scope), receive, send)
+
+
+async def measure(name, app, scopes):
+    # the app (and its middleware stack) is built on the first call
+    await request(app, scopes[0])
+    start = time.perf_counter()
+    for scope in scopes:
+        await request(app, scope)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<18} {elapsed / len(scopes) * 1e6:>8.1f} us/request')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    scopes = build_scopes(args.requests)
+    await measure('no middleware', build_app(None), scopes)
+    await measure('BaseHTTPMiddleware', build_app(BaseHTTPPrometheusMiddleware), scopes)
+    await measure('pure ASGI', build_app(PrometheusMiddleware), scopes)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
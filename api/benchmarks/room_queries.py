@@ -0,0 +1,72 @@
+"""
+Benchmark of the number of Neo4j queries it takes to load rooms together with their members.
+
+Compares the per-member lookups (`connected_users`, `User.get_status` and the typing relationship) with the single
+Cypher projection of `Room.load_members`.
+
+Requires a running Neo4j instance (see the docker-compose file in the root of the project) and the usual `NEO4J_*`
+environment variables. Run from the `/api` directory:
+    python -m benchmarks.room_queries --rooms 5 --members 200
+"""
+import argparse
+import time
+from unittest.mock import patch
+from uuid import uuid4
+
+from neomodel import db
+
+from app.models import Room, User
+from app.schemas.room import RoomSchema
+from app.schemas.user import UserSchema
+from benchmarks import setup_neo4j_connection
+
+
+def load_rooms_per_member(rooms):
+    """The way rooms were loaded before `Room.load_members`: one or more queries for every member."""
+    return [
+        (
+            [UserSchema.from_orm(user) for user in room.connected_users.all()],
+            [user for user in room.connected_users.all() if room.connected_users.relationship(user).is_typing],
+        )
+        for room in rooms
+    ]
+
+
+def load_rooms_projection(rooms):
+    Room.load_members(rooms)
+    return [RoomSchema.from_orm(room) for room in rooms]
+
+
+def measure(name, func, rooms):
+    with patch.object(db, 'cypher_query', wraps=db.cypher_query) as cypher_query:
+        start = time.perf_counter()
+        func(rooms)
+        elapsed = time.perf_counter() - start
+    print(f'{name:<12} {cypher_query.call_count:>8} queries {elapsed * 1000:>10.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--members', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_neo4j_connection()
+    prefix = f'bench-{uuid4().hex[:8]}'
+    rooms = [Room(room_name=f'{prefix}-{i}').save() for i in range(args.rooms)]
+    users = [User(username=f'{prefix}-{i}', hashed_password='-').save() for i in range(args.members)]
+    try:
+        for room in rooms:
+            for user in users:
+                room.connected_users.connect(user)
+
+        print(f'{args.rooms} rooms with {args.members} members each')
+        measure('per member', load_rooms_per_member, [Room.nodes.get(uuid=room.uuid) for room in rooms])
+        measure('projection', load_rooms_projection, [Room.nodes.get(uuid=room.uuid) for room in rooms])
+    finally:
+        db.cypher_query('MATCH (n) WHERE n.room_name STARTS WITH $prefix OR n.username STARTS WITH $prefix '
+                        'DETACH DELETE n', {'prefix': prefix})
+
+
+if __name__ == '__main__':
+    main()
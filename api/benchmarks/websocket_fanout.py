@@ -0,0 +1,70 @@
+"""
+Microbenchmark of the CPU time it takes to deliver a room message to the local connections of the room members.
+
+Compares encoding the message for every connection (`send_json`, like `WebSocketManager` does) with the encode-once
+frames of `EchoChatWebSocketManager`. The websockets do not send anything, so only the encoding and delivery overhead
+is measured.
+
+Does not need any broker. Run from the `/api` directory:
+    python -m benchmarks.websocket_fanout --members 10 100 1000 10000
+"""
+import argparse
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+from distributed_websocket import Message, WebSocketManager
+
+from app.util.websocket import EchoChatWebSocketManager, room_topic
+
+
+class NullWebSocket:
+    async def accept(self, *args, **kwargs):
+        pass
+
+    async def receive_json(self, *args, **kwargs):
+        pass
+
+    async def iter_json(self):
+        yield
+
+    async def send_json(self, data, *args, **kwargs):
+        json.dumps(data)  # what starlette does before sending
+
+    async def send_text(self, data):
+        pass
+
+
+async def measure(name, manager_class, members, repeat):
+    manager = manager_class('channel:bench', broker_url='memory://')
+    room_id = uuid4()
+    for _ in range(members):
+        connection = await manager.new_connection(NullWebSocket(), str(uuid4()))
+        connection.topics.add(room_topic(room_id))
+
+    message = Message(
+        typ='send', topic=room_topic(room_id),
+        data={'action': 'new_message', 'roomId': str(room_id), 'message': {'content': 'x' * 200, 'seen': False}},
+    )
+    start = time.process_time()
+    for _ in range(repeat):
+        await manager._send(message)
+    elapsed = time.process_time() - start
+    print(f'{name:<14} {members:>6} members {elapsed / repeat * 1000:>9.3f} ms/message '
+          f'{elapsed / repeat / members * 1e6:>7.2f} us/recipient')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    for members in args.members:
+        await measure('per recipient', WebSocketManager, members, args.repeat)
+        await measure('encode once', EchoChatWebSocketManager, members, args.repeat)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
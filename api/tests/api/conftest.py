@@ -43,7 +43,7 @@ def user_exists():
 
 @pytest.fixture
 def mock_get_user_by_username(user_exists):
-    with patch('app.routers.user.User.get_user_by_username') as mock:
+    with patch('app.repositories.user.User.get_user_by_username') as mock:
         def side_effect(username):
             if user_exists:
                 return User(uuid=uuid4(), username=username)
@@ -55,7 +55,7 @@ def mock_get_user_by_username(user_exists):
 
 @pytest.fixture
 def mock_get_user_by_id(user_exists):
-    with patch('app.routers.user.User.get_user_by_id') as mock:
+    with patch('app.repositories.user.User.get_user_by_id') as mock:
         def side_effect(user_id):
             if user_exists:
                 return User(uuid=user_id, username='test')
@@ -67,13 +67,13 @@ def mock_get_user_by_id(user_exists):
 
 @pytest.fixture
 def mock_user_save():
-    with patch('app.routers.user.User.save') as mock:
+    with patch('app.repositories.user.User.save') as mock:
         yield mock
 
 
 @pytest.fixture
 def mock_user_status_rel():
-    with patch('app.routers.user.UserSchema.from_orm') as mock:
+    with patch('app.repositories.user.UserSchema.from_orm') as mock:
         def side_effect(user):
             return UserSchema(
                 uuid=user.uuid,
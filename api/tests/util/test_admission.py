@@ -0,0 +1,23 @@
+from unittest.mock import patch
+
+from app.util.admission import TokenBucketLimiter
+
+
+def test_token_bucket_admits_bursts_at_the_rate():
+    now = [100.0]
+    with patch('app.util.admission.time.monotonic', lambda: now[0]):
+        limiter = TokenBucketLimiter(rate=10, burst=5)
+        assert [limiter.try_acquire() for _ in range(6)] == [True] * 5 + [False]
+        now[0] += 0.25
+        assert [limiter.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def test_retry_hints_are_spread_at_the_rate():
+    now = [100.0]
+    with patch('app.util.admission.time.monotonic', lambda: now[0]):
+        limiter = TokenBucketLimiter(rate=10, burst=1, max_retry_after=0.5, jitter=0)
+        assert limiter.try_acquire()
+        hints = [round(limiter.retry_after(), 3) for _ in range(6)]
+
+    # every rejected client gets its own slot, up to the maximum hint
+    assert hints == [0.1, 0.2, 0.3, 0.4, 0.5, 0.5]
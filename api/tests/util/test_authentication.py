@@ -0,0 +1,59 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+from uuid import UUID, uuid4
+
+from fastapi.security import SecurityScopes
+from jose import jwt
+from prometheus_client import REGISTRY
+
+from app.util.authentication import USER_SCOPES, create_jwt_token, get_jwt_user, verified_token_cache, \
+    verify_websocket_token
+
+
+def lookups(result):
+    return REGISTRY.get_sample_value('echochat_verified_token_cache_lookups_total', {'result': result}) or 0
+
+
+def test_verified_tokens_skip_decoding_and_the_user_lookup():
+    user_uuid = uuid4().hex
+    token = create_jwt_token(data={'sub': user_uuid, 'scopes': USER_SCOPES})
+    hits, misses = lookups('hit'), lookups('miss')
+
+    with patch('app.util.authentication.user_repository.get_by_id', AsyncMock(return_value=object())) as get_by_id, \
+            patch('app.util.authentication.jwt.decode', wraps=jwt.decode) as decode:
+        for _ in range(3):
+            assert asyncio.run(get_jwt_user(SecurityScopes(['get_rooms']), token)) == user_uuid
+
+    assert get_by_id.call_count == 1
+    assert decode.call_count == 1
+    assert (lookups('hit') - hits, lookups('miss') - misses) == (2, 1)
+
+
+def test_user_tokens_are_invalidated():
+    user_uuid = uuid4().hex
+    tokens = [create_jwt_token(data={'sub': user_uuid, 'scopes': USER_SCOPES, 'n': n}) for n in range(2)]
+    other_token = create_jwt_token(data={'sub': uuid4().hex, 'scopes': USER_SCOPES})
+
+    with patch('app.util.authentication.user_repository.get_by_id', AsyncMock(return_value=object())):
+        for token in tokens + [other_token]:
+            asyncio.run(get_jwt_user(SecurityScopes(), token))
+
+    verified_token_cache.invalidate(tokens[0])
+    assert verified_token_cache.get(tokens[0]) is None
+    assert verified_token_cache.invalidate_user(user_uuid) == 1
+    assert verified_token_cache.get(tokens[1]) is None
+    assert verified_token_cache.get(other_token) is not None
+
+
+def test_websocket_tokens_are_verified_without_the_user_lookup():
+    user_uuid = str(uuid4())
+    token = create_jwt_token(data={'sub': user_uuid, 'username': 'alice', 'scopes': USER_SCOPES})
+
+    with patch('app.util.authentication.user_repository.get_by_id', AsyncMock()) as get_by_id:
+        token_data = verify_websocket_token(token, user_uuid)
+        assert verify_websocket_token(token, str(uuid4())) is None
+        assert verify_websocket_token(token + 'x', user_uuid) is None
+        assert verify_websocket_token(None, user_uuid) is None
+
+    assert (token_data.user_uuid, token_data.username) == (UUID(user_uuid), 'alice')
+    get_by_id.assert_not_called()
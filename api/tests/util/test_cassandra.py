@@ -0,0 +1,185 @@
+import asyncio
+from datetime import datetime
+import threading
+from unittest.mock import patch
+from uuid import uuid4
+
+from cassandra.query import UNSET_VALUE, BatchType
+from prometheus_client import REGISTRY
+import pytest
+
+from app.repositories import message_repository
+from app.util.cassandra import MESSAGE_COLUMNS, MESSAGE_QUERIES, message_statements, to_asyncio_future
+
+
+class FakeResponseFuture:
+    """Completes from another thread, like the driver does from its event loop thread."""
+    def __init__(self, rows=None, exc=None):
+        self.rows = rows
+        self.exc = exc
+        self.has_more_pages = False
+        self._paging_state = None
+        self._col_names = None
+        self._col_types = None
+
+    def add_callbacks(self, callback, errback):
+        target = (lambda: errback(self.exc)) if self.exc else (lambda: callback(self.rows))
+        threading.Timer(0.01, target).start()
+
+
+def test_result_is_handed_over_to_the_event_loop():
+    async def run():
+        results = await to_asyncio_future(FakeResponseFuture(rows=[{'content': 'hi'}]))
+        assert results.current_rows == [{'content': 'hi'}]
+        assert results.paging_state is None
+
+    asyncio.run(run())
+
+
+def test_error_is_raised_in_the_event_loop():
+    async def run():
+        with pytest.raises(RuntimeError):
+            await to_asyncio_future(FakeResponseFuture(exc=RuntimeError('timeout')))
+
+    asyncio.run(run())
+
+
+class FakeBoundStatement:
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+        self.fetch_size = None
+
+
+class FakePreparedStatement:
+    def __init__(self, name):
+        self.name = name
+        self.query_id = name.encode()
+        self.fetch_size = None
+
+    def bind(self, parameters):
+        return FakeBoundStatement(self.name, parameters)
+
+
+class FakeSession:
+    """Records every execution and answers with the given rows."""
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executions = []
+
+    def execute_async(self, statement, parameters=None, **kwargs):
+        self.executions.append((statement, parameters, kwargs))
+        return FakeResponseFuture(rows=self.rows)
+
+    def prepare(self, query):
+        name = next(name for name, statement_query in MESSAGE_QUERIES.items() if statement_query == query)
+        return FakePreparedStatement(name)
+
+
+@pytest.fixture
+def session():
+    session = FakeSession()
+    statements = {name: FakePreparedStatement(name) for name in MESSAGE_QUERIES}
+    with patch.dict(message_statements.statements, statements, clear=True), \
+            patch('app.util.cassandra.cassandra_connection.get_session', return_value=session):
+        yield session
+
+
+def test_create_binds_all_columns_in_order_and_leaves_none_unset(session):
+    room_id, sender_id = uuid4(), uuid4()
+
+    message = asyncio.run(message_repository.create(
+        uuid=uuid4(), room_id=room_id, index_id=datetime.utcnow(), sender_id=str(sender_id), content='hi',
+        message_date=datetime.utcnow().date(), message_stamp=datetime.utcnow().time(),
+    ))
+
+    statement, _, _ = session.executions[0]
+    parameters = statement.parameters
+    assert statement.name == 'insert_message'
+    assert [column for _, column in MESSAGE_COLUMNS][6:8] == ['date', 'stamp']
+    assert len(parameters) == len(MESSAGE_COLUMNS)
+    by_column = dict(zip((column for _, column in MESSAGE_COLUMNS), parameters))
+    assert by_column['room_id'] == room_id
+    assert by_column['sender_id'] == sender_id
+    assert by_column['date'] == message.message_date
+    assert by_column['seen'] is False
+    assert by_column['username'] is UNSET_VALUE
+    assert by_column['reply_message'] is UNSET_VALUE
+
+
+class FakeBatchStatement:
+    def __init__(self, batch_type):
+        self.batch_type = batch_type
+        self.statements = []
+
+    def add(self, statement, parameters):
+        self.statements.append((statement, parameters))
+
+
+def test_create_many_writes_one_unlogged_batch(session):
+    room_id = uuid4()
+    messages = [
+        message_repository.build(
+            uuid=uuid4(), room_id=room_id, index_id=datetime.utcnow(), sender_id=uuid4(), content=str(i),
+            message_date=datetime.utcnow().date(), message_stamp=datetime.utcnow().time(),
+        )
+        for i in range(3)
+    ]
+
+    with patch('app.util.cassandra.BatchStatement', FakeBatchStatement):
+        asyncio.run(message_repository.create_many(messages))
+
+    assert len(session.executions) == 1
+    batch = session.executions[0][0]
+    assert batch.batch_type == BatchType.UNLOGGED
+    assert [statement.name for statement, _ in batch.statements] == ['insert_message'] * 3
+    content_index = [column for _, column in MESSAGE_COLUMNS].index('content')
+    assert [parameters[content_index] for _, parameters in batch.statements] == ['0', '1', '2']
+
+
+def test_get_constructs_message_from_row(session):
+    room_id, uuid, index_id = uuid4(), uuid4(), datetime(2022, 11, 1, 12)
+    session.rows = [{'room_id': room_id, 'index_id': index_id, 'uuid': uuid, 'sender_id': uuid4(),
+                     'content': 'hi', 'seen': True}]
+
+    message = asyncio.run(message_repository.get(room_id, index_id, uuid))
+
+    assert session.executions[0][0].name == 'get_message'
+    assert session.executions[0][0].parameters == [room_id, index_id, uuid]
+    assert message.uuid == uuid and message.seen is True
+
+
+def test_get_returns_none_for_missing_message(session):
+    assert asyncio.run(message_repository.get(uuid4(), datetime.utcnow(), uuid4())) is None
+
+
+def test_get_page_sets_page_size_on_the_bound_statement_only(session):
+    room_id = uuid4()
+
+    asyncio.run(message_repository.get_page(room_id, 20, paging_state=b'\x01'))
+
+    statement, _, kwargs = session.executions[0]
+    assert statement.parameters == [room_id]
+    assert statement.fetch_size == 20
+    assert kwargs['paging_state'] == b'\x01'
+    assert message_statements.statements['get_messages'].fetch_size is None
+
+
+def test_registry_prepares_missing_statements_on_demand(session):
+    def lookups(result):
+        return REGISTRY.get_sample_value(
+            'echochat_cassandra_statement_lookups_total', {'statement': 'get_message', 'result': result}
+        ) or 0
+
+    del message_statements.statements['get_message']
+    hits, misses = lookups('hit'), lookups('miss')
+
+    asyncio.run(message_repository.get(uuid4(), datetime.utcnow(), uuid4()))
+    asyncio.run(message_repository.get(uuid4(), datetime.utcnow(), uuid4()))
+
+    assert [statement.name for statement, _, _ in session.executions] == ['get_message', 'get_message']
+    assert lookups('miss') == misses + 1
+    assert lookups('hit') == hits + 1
+    assert REGISTRY.get_sample_value(
+        'echochat_cassandra_statement_duration_seconds_count', {'statement': 'get_message'}
+    ) >= 2
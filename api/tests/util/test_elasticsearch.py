@@ -0,0 +1,55 @@
+import asyncio
+from unittest.mock import patch
+
+from app.util import elasticsearch
+from app.util.elasticsearch import LEGACY_MESSAGE_INDEX, MESSAGE_INDEX, message_content_query, message_index, \
+    setup_elasticsearch
+
+
+class FakeIndices:
+    def __init__(self, counts):
+        self.counts = counts
+        self.aliases = {}
+
+    async def exists(self, index):
+        return index in self.counts
+
+    async def create(self, index, settings, mappings):
+        self.counts[index] = 0
+
+    async def exists_alias(self, name):
+        return name in self.aliases
+
+    async def update_aliases(self, actions):
+        for action in actions:
+            if 'remove' in action:
+                del self.aliases[action['remove']['alias']]
+            else:
+                self.aliases[action['add']['alias']] = action['add']['index']
+
+
+class FakeElasticsearch:
+    def __init__(self, counts):
+        self.indices = FakeIndices(counts)
+
+    async def count(self, index):
+        return {'count': self.indices.counts[index]}
+
+
+def test_search_moves_to_the_ngram_index_once_it_caught_up():
+    es = FakeElasticsearch({LEGACY_MESSAGE_INDEX: 10})
+    with patch.object(elasticsearch, 'es', es):
+        asyncio.run(setup_elasticsearch())
+        assert es.indices.aliases == {message_index: LEGACY_MESSAGE_INDEX}
+        assert 'query_string' in message_content_query('ell')
+
+        es.indices.counts[MESSAGE_INDEX] = 10
+        asyncio.run(setup_elasticsearch())
+        assert es.indices.aliases == {message_index: MESSAGE_INDEX}
+        assert message_content_query('ell')['bool']['must'] == [
+            {'match': {'content.ngram': {'query': 'ell', 'operator': 'and'}}}
+        ]
+        # too short for a trigram
+        assert message_content_query('he') == {'match_phrase_prefix': {'content': {'query': 'he'}}}
+
+    elasticsearch.ngram_content_search = False
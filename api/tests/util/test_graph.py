@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+
+from prometheus_client import REGISTRY
+
+from app.util.graph import GraphExecutor
+
+
+def test_graph_executor_runs_operations_off_the_event_loop():
+    async def run():
+        executor = GraphExecutor(max_workers=2)
+        loop_thread = threading.current_thread()
+
+        def operation(value, *, offset):
+            return threading.current_thread(), value + offset
+
+        thread, result = await executor.run(operation, 1, offset=2)
+        executor.shutdown()
+        return loop_thread, thread, result
+
+    loop_thread, thread, result = asyncio.run(run())
+    assert result == 3
+    assert thread is not loop_thread
+    assert thread.name.startswith('neo4j')
+
+
+def test_graph_executor_limits_concurrency():
+    async def run():
+        executor = GraphExecutor(max_workers=2)
+        running, max_running = 0, 0
+        lock = threading.Lock()
+
+        def operation():
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            time.sleep(0.02)
+            with lock:
+                running -= 1
+
+        await asyncio.gather(*(executor.run(operation) for _ in range(6)))
+        executor.shutdown()
+        return max_running
+
+    assert asyncio.run(run()) == 2
+    assert REGISTRY.get_sample_value('echochat_graph_queries_waiting') == 0
+    assert REGISTRY.get_sample_value('echochat_graph_queries_in_progress') == 0
@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+
+from app.models import Message
+from app.util.ingestion import IngestionQueueFull, MessageIngestionQueue
+
+
+def build_message(room_id):
+    return Message(uuid=uuid4(), room_id=room_id, index_id=datetime.utcnow(), sender_id=uuid4(), content='hi')
+
+
+def test_pending_messages_are_batched_per_room():
+    async def run():
+        batches = []
+
+        async def write_batch(messages):
+            batches.append(messages)
+
+        queue = MessageIngestionQueue(write_batch, batch_size=2)
+        queue.start()
+        busy_room, quiet_room = uuid4(), uuid4()
+        messages = [build_message(busy_room) for _ in range(3)] + [build_message(quiet_room)]
+        await asyncio.gather(*(queue.submit(message) for message in messages))
+        await queue.stop()
+        return busy_room, quiet_room, batches
+
+    busy_room, quiet_room, batches = asyncio.run(run())
+    assert sorted(len(batch) for batch in batches) == [1, 1, 2]
+    assert all(len({message.room_id for message in batch}) == 1 for batch in batches)
+    assert sum(1 for batch in batches if batch[0].room_id == busy_room) == 2
+
+
+def test_submit_waits_for_the_write_and_raises_its_error():
+    async def run():
+        release = asyncio.Event()
+
+        async def write_batch(messages):
+            await release.wait()
+            raise RuntimeError('write timeout')
+
+        queue = MessageIngestionQueue(write_batch)
+        queue.start()
+        submit = asyncio.create_task(queue.submit(build_message(uuid4())))
+        await asyncio.sleep(0.01)
+        assert not submit.done()  # not acknowledged yet
+
+        release.set()
+        with pytest.raises(RuntimeError):
+            await submit
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_full_queue_applies_backpressure():
+    async def run():
+        release = asyncio.Event()
+
+        async def write_batch(messages):
+            await release.wait()
+
+        queue = MessageIngestionQueue(write_batch, maxsize=1, max_in_flight=1, submit_timeout=0.05)
+        queue.start()
+        room_id = uuid4()
+        in_flight = asyncio.create_task(queue.submit(build_message(room_id)))
+        await asyncio.sleep(0)  # taken from the queue, its write holds the only in-flight slot
+        queued = asyncio.create_task(queue.submit(build_message(room_id)))
+        await asyncio.sleep(0)  # taken from the queue, waiting for the in-flight slot
+        waiting = asyncio.create_task(queue.submit(build_message(room_id)))
+        await asyncio.sleep(0)  # fills the queue
+
+        with pytest.raises(IngestionQueueFull):
+            await queue.submit(build_message(room_id))
+
+        release.set()
+        await asyncio.gather(in_flight, queued, waiting)
+        await queue.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+from unittest.mock import patch
+from uuid import uuid4
+
+from app.util import membership
+from app.util.membership import get_room_member_ids, get_user_room_ids, invalidate_room_members, \
+    invalidate_user_rooms
+
+
+def test_user_rooms_are_cached_until_invalidated():
+    user_id, room_id = uuid4(), uuid4().hex
+    rooms = {str(user_id): frozenset([room_id])}
+    loads = []
+
+    async def get_users_room_ids(user_ids):
+        loads.append(user_ids)
+        loaded = dict(rooms)
+        if len(loads) == 2:
+            # the user joins a room while its rooms are being loaded
+            invalidate_user_rooms(user_id)
+        return loaded
+
+    async def main():
+        with patch.object(membership, 'get_users_room_ids', get_users_room_ids):
+            assert await get_user_room_ids(user_id.hex) == {room_id}
+            assert await get_user_room_ids(user_id) == {room_id}
+            assert len(loads) == 1
+
+            invalidate_user_rooms(str(user_id))
+            assert await get_user_room_ids(user_id) == {room_id}
+            # loaded before the invalidation, so not cached
+            assert await get_user_room_ids(user_id) == {room_id}
+            assert len(loads) == 3
+
+    asyncio.run(main())
+    membership.user_rooms_cache.clear()
+
+
+def test_room_members_loaded_while_invalidated_are_not_cached():
+    room_id, user_id = uuid4(), uuid4()
+    queries = []
+
+    class FakeGraphExecutor:
+        async def run(self, func, query, params):
+            queries.append(params)
+            if len(queries) == 1:
+                # the user joins the room while the query is pending
+                invalidate_room_members(room_id)
+            return [(room_id.hex, [user_id.hex])], None
+
+    async def main():
+        with patch.object(membership, 'graph_executor', FakeGraphExecutor()):
+            assert await get_room_member_ids(room_id) == {str(user_id)}
+            assert await get_room_member_ids(room_id) == {str(user_id)}
+            assert len(queries) == 2
+            # loaded after the invalidation, so cached
+            assert await get_room_member_ids(room_id.hex) == {str(user_id)}
+            assert len(queries) == 2
+
+    asyncio.run(main())
+    membership.room_members_cache.clear()
@@ -0,0 +1,57 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+from prometheus_client import REGISTRY
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.testclient import TestClient
+
+from app.util.monitoring import PrometheusMiddleware
+
+
+async def endpoint(request):
+    return PlainTextResponse('ok', status_code=201 if request.method == 'POST' else 200)
+
+
+async def websocket_endpoint(websocket):
+    await websocket.accept()
+    await websocket.send_text('ok')
+    await websocket.close()
+
+
+def build_client():
+    app = Starlette(routes=[
+        Route('/rooms/{room_id}/leave', endpoint, methods=['POST']),
+        WebSocketRoute('/ws/{conn_id}', websocket_endpoint),
+    ])
+    app.add_middleware(PrometheusMiddleware, app_name='test-monitoring')
+    return TestClient(app)
+
+
+def responses(status_code):
+    return REGISTRY.get_sample_value('fastapi_responses_total', {
+        'method': 'POST', 'path': '/rooms/{room_id}/leave', 'status_code': str(status_code),
+        'app_name': 'test-monitoring',
+    }) or 0
+
+
+def test_route_templates_are_resolved_once_per_path_shape():
+    client = build_client()
+    with patch.object(PrometheusMiddleware, 'get_path', wraps=PrometheusMiddleware.get_path) as get_path:
+        for _ in range(3):
+            assert client.post(f'/rooms/{uuid4()}/leave').status_code == 201
+        client.get('/unknown')
+        client.get('/unknown')
+
+    assert get_path.call_count == 2
+    assert responses(201) == 3
+
+
+def test_websocket_scopes_are_passed_on():
+    client = build_client()
+    with patch.object(PrometheusMiddleware, 'get_path') as get_path:
+        with client.websocket_connect(f'/ws/{uuid4()}') as websocket:
+            assert websocket.receive_text() == 'ok'
+
+    get_path.assert_not_called()
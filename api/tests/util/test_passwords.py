@@ -0,0 +1,43 @@
+import asyncio
+
+from passlib.context import CryptContext
+
+from app.util.passwords import PasswordHasher, PasswordHasherBusy
+
+# a cheap hash, the cost of bcrypt does not matter here
+HASHED_PASSWORD = CryptContext(schemes=['bcrypt'], bcrypt__rounds=4).hash('password')
+
+
+def test_password_hasher_verifies_in_a_worker_process():
+    async def run():
+        hasher = PasswordHasher(max_workers=1, max_pending=2)
+        try:
+            return await asyncio.gather(
+                hasher.verify('password', HASHED_PASSWORD),
+                hasher.verify('wrong', HASHED_PASSWORD),
+            )
+        finally:
+            hasher.shutdown()
+
+    assert asyncio.run(run()) == [True, False]
+
+
+def test_password_hasher_rejects_when_saturated():
+    async def run():
+        hasher = PasswordHasher(max_workers=1, max_pending=1)
+        try:
+            results = await asyncio.gather(
+                hasher.verify('password', HASHED_PASSWORD),
+                hasher.verify('password', HASHED_PASSWORD),
+                return_exceptions=True,
+            )
+            # the rejected operation did not take the place of a new one
+            results.append(await hasher.verify('password', HASHED_PASSWORD))
+            return results, hasher.pending
+        finally:
+            hasher.shutdown()
+
+    (first, second, third), pending = asyncio.run(run())
+    assert first is True and third is True
+    assert isinstance(second, PasswordHasherBusy)
+    assert pending == 0
@@ -0,0 +1,197 @@
+import asyncio
+from datetime import datetime
+import time
+
+from app.util.presence import PRESENCE_DEADLINES_KEY, PresenceService, RedisPresenceStore
+
+
+class FakePresenceStore:
+    """Shared by the services of multiple nodes, a user is online while any node has it connected."""
+    def __init__(self):
+        self.nodes = {}
+        self.crashed = set()
+
+    def for_node(self, node_id):
+        store = self
+
+        class NodeStore:
+            async def connect(self, user_ids, changed_at):
+                return {user_id for user_id in user_ids if store._set(user_id, node_id, True)}
+
+            async def disconnect(self, user_ids, changed_at):
+                return {user_id for user_id in user_ids if store._set(user_id, node_id, False)}
+
+            async def heartbeat(self, user_ids):
+                pass
+
+            async def reap(self, changed_at):
+                reaped, store.crashed = store.crashed, set()
+                return {user_id for user_id in reaped if store._set(user_id, 'crashed-node', False)}
+
+        return NodeStore()
+
+    def _set(self, user_id, node_id, connected):
+        nodes = self.nodes.setdefault(user_id, set())
+        was_online = bool(nodes)
+        (nodes.add if connected else nodes.discard)(node_id)
+        return was_online != bool(nodes)
+
+
+def create_service(store, published, contacts, node_id='node-1', **kwargs):
+    async def resolve_recipients(user_ids):
+        return {user_id: contacts[user_id] for user_id in user_ids}
+
+    async def publish(recipients, updates):
+        published.append((recipients, {update['userId']: update['props']['status']['state'] for update in updates}))
+
+    return PresenceService(
+        store.for_node(node_id), resolve_recipients, publish, grace_period=0.05, tick=0.01, **kwargs
+    )
+
+
+def test_changes_are_sent_as_one_frame_per_recipient():
+    published = []
+    contacts = {'alice': {'carol', 'dave'}, 'bob': {'carol'}}
+    service = create_service(FakePresenceStore(), published, contacts)
+
+    service.connected('alice')
+    service.connected('bob')
+    asyncio.run(service.run_tick())
+
+    assert sorted(published) == [
+        (['carol'], {'alice': 'online', 'bob': 'online'}),
+        (['dave'], {'alice': 'online'}),
+    ]
+
+
+def test_reconnect_within_the_grace_period_is_not_announced():
+    async def run():
+        published = []
+        service = create_service(FakePresenceStore(), published, {'alice': {'bob'}})
+        service.connected('alice')
+        await service.run_tick()
+
+        service.disconnected('alice')
+        await service.run_tick()  # still within the grace period
+        service.connected('alice')
+        await asyncio.sleep(0.06)
+        await service.run_tick()
+        flapped = list(published)
+
+        service.disconnected('alice')
+        await asyncio.sleep(0.06)
+        await service.run_tick()
+        return flapped, published
+
+    flapped, published = asyncio.run(run())
+    assert flapped == [(['bob'], {'alice': 'online'})]
+    assert published[-1] == (['bob'], {'alice': 'offline'})
+
+
+def test_user_connected_to_another_node_stays_online():
+    async def run():
+        store, published = FakePresenceStore(), []
+        first = create_service(store, published, {'alice': {'bob'}}, node_id='node-1')
+        second = create_service(store, published, {'alice': {'bob'}}, node_id='node-2')
+        first.connected('alice')
+        second.connected('alice')
+        await first.run_tick()
+        await second.run_tick()
+
+        first.disconnected('alice')
+        await asyncio.sleep(0.06)
+        await first.run_tick()
+        return published
+
+    assert asyncio.run(run()) == [(['bob'], {'alice': 'online'})]
+
+
+def test_users_of_a_crashed_node_are_reaped_and_snapshotted_in_batches():
+    async def run():
+        store, published, snapshots = FakePresenceStore(), [], []
+
+        async def save_snapshot(statuses):
+            snapshots.append({user_id: state.value for user_id, (state, _) in statuses.items()})
+
+        service = create_service(
+            store, published, {'alice': {'carol'}, 'bob': {'carol'}},
+            heartbeat_interval=0, save_snapshot=save_snapshot, snapshot_interval=60,
+        )
+        store._set('bob', 'crashed-node', True)
+        store.crashed.add('bob')
+        service.connected('alice')
+        await service.run_tick()
+        service.disconnected('alice')
+        await asyncio.sleep(0.06)
+        await service.run_tick()
+        unsaved = list(snapshots)  # the snapshot interval has not passed yet
+
+        await service.stop()
+        return published, unsaved, snapshots
+
+    published, unsaved, snapshots = asyncio.run(run())
+    assert published == [(['carol'], {'alice': 'online', 'bob': 'offline'}), (['carol'], {'alice': 'offline'})]
+    assert unsaved == []
+    assert snapshots == [{'alice': 'offline', 'bob': 'offline'}]
+
+
+class FakeRedis:
+    """Records the script calls, and keeps the deadlines zset."""
+    def __init__(self):
+        self.deadlines = {}
+        self.calls = []
+
+    def register_script(self, script):
+        async def run(keys, args, client):
+            client.results.append(1)
+            self.calls.append((keys, args))
+        return run
+
+    def pipeline(self, transaction):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.results = []
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+            def hset(self, *args):
+                pass
+
+            def expire(self, *args):
+                pass
+
+            def zadd(self, key, mapping):
+                redis.deadlines.update(mapping)
+
+            async def execute(self):
+                results, self.results = self.results, []
+                return results
+
+        return Pipeline()
+
+    async def zrangebyscore(self, key, low, high, start, num):
+        assert key == PRESENCE_DEADLINES_KEY
+        return [member.encode() for member, deadline in self.deadlines.items() if deadline <= high][start:start + num]
+
+
+def test_reap_only_runs_for_connections_that_missed_their_deadline():
+    async def run():
+        redis = FakeRedis()
+        live, crashed = RedisPresenceStore(redis, node_id='live'), RedisPresenceStore(redis, node_id='crashed')
+        await live.heartbeat([f'user-{i}' for i in range(100)])
+        await crashed.heartbeat(['bob', 'carol'])
+        redis.deadlines.update({'crashed:bob': time.time() - 1, 'crashed:carol': time.time() - 1})
+        return redis, await live.reap(datetime.utcnow())
+
+    redis, reaped = asyncio.run(run())
+    assert reaped == {'bob', 'carol'}
+    assert [(keys[0], args[0], args[-2:]) for keys, args in redis.calls] == [
+        ('presence:user:bob', 'node:crashed', ['crashed:bob', 1]),
+        ('presence:user:carol', 'node:crashed', ['crashed:carol', 1]),
+    ]
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from app.util.read_cursors import ReadCursorCoalescer, apply_read_cursors
+
+
+def test_cursors_are_coalesced_per_room():
+    async def run():
+        writes, published = [], []
+
+        async def write(room_id, cursors):
+            writes.append((room_id, dict(cursors)))
+
+        async def publish(room_id, cursors):
+            published.append((room_id, dict(cursors)))
+
+        coalescer = ReadCursorCoalescer(write, publish, window=0.01)
+        room_id, alice, bob = uuid4(), uuid4(), uuid4()
+        now = datetime.utcnow()
+        for seconds in (1, 3, 2):
+            coalescer.advance(room_id, alice, now + timedelta(seconds=seconds))
+        coalescer.advance(room_id, bob, now)
+        await asyncio.sleep(0.05)
+        await coalescer.stop()
+        return room_id, {alice: now + timedelta(seconds=3), bob: now}, writes, published
+
+    room_id, expected, writes, published = asyncio.run(run())
+    assert writes == [(room_id, expected)]
+    assert published == [(room_id, expected)]
+
+
+def test_cursors_are_not_published_when_the_write_fails():
+    async def run():
+        published = []
+
+        async def write(room_id, cursors):
+            raise RuntimeError('write timeout')
+
+        async def publish(room_id, cursors):
+            published.append(room_id)
+
+        coalescer = ReadCursorCoalescer(write, publish, window=60)
+        coalescer.advance(uuid4(), uuid4(), datetime.utcnow())
+        await coalescer.stop()  # flushes without waiting for the window
+        return published
+
+    assert asyncio.run(run()) == []
+
+
+def test_seen_is_derived_from_the_cursors_of_other_members():
+    alice, bob = uuid4(), uuid4()
+    now = datetime.utcnow()
+    rows = [
+        {'sender_id': alice, 'index_id': now, 'seen': False, 'distributed': False},
+        {'sender_id': bob, 'index_id': now + timedelta(seconds=1), 'seen': False, 'distributed': False},
+        {'sender_id': alice, 'index_id': now + timedelta(seconds=2), 'seen': False, 'distributed': False},
+    ]
+    # bob read up to the second message, alice read everything (but her own messages are not seen by her cursor)
+    apply_read_cursors(rows, {bob: now + timedelta(seconds=1), alice: now + timedelta(seconds=2)})
+    assert [row['seen'] for row in rows] == [True, True, False]
+    assert rows[0]['distributed'] and not rows[2]['distributed']
@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+from unittest.mock import patch
+from uuid import UUID, uuid4
+
+from app.models import Room
+from app.models import room as room_module
+from app.models.enums import UserStates
+
+
+def member(**values):
+    return {
+        'uuid': uuid4().hex, 'username': 'alice', 'is_admin': None, 'state': None, 'last_changed': None,
+        'is_typing': None, **values,
+    }
+
+
+def test_members_of_rooms_are_loaded_with_one_query():
+    changed = datetime(2022, 11, 1, 12, 30, tzinfo=timezone.utc)
+    alice = member(username='alice', is_admin=True, state=UserStates.ONLINE.value,
+                   last_changed=changed.timestamp(), is_typing=True)
+    # a status without the time of the change, and a user without a status at all
+    bob = member(username='bob', state=UserStates.OFFLINE.value)
+    carol = member(username='carol', last_changed=changed.timestamp(), is_typing=False)
+    full, empty, missing = Room(uuid=uuid4().hex), Room(uuid=uuid4().hex), Room(uuid=uuid4().hex)
+    queries = []
+
+    class FakeDatabase:
+        def cypher_query(self, query, params):
+            queries.append((query, params))
+            # a room without members is a single row with an empty projection (nulls of the OPTIONAL MATCH are
+            # dropped by the CASE), rooms that do not exist have no row at all
+            return [(full.uuid, [alice, bob, carol]), (empty.uuid, [])], None
+
+    with patch.object(room_module, 'db', FakeDatabase()):
+        Room.load_members([full, empty, missing])
+        users, typing_users = full.users, full.typing_users
+
+    assert queries == [(room_module.ROOM_MEMBERS_QUERY, {'room_uuids': [full.uuid, empty.uuid, missing.uuid]})]
+    assert [user.username for user in users] == ['alice', 'bob', 'carol']
+    assert [user.username for user in typing_users] == ['alice']
+    assert [str(user.uuid) for user in users] == [str(UUID(m['uuid'])) for m in (alice, bob, carol)]
+    assert [user.is_admin for user in users] == [True, False, False]
+    assert [(user.status.state, user.status.last_changed) for user in users] == [
+        (UserStates.ONLINE, changed),
+        (UserStates.OFFLINE, None),
+        # users without a status are offline, a dangling time of change is ignored
+        (UserStates.OFFLINE, None),
+    ]
+    assert empty.users == [] and empty.typing_users == []
+    assert missing.users == []
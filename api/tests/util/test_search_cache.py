@@ -0,0 +1,48 @@
+import asyncio
+from uuid import uuid4
+
+from app.util.search_cache import SearchResultCache
+
+
+class FakeRoomVersions:
+    def __init__(self, clock):
+        self.clock = clock
+        self.versions = {}
+        self.writes = {}
+
+    async def bump(self, room_id):
+        self.versions[room_id] = self.versions.get(room_id, 0) + 1
+        self.writes[room_id] = self.clock[0]
+
+    async def get(self, room_ids):
+        return (
+            tuple(self.versions.get(room_id, 0) for room_id in room_ids),
+            max((self.writes[room_id] for room_id in room_ids if room_id in self.writes), default=0.0),
+        )
+
+
+def test_results_are_served_until_one_of_their_rooms_is_written_to():
+    clock = [100.0]
+    cache = SearchResultCache(FakeRoomVersions(clock), settle_time=2, timer=lambda: clock[0])
+    room_id, other_room_id = str(uuid4()), str(uuid4())
+    searches = []
+
+    async def search():
+        searches.append(clock[0])
+        return f'result {len(searches)}'.encode()
+
+    async def main():
+        assert await cache.get('Hello  world', [room_id, other_room_id], None, search) == b'result 1'
+        # normalized query, rooms in another order
+        assert await cache.get('hello world', [other_room_id, room_id], None, search) == b'result 1'
+        assert await cache.get('hello world', [room_id], None, search) == b'result 2'
+
+        await cache.room_written(room_id)
+        assert await cache.get('hello world', [room_id, other_room_id], None, search) == b'result 3'
+        # the new message might not be searchable yet
+        assert await cache.get('hello world', [room_id, other_room_id], None, search) == b'result 4'
+        clock[0] += 2
+        assert await cache.get('hello world', [room_id, other_room_id], None, search) == b'result 5'
+        assert await cache.get('hello world', [room_id, other_room_id], None, search) == b'result 5'
+
+    asyncio.run(main())
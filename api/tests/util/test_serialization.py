@@ -0,0 +1,81 @@
+from datetime import datetime
+import json
+from uuid import uuid4
+
+from cassandra.util import Date, Time
+import orjson
+
+from app.models import Message
+from app.schemas.message import MessageFetchSchema, MessageSchema
+from app.util.serialization import WEBSOCKET_INDEX_FORMAT, message_encoder, search_message_encoder, \
+    websocket_message_encoder
+
+
+def build_row(**values):
+    now = datetime(2022, 11, 1, 12, 30, 15, 123456)
+    return {
+        'room_id': uuid4(), 'index_id': now, 'uuid': uuid4(), 'sender_id': uuid4(), 'content': 'hi',
+        'username': 'test', 'date': Date(now.date()), 'stamp': Time(now.time()), 'saved': True,
+        'distributed': True, 'seen': False, 'deleted': False, 'failure': False, 'reply_message': None,
+        **values,
+    }
+
+
+def pydantic_page(rows, paging_state):
+    # the path of `get_messages` before the encoder: a schema per row, validated again as response model
+    def result_to_schema(result):
+        result = dict(result)
+        result['date'] = result['date'].date().strftime('%d-%m-%Y')
+        result['time_stamp'] = result['stamp'].time().strftime('%H:%M:%S')
+        return MessageSchema(**result)
+
+    messages = [result_to_schema(row) for row in rows]
+    schema = MessageFetchSchema(messages=messages, count=len(messages), paging_state=paging_state.hex())
+    return json.loads(schema.json(by_alias=True))
+
+
+def test_encoded_page_matches_the_schema():
+    rows = [build_row(), build_row(username=None, seen=True)]
+
+    encoded = orjson.loads(message_encoder.encode_page(rows, b'\x01\x02'))
+
+    assert encoded == pydantic_page(rows, b'\x01\x02')
+    assert encoded['messages'][0]['date'] == '01-11-2022'
+    assert encoded['messages'][0]['time_stamp'] == '12:30:15'
+
+
+def test_websocket_payload_of_a_message_matches_the_schema():
+    now = datetime.utcnow()
+    message = Message(
+        uuid=uuid4(), room_id=uuid4(), sender_id=uuid4(), content='hi', username='test',
+        index_id=now, message_date=now.date(), message_stamp=now.time(), saved=True,
+    )
+
+    payload = websocket_message_encoder.to_dict(message)
+
+    expected = MessageSchema.from_orm(message).dict(by_alias=True)
+    assert payload['_id'] == str(expected['_id'])
+    assert payload['senderId'] == str(expected['senderId'])
+    assert payload['indexId'] == now.strftime(WEBSOCKET_INDEX_FORMAT)
+    assert payload['date'] == expected['date'].strftime('%d-%m-%Y')
+    assert payload['time_stamp'] == expected['time_stamp'].strftime('%H:%M:%S')
+    unchanged = set(expected) - {'_id', 'senderId', 'indexId', 'date', 'time_stamp'}
+    assert {key: payload[key] for key in unchanged} == {key: expected[key] for key in unchanged}
+
+
+def test_search_hit_matches_the_encoded_row():
+    row = build_row()
+    # the source of the hit of the row, null values are left out
+    source = {
+        'room_id': str(row['room_id']), 'index_id': '2022-11-01T12:30:15.123Z', 'uuid': str(row['uuid']),
+        'sender_id': str(row['sender_id']), 'content': 'hi', 'username': 'test', 'date': '2022-11-01T00:00:00.000Z',
+        'stamp': row['stamp'].nanosecond_time, 'saved': True, 'distributed': True, 'seen': False, 'deleted': False,
+        'failure': False,
+    }
+
+    encoded = search_message_encoder.to_dict(source)
+
+    expected = message_encoder.to_dict(row)
+    assert encoded.pop('indexId') == '2022-11-01T12:30:15.123'
+    expected.pop('indexId')
+    assert encoded == expected
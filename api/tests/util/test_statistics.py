@@ -0,0 +1,70 @@
+import asyncio
+
+from app.util.statistics import AdminStatistics
+
+
+class FakeWebSocket:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.frames = []
+
+    async def send_text(self, frame):
+        if self.fail:
+            raise RuntimeError('connection closed')
+        self.frames.append(frame)
+
+
+def test_statistics_are_collected_once_for_all_admin_sockets():
+    async def run():
+        queries = []
+
+        async def count_users():
+            queries.append('users')
+            return 10
+
+        async def count_online_users():
+            queries.append('online')
+            return 4
+
+        statistics = AdminStatistics(count_users, count_online_users, lambda: 7)
+        sockets = [FakeWebSocket() for _ in range(3)]
+        for websocket in sockets:
+            await statistics.register(websocket)
+        broken = FakeWebSocket(fail=True)
+        statistics.sockets.add(broken)
+
+        queries.clear()
+        for _ in range(5):
+            statistics.record_message()
+        await statistics.broadcast()
+        return queries, sockets, broken, statistics
+
+    queries, sockets, broken, statistics = asyncio.run(run())
+    assert sorted(queries) == ['online', 'users']
+    assert all(websocket.frames[-1] is sockets[0].frames[-1] for websocket in sockets)
+    assert broken not in statistics.sockets
+    assert statistics.statistics['userCount'] == 10
+    assert statistics.statistics['onlineUsers'] == 4
+    assert statistics.statistics['connections'] == 7
+    assert statistics.statistics['messagesPerSecond'] > 0
+
+
+def test_failing_statistic_keeps_its_last_value():
+    async def run():
+        calls = []
+
+        async def count_users():
+            calls.append(1)
+            if len(calls) > 1:
+                raise RuntimeError('Neo4j unavailable')
+            return 10
+
+        async def count_online_users():
+            return 1
+
+        statistics = AdminStatistics(count_users, count_online_users, lambda: 0)
+        await statistics.collect()
+        await statistics.collect()
+        return statistics.statistics
+
+    assert asyncio.run(run())['userCount'] == 10
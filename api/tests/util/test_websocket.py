@@ -0,0 +1,301 @@
+import asyncio
+import inspect
+import time
+from unittest.mock import patch
+from uuid import uuid4
+
+from distributed_websocket import BrokerInterface, Message, WebSocketManager
+import orjson
+from prometheus_client import REGISTRY
+
+from app.util.websocket import BrokerHealthMonitor, BrokerState, EchoChatWebSocketManager, room_topic
+
+
+class FakeBroker(BrokerInterface):
+    """
+    Broker that only records what is published, messages are delivered explicitly with `deliver`.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def subscribe(self, channel):
+        pass
+
+    async def unsubscribe(self, channel):
+        pass
+
+    async def publish(self, channel, message):
+        self.published.append(orjson.loads(message) if isinstance(message, bytes) else dict(message))
+
+    async def get_message(self, **kwargs):
+        await asyncio.Event().wait()
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.frames = []
+
+    async def accept(self, *args, **kwargs):
+        pass
+
+    async def receive_json(self, *args, **kwargs):
+        pass
+
+    async def send_json(self, data, *args, **kwargs):
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        self.frames.append(data)
+        self.sent.append(orjson.loads(data))
+
+    async def iter_json(self):
+        yield
+
+    async def close(self, *args, **kwargs):
+        pass
+
+
+async def deliver(manager: EchoChatWebSocketManager):
+    # deliver the oldest published message to the local connections, as the broker listener would
+    data = manager.broker.published.pop(0)
+    manager.send_msg(Message(data=data, typ=data.pop('type'), topic=data.pop('topic'), conn_id=data.pop('conn_id')))
+    await asyncio.sleep(0)
+
+
+def create_manager() -> EchoChatWebSocketManager:
+    return EchoChatWebSocketManager('channel:test', broker_class=FakeBroker)
+
+
+def test_room_message_is_published_once_and_delivered_to_members():
+    async def run():
+        manager = create_manager()
+        room_id, member_id, other_id = uuid4(), uuid4(), uuid4()
+
+        member_ws, other_ws = FakeWebSocket(), FakeWebSocket()
+        member = await manager.new_connection(member_ws, member_id.hex)
+        await manager.new_connection(other_ws, str(other_id))
+        assert member.id == str(member_id)
+        manager.subscribe_rooms(member, [room_id.hex])
+
+        await manager.publish({'type': 'send', 'topic': room_topic(room_id), 'data': {'action': 'new_message'}})
+        assert len(manager.broker.published) == 1
+        await deliver(manager)
+
+        assert [msg['data'] for msg in member_ws.sent] == [{'action': 'new_message'}]
+        assert other_ws.sent == []
+
+    asyncio.run(run())
+
+
+def test_room_message_is_encoded_once_for_all_local_members():
+    async def run():
+        manager = create_manager()
+        room_id = uuid4()
+        sockets = [FakeWebSocket() for _ in range(50)]
+        for ws in sockets:
+            manager.subscribe_rooms(await manager.new_connection(ws, str(uuid4())), [room_id])
+
+        await manager.publish({'type': 'send', 'topic': room_topic(room_id), 'data': {'action': 'new_message'}})
+        with patch('app.util.websocket.orjson.dumps', wraps=orjson.dumps) as dumps:
+            await deliver(manager)
+
+        assert dumps.call_count == 1
+        frame = sockets[0].frames[0]
+        assert all(ws.frames == [frame] and ws.frames[0] is frame for ws in sockets)
+
+    asyncio.run(run())
+
+
+def test_message_for_multiple_users_reaches_only_their_connections():
+    async def run():
+        manager = create_manager()
+        user_ids = [str(uuid4()) for _ in range(3)]
+        sockets = [FakeWebSocket() for _ in user_ids]
+        for user_id, ws in zip(user_ids, sockets):
+            await manager.new_connection(ws, user_id)
+
+        await manager.publish({'type': 'send_by_conn_id', 'conn_id': user_ids[:2], 'data': {'action': 'user_update'}})
+        await deliver(manager)
+
+        assert [len(ws.sent) for ws in sockets] == [1, 1, 0]
+
+    asyncio.run(run())
+
+
+class FailingWebSocket(FakeWebSocket):
+    async def send_text(self, data):
+        raise RuntimeError('connection lost')
+
+
+def sample(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+def test_frames_are_instrumented():
+    async def run():
+        manager = create_manager()
+        room_id, message_id = uuid4(), str(uuid4())
+        for ws in [FailingWebSocket(), FakeWebSocket(), FakeWebSocket()]:
+            manager.subscribe_rooms(await manager.new_connection(ws, str(uuid4())), [room_id])
+
+        manager.track_delivery(message_id, time.perf_counter())
+        for _ in range(2):
+            await manager.publish({
+                'type': 'send', 'topic': room_topic(room_id),
+                'data': {'action': 'new_message', 'message': {'_id': message_id}},
+            })
+            await deliver(manager)
+
+    labels = {'action': 'new_message'}
+    before = [
+        sample('echochat_websocket_fanout_recipients_sum', labels),
+        sample('echochat_websocket_sends_total', {**labels, 'result': 'sent'}),
+        sample('echochat_websocket_sends_total', {**labels, 'result': 'failed'}),
+        sample('echochat_message_delivery_seconds_count'),
+        sample('echochat_broker_publish_duration_seconds_count'),
+    ]
+    asyncio.run(run())
+    after = [
+        sample('echochat_websocket_fanout_recipients_sum', labels),
+        sample('echochat_websocket_sends_total', {**labels, 'result': 'sent'}),
+        sample('echochat_websocket_sends_total', {**labels, 'result': 'failed'}),
+        sample('echochat_message_delivery_seconds_count'),
+        sample('echochat_broker_publish_duration_seconds_count'),
+    ]
+
+    # the delivery time is observed at the first send of the message only
+    assert [a - b for a, b in zip(after, before)] == [6, 4, 2, 1, 2]
+
+
+def test_room_membership_control_message_updates_subscriptions():
+    async def run():
+        manager = create_manager()
+        room_id, user_id = uuid4(), uuid4()
+        connection = await manager.new_connection(FakeWebSocket(), str(user_id))
+
+        await manager.publish_room_membership(user_id.hex, room_id, joined=True)
+        assert room_topic(room_id) in connection.topics  # applied locally before publishing
+        await deliver(manager)
+        assert room_topic(room_id) in connection.topics
+
+        await manager.publish_room_membership(user_id, room_id.hex, joined=False)
+        await deliver(manager)
+        assert room_topic(room_id) not in connection.topics
+
+    asyncio.run(run())
+
+
+def test_room_subscriptions_are_resynced_on_connect_and_reconnect():
+    async def run():
+        manager = create_manager()
+        user_id, old_room, new_room = uuid4(), uuid4(), uuid4()
+        rooms = {str(user_id): frozenset([old_room.hex])}
+        async def resolve_rooms(user_ids):
+            return {user: rooms[user] for user in user_ids if user in rooms}
+
+        manager.room_resolver = resolve_rooms
+
+        connection = await manager.new_connection(FakeWebSocket(), user_id.hex)
+        await manager.resync_room_subscriptions([connection])
+        assert connection.topics == {str(user_id), room_topic(old_room)}
+
+        # the membership change was published while this node was disconnected from the broker
+        rooms[str(user_id)] = frozenset([new_room.hex])
+        await manager.reconnect()
+        assert connection.topics == {str(user_id), room_topic(new_room)}
+        assert manager.listening
+
+        await manager.shutdown()
+
+    asyncio.run(run())
+
+
+def test_overridden_internals_match_the_base_class():
+    # the manager overrides and drives private members of fastapi-distributed-websocket (pinned in requirements.txt),
+    # an upgrade that changes them fails here instead of in production
+    for name in ('_publish_to_broker', '_broker_listener', '_send', '_broadcast', '_send_by_conn_id',
+                 '_send_multi_by_conn_id', 'send_msg', 'new_connection'):
+        base, override = getattr(WebSocketManager, name), getattr(EchoChatWebSocketManager, name)
+        assert list(inspect.signature(base).parameters) == list(inspect.signature(override).parameters), name
+        assert inspect.iscoroutinefunction(base) == inspect.iscoroutinefunction(override), name
+    manager = WebSocketManager('channel:test', broker_url='memory://')
+    assert manager._main_task is None and manager._send_tasks == []
+
+
+def test_reconnect_restarts_the_broker_listener_of_the_base_class():
+    async def run():
+        # the in-memory broker of the library, messages go through its listener like with Redis
+        manager = EchoChatWebSocketManager('channel:test', broker_url='memory://')
+        user_id, old_room, new_room = uuid4(), uuid4(), uuid4()
+        rooms = {str(user_id): frozenset([old_room.hex])}
+
+        async def resolve_rooms(user_ids):
+            return {user: rooms[user] for user in user_ids if user in rooms}
+
+        manager.room_resolver = resolve_rooms
+        await manager.startup()
+        websocket = FakeWebSocket()
+        connection = await manager.new_connection(websocket, user_id.hex)
+        await manager.resync_room_subscriptions([connection])
+        broker, listener = manager.broker, manager._main_task
+
+        rooms[str(user_id)] = frozenset([new_room.hex])
+        await manager.reconnect()
+        await asyncio.sleep(0)
+        assert manager.broker is not broker and listener.done()
+        assert manager.listening
+        assert connection.topics == {str(user_id), room_topic(new_room)}
+
+        await manager.publish({'type': 'send', 'topic': room_topic(new_room), 'data': {'action': 'new_message'}})
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await manager.shutdown()
+        return websocket.sent
+
+    sent = asyncio.run(run())
+    assert [frame['data']['action'] for frame in sent] == ['new_message']
+
+
+class FakeManager:
+    def __init__(self):
+        self.listening = True
+        self.reconnects = 0
+
+    async def reconnect(self):
+        self.reconnects += 1
+        self.listening = True
+
+
+def test_broker_health_monitor_opens_circuit_and_reconnects_once():
+    async def run():
+        manager = FakeManager()
+        monitor = BrokerHealthMonitor(manager, interval=1, failure_threshold=2, max_backoff=4)
+        results = iter([False, False, False, False, True, True])
+
+        async def ping():
+            return next(results)
+
+        monitor._ping = ping
+
+        await monitor.check()
+        assert monitor.healthy  # a single failure does not open the circuit
+        await monitor.check()
+        assert monitor.state is BrokerState.OPEN
+        await monitor.check()
+        await monitor.check()
+        assert monitor.next_delay() == 4  # exponential backoff, capped
+
+        await monitor.check()
+        assert monitor.healthy
+        await monitor.check()
+        assert manager.reconnects == 1
+
+    asyncio.run(run())
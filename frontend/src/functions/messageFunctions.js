@@ -59,27 +59,37 @@ const messageFunctions = {
   },
 
   /**
-   * Updates the message seen status of a message
+   * Moves the read cursor of the user in a chatroom forward, all messages up to the given one have been seen
    * @param {WebSocket} socket    The websocket connection to the backend
    * @param {String} roomId       The id of the room in which the message resides
-   * @param {String} messageIndex The index of the message to update (datetime)
-   * @param {String} messageId    The id of the message to update
+   * @param {String} messageIndex The index of the last seen message (datetime)
    */
-  sendMessageSeen(socket, roomId, messageIndex, messageId) {
+  sendReadCursor(socket, roomId, messageIndex) {
     return new Promise((resolve) => {
       const message = {
         type: 'send',
-        topic: 'message_seen',
+        topic: 'read_cursor',
         data: {
           roomId: roomId,
-          messageIndex: messageIndex,
-          messageId: messageId
+          indexId: messageIndex
         }
       }
 
       socket.send(JSON.stringify(message))
       resolve()
     })
+  },
+
+  /**
+   * Checks whether a message has been seen according to the read cursors of a chatroom
+   * @param {Object} message The message to check
+   * @param {Object} cursors The index of the last seen message (datetime), by user id
+   * @returns {Boolean}      True if any user other than the sender has read up to (or past) the message
+   */
+  isSeenByCursors(message, cursors) {
+    // REST messages have an ISO formatted index, websocket messages a space separated one
+    const messageIndex = String(message.indexId).replace('T', ' ')
+    return Object.entries(cursors).some(([userId, indexId]) => userId !== message.senderId && indexId >= messageIndex)
   }
 }
 
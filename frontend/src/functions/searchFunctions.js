@@ -12,11 +12,20 @@ const searchFunctions = {
   /**
    * Searches for messages by content
    * @param {String} searchQuery The content to search for within messages
+   * @param {String} pagingState Paging state of the previous page of results, to fetch the next page
+   * @param {Boolean} grouped    Whether to fetch the newest messages of every room (with the counts per room) instead
    * @returns {Promise}          A promise that resolves to an array of message objects
    */
-  searchMessagesByContent(searchQuery) {
+  searchMessagesByContent(searchQuery, pagingState = null, grouped = false) {
+    let url = `${baseUrl}/messages/content?c=${encodeURIComponent(searchQuery)}`
+    if (grouped) {
+      url += '&g=true'
+    } else if (pagingState) {
+      url += `&ps=${pagingState}`
+    }
+
     return axios
-      .get(`${baseUrl}/messages/content?c=${searchQuery}`, authConfig())
+      .get(url, authConfig())
       .then(response => response.data)
       .catch(error => {
         handleAxiosError(error, 'ERROR while searching messages by content:')
@@ -1,5 +1,8 @@
 import { WEBSOCKET_URL } from "@/util/constants"
 
+// Close code of a connection the server refused because it admits too many connections at once
+const TRY_AGAIN_LATER = 1013
+
 /**
  * A collection of functions to work with websocket connections to the backend.
  */
@@ -7,12 +10,13 @@ const websocketFunctions = {
   /**
    * Creates a new websocket connection to the backend.
    * @param {String} connectionId The id of the connection to create
-   * @param {Object} callbacks    The callbacks to use for the connection
+   * @param {Object} callbacks    The callbacks to use for the connection, and the JWT token to authenticate it with
    * @returns 
    */
-  createWebsocket(connectionId, {onOpenCallback=null, onMessageCallback, onCloseCallback, onErrorCallback=null, websocketUrlAddition=null}) {
+  createWebsocket(connectionId, {onOpenCallback=null, onMessageCallback, onCloseCallback, onErrorCallback=null, websocketUrlAddition=null, token=null}) {
     const websocketUrl = `${WEBSOCKET_URL}${websocketUrlAddition ? websocketUrlAddition : ''}`
-    const websocket = new WebSocket(`${websocketUrl}/${connectionId}`)
+    const query = token ? `?token=${encodeURIComponent(token)}` : ''
+    const websocket = new WebSocket(`${websocketUrl}/${connectionId}${query}`)
     websocket.onopen = () => {
       console.log("Websocket connection established")
       if (onOpenCallback) {
@@ -24,9 +28,9 @@ const websocketFunctions = {
       console.log("Websocket message received: ", data)
       onMessageCallback(data.data)
     }
-    websocket.onclose = () => {
+    websocket.onclose = (event) => {
       console.log("Websocket connection closed")
-      onCloseCallback()
+      onCloseCallback(event)
     }
     websocket.onerror = (error) => {
       console.log("Websocket error: ", error)
@@ -37,6 +41,19 @@ const websocketFunctions = {
     return websocket
   },
 
+  /**
+   * Gets the delay after which the server asked to reconnect, when it refused the connection because it is busy.
+   * @param {CloseEvent} event The close event of the websocket connection
+   * @returns {Number|null}    The delay in milliseconds, or null if the connection was not refused
+   */
+  getRetryDelay(event) {
+    if (!event || event.code !== TRY_AGAIN_LATER) {
+      return null
+    }
+    const delay = Number(event.reason)
+    return Number.isFinite(delay) ? delay : 1000
+  },
+
   /**
    * Checks if a websocket connection is open, otherwise creates one.
    * @param {WebSocket}         socket            The websocket connection to check
@@ -56,7 +73,8 @@ const websocketFunctions = {
           onOpenCallback: resolve,
           onMessageCallback: onMessageCallback, 
           onCloseCallback: onCloseCallback,
-          onErrorCallback: reject
+          onErrorCallback: reject,
+          token: localStorage.getItem('jwt')
         })
       }
     })